@@ -1,3 +1,4 @@
+import gc
 import pygame
 import sys
 import random
@@ -5,21 +6,27 @@ import math
 import os
 from random import randint, choice
 
-# Initialize pygame
-pygame.init()
-pygame.mixer.init()
+import assets
+import audio
+import dirty
+import engine
+import history
+import loader
+import lookahead
+import multiball
+import netplay
+import particles
+import replay
+import spectate
+import textcache
+from controls import controls
+from layers import screens
+from profiler import profiler
 
 
-# Load and play background music in a loop
-pygame.mixer.music.load("bg.mp3")  
-pygame.mixer.music.set_volume(0.5)  
-pygame.mixer.music.play(-1)
-
 
 # Screen dimensions
 WIDTH, HEIGHT = 1200, 800
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("DJONG Ultimate")
 
 # Classic Arcade Colors
 BLACK = (0, 0, 0)
@@ -31,23 +38,56 @@ YELLOW = (255, 255, 50)
 PURPLE = (150, 50, 255)
 ORANGE = (255, 150, 50)
 
+# Only the display is initialized before the first frame; fonts, sounds and
+# backgrounds load in the background until wait_for_assets()
+with assets.stage("display"):
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    pygame.display.set_caption("DJONG Ultimate")
+    screen.fill(BLACK)
+    pygame.display.flip()
+assets.milestone("first frame")
+
 # Game variables
 clock = pygame.time.Clock()
 FPS = 90
-font = pygame.font.SysFont('Arial', 30, bold=True)
-big_font = pygame.font.SysFont('Arial', 60, bold=True)
-title_font = pygame.font.SysFont('Impact', 80)
+font = big_font = title_font = None
 points_to_win = 5
-last_change_time = 0
-change_delay = 200  # milliseconds
+# Only redraw and push the regions that changed while PLAYING
+DIRTY_RECTS = os.environ.get("PINGPONG_DIRTY_RECTS", "1") != "0"
+# Record matches to, or replay one from, a file (see replay.py)
+RECORD = os.environ.get("PINGPONG_RECORD")
+REPLAY = os.environ.get("PINGPONG_REPLAY")
+tape = None
+# Networked two-player mode (see netplay.py): host on a UDP port, or join a host
+NET_HOST = os.environ.get("PINGPONG_HOST")
+NET_JOIN = os.environ.get("PINGPONG_JOIN")
+net = None
+# Broadcast the match to spectators on this TCP port (see spectate.py)
+SPECTATE = os.environ.get("PINGPONG_SPECTATE")
+# Bot trained with gymenv.py, offered as an extra difficulty
+POLICY = os.environ.get("PINGPONG_POLICY")
+# Balls in play at once; more than one is party mode (see multiball.py)
+BALLS = int(os.environ.get("PINGPONG_BALLS", "1"))
+# Finished matches are logged for the stats screen (see history.py)
+HISTORY = os.environ.get("PINGPONG_HISTORY", history.DEFAULT_PATH)
+matches = history.MatchLog(HISTORY) if HISTORY != "0" else None
+tally = None
+stats_loading = None
+broadcast = None
 crazy_mode = False
 ball_size_changes = True
 bs = 20  # Initial ball size
+# Hit sparks, ball trails and victory fireworks share one particle pool
+effects = particles.Particles()
+FIREWORK_COLORS = (YELLOW, ORANGE, GREEN, PURPLE, RED)
 
 # Game states
 MENU = 0
 PLAYING = 1
 GAME_OVER = 2
+STATS = 3
 game_state = MENU
 
 # Game modes
@@ -56,36 +96,24 @@ MULTI_PLAYER = 1
 game_mode = None
 
 # Difficulty levels
-EASY = 0
-MODERATE = 1
-HARD = 2
+EASY = engine.EASY
+MODERATE = engine.MODERATE
+HARD = engine.HARD
+GENIUS = lookahead.install()  # plans its shots on a worker thread
 difficulty = EASY
 difficulty_colors = [WHITE, YELLOW, RED]
+TRAINED = None
+if POLICY:
+    import gymenv
+    TRAINED = engine.register_policy(gymenv.LinearPolicy.load(POLICY))
 
 
-try:
-    bg_img = pygame.image.load("g-img.jpg")
-    bg_img = pygame.transform.scale(bg_img, (WIDTH, HEIGHT))
-except:
-    # Create retro gradient background if image not found
-    bg_img = pygame.Surface((WIDTH, HEIGHT))
-    for y in range(HEIGHT):
-        # Blue to purple gradient
-        color = (50, 50, 100 + int(155 * y / HEIGHT))
-        pygame.draw.line(bg_img, color, (0, y), (WIDTH, y))
-
-try:
-    pl_img = pygame.image.load("pl-img.jpg")
-    pl_img = pygame.transform.scale(pl_img, (WIDTH, HEIGHT))
-except:
-    # Create classic game background if image not found
-    pl_img = pygame.Surface((WIDTH, HEIGHT))
-    pl_img.fill(BLACK)
-    # Draw court lines
-    pygame.draw.rect(pl_img, BLUE, (0, 0, WIDTH, HEIGHT), 10)
-    for y in range(30, HEIGHT, 40):
-        pygame.draw.rect(pl_img, WHITE, (WIDTH//2 - 2, y, 4, 20))
-
+def quit_game():
+    if tape is not None:
+        tape.close()
+    profiler.export_on_exit()
+    pygame.quit()
+    sys.exit()
 
 def resource_path(relative_path):
     """ Get absolute path to resource (for PyInstaller compatibility). """
@@ -95,104 +123,174 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
-collision_sound = pygame.mixer.Sound(resource_path("collision.mp3"))
+def load_fonts():
+    return (pygame.font.SysFont('Arial', 30, bold=True),
+            pygame.font.SysFont('Arial', 60, bold=True),
+            pygame.font.SysFont('Impact', 80))
 
-class Paddle:
-    def __init__(self, x, y, color):
-        self.rect = pygame.Rect(x, y, 15, 100)
-        self.speed = 5
-        self.score = 0
-        self.color = color
-    
-    def move(self, up_key, down_key):
-        keys = pygame.key.get_pressed()
-        if keys[up_key] and self.rect.top > 0:
-            self.rect.y -= self.speed
-        if keys[down_key] and self.rect.bottom < HEIGHT:
-            self.rect.y += self.speed
-    
-    def ai_move(self, ball, difficulty):
-        if difficulty == EASY:
-            if random.random() > 0.7:
-                if ball.rect.centery < self.rect.centery and self.rect.top > 0:
-                    self.rect.y -= self.speed * 0.7
-                elif ball.rect.centery > self.rect.centery and self.rect.bottom < HEIGHT:
-                    self.rect.y += self.speed * 0.7
-        elif difficulty == MODERATE:
-            if ball.rect.centery < self.rect.centery and self.rect.top > 0:
-                self.rect.y -= self.speed * 0.9
-            elif ball.rect.centery > self.rect.centery and self.rect.bottom < HEIGHT:
-                self.rect.y += self.speed * 0.9
-        else:  # HARD
-            predicted_y = ball.rect.centery + (ball.dx * (self.rect.left - ball.rect.right) / ball.speed)
-            predicted_y = max(50, min(predicted_y, HEIGHT - 50))
-            
-            if predicted_y < self.rect.centery and self.rect.top > 0:
-                self.rect.y -= self.speed * 1.1
-            elif predicted_y > self.rect.centery and self.rect.bottom < HEIGHT:
-                self.rect.y += self.speed * 1.1
-    
-    def draw(self):
-        pygame.draw.rect(screen, self.color, self.rect)
-        pygame.draw.rect(screen, WHITE, self.rect, 2)
-
-class Ball:
-    def __init__(self):
-        self.rect = pygame.Rect(WIDTH // 2 - bs//2, HEIGHT // 2 - bs//2, bs, bs)
-        self.dx = 5 * random.choice([-1, 1])
-        self.dy = 5 * random.choice([-1, 1])
-        self.speed = 5
-        self.colors = [RED, GREEN, BLUE, YELLOW]
-        self.current_color = RED
-    
-    def move(self):
-        self.rect.x += self.dx * (1.5 if crazy_mode else 1)
-        self.rect.y += self.dy * (1.5 if crazy_mode else 1)
-        
-        if self.rect.top <= 0 or self.rect.bottom >= HEIGHT:
-            self.dy *= -1
-        
-        if self.rect.left <= 0:
-            return "right"
-        if self.rect.right >= WIDTH:
-            return "left"
-        return None
-    
-    def draw(self):
-        self.current_color = choice(self.colors) if crazy_mode else RED
-        pygame.draw.ellipse(screen, self.current_color, self.rect)
-        pygame.draw.ellipse(screen, WHITE, self.rect, 2)
-    
-    def reset(self):
-        self.rect.center = (WIDTH // 2, HEIGHT // 2)
-        self.dx = 5 * random.choice([-1, 1])
-        self.dy = 5 * random.choice([-1, 1])
-        self.speed = 5
-        self.rect.size = (bs, bs)
-    
-    def collide(self, paddle):
-        if self.rect.colliderect(paddle.rect):
-            relative_intersect = (paddle.rect.centery - self.rect.centery) / (paddle.rect.height / 2)
-            bounce_angle = relative_intersect * (5 * 3.14159 / 12)
-            
-            self.speed = min(self.speed * 1.05, 12)
-            self.dx = -self.dx
-            self.dy = -self.speed * pygame.math.Vector2(1, 0).rotate(bounce_angle * 180 / 3.14159).y
-            
-            #paddle.color = (randint(0, 255), randint(0, 255), randint(0, 255))
-            pygame.mixer.Sound.play(collision_sound) 
-            return True
-        return False
-
-def draw_text(text, font, color, x, y):
-    text_surface = font.render(text, True, color)
+def load_backgrounds():
+    # Pre-scaled from the asset cache; the retro gradient and classic court
+    # are generated when g-img.jpg / pl-img.jpg are missing
+    bg_img = assets.background("g-img.jpg", (WIDTH, HEIGHT), assets.gradient)
+    pl_img = assets.background("pl-img.jpg", (WIDTH, HEIGHT), assets.court)
+    return bg_img, pl_img
+
+def load_audio():
+    effects = audio.AudioManager()
+    # Load and play background music in a loop
+    pygame.mixer.music.load("bg.mp3")  
+    pygame.mixer.music.set_volume(0.5)  
+    pygame.mixer.music.play(-1)
+    effects.load("collision", resource_path("collision.mp3"))
+    return effects
+
+fonts_loading = loader.submit("fonts", load_fonts)
+backgrounds_loading = loader.submit("backgrounds", load_backgrounds)
+audio_loading = loader.submit("audio", load_audio)
+bg_img = pl_img = None
+sfx = None
+
+def settle_heap():
+    """ Collect now, between screens, and freeze whatever survives.
+
+    Frozen objects are never scanned by the garbage collector again, so a
+    full collection mid-match only walks what was created since, not every
+    font, surface and module object loaded at startup.
+    """
+    gc.collect()
+    gc.freeze()
+
+def wait_for_assets():
+    """ Block until the background loads are done and publish them as globals. """
+    global font, big_font, title_font, bg_img, pl_img, sfx
+    if font is not None:
+        return
+    font, big_font, title_font = fonts_loading.result()
+    bg_img, pl_img = backgrounds_loading.result()
+    sfx = audio_loading.result()
+    screens.invalidate()
+    assets.milestone("assets ready")
+    assets.report()
+    settle_heap()
+
+class Paddle(engine.Paddle):
+    @property
+    def rect(self):
+        return pygame.Rect(self.x, self.y, self.width, self.height)
+
+    def rect_at(self, alpha):
+        return pygame.Rect(self.at(alpha), (self.width, self.height))
+
+    def draw(self, color, alpha=1.0):
+        rect = self.rect_at(alpha)
+        pygame.draw.rect(screen, color, rect)
+        pygame.draw.rect(screen, WHITE, rect, 2)
+        return rect
+
+class Ball(engine.Ball):
+    colors = [RED, GREEN, BLUE, YELLOW]
+    current_color = RED
+
+    @property
+    def rect(self):
+        return pygame.Rect(self.x, self.y, self.width, self.height)
+
+    def rect_at(self, alpha):
+        return pygame.Rect(self.at(alpha), (self.width, self.height))
+
+    def draw(self, alpha=1.0):
+        # Crazy mode cycles colors, and the trail keeps the ones already shown
+        self.current_color = self.colors[assets.ticks() // 100 % len(self.colors)] if crazy_mode else RED
+        rect = self.rect_at(alpha)
+        pygame.draw.ellipse(screen, self.current_color, rect)
+        pygame.draw.ellipse(screen, WHITE, rect, 2)
+        return rect
+
+def build_ball(size, color):
+    surface = pygame.Surface((size, size)).convert()
+    surface.set_colorkey(BLACK)
+    pygame.draw.ellipse(surface, color, (0, 0, size, size))
+    pygame.draw.ellipse(surface, WHITE, (0, 0, size, size), 2)
+    return surface
+
+def ball_sprite(size, color):
+    """ A ball drawn once into a cached layer, for party mode's hundreds of balls. """
+    return screens.get(("ball", size), color, build_ball, size, color)
+
+def draw_balls(match, alpha=1.0):
+    """ Every ball of a party match as one batch of sprite blits; returns their rects. """
+    color = Ball.colors[assets.ticks() // 100 % len(Ball.colors)] if crazy_mode else RED
+    match.ball.current_color = color  # for the trail
+    return screen.blits([(ball_sprite(ball.width, color), ball.at(alpha)) for ball in match.balls])
+
+class Match(engine.Match):
+    paddle_class = Paddle
+    ball_class = Ball
+
+class PartyMatch(multiball.MultiBallMatch):
+    paddle_class = Paddle
+    ball_class = Ball
+
+def new_match():
+    ai = difficulty if game_mode == SINGLE_PLAYER else None
+    # Netplay only syncs one ball, so party mode is local only. Every ball
+    # scores, so a match is worth points_to_win per ball
+    if BALLS > 1 and net is None:
+        return PartyMatch(WIDTH, HEIGHT, points_to_win * BALLS, crazy=crazy_mode, ball_size=bs, right_ai=ai,
+                          balls=BALLS)
+    return Match(WIDTH, HEIGHT, points_to_win, crazy=crazy_mode, ball_size=bs, right_ai=ai)
+
+def start_match():
+    """ New match from the menu settings, recorded if PINGPONG_RECORD is set. """
+    global tape, tally
+    if tape is not None:
+        tape.close()
+    match = new_match()
+    # Recordings replay on a one-ball Match
+    tape = replay.Recorder(match, RECORD) if RECORD and not isinstance(match, PartyMatch) else None
+    tally = history.Tally() if matches is not None else None
+    effects.clear()
+    settle_heap()
+    return match
+
+def start_replay(path):
+    """ Match driven by a recording instead of the keyboard, straight into PLAYING. """
+    global tape, tally, game_state
+    recording = replay.Recording.load(path)
+    tape = replay.Player(recording)
+    tally = None  # replays aren't new matches
+    game_state = PLAYING
+    match = recording.match(Match)
+    settle_heap()
+    return match
+
+def set_ball_size(match, size):
+    # Mid-match resizes are part of a recording, and come from it in a replay
+    if tape is not None and game_state == PLAYING:
+        tape.resize(match, size)
+    else:
+        match.set_ball_size(size)
+
+def draw_text(text, font, color, x, y, surface=None):
+    if surface is None:
+        surface = screen
+    text_surface = textcache.render(font, text, True, color)
     text_rect = text_surface.get_rect()
     text_rect.center = (x, y)
-    screen.blit(text_surface, text_rect)
+    surface.blit(text_surface, text_rect)
+    return text_rect
+
+def build_button(text, font, width, height, color, border_color):
+    surface = pygame.Surface((width, height))
+    pygame.draw.rect(surface, color, (0, 0, width, height))
+    pygame.draw.rect(surface, border_color, (0, 0, width, height), 3)
+    draw_text(text, font, BLACK, width // 2, height // 2, surface)
+    return surface
 
 def draw_button(text, font, color, x, y, width, height, hover_color, action=None, selected=False):
-    mouse = pygame.mouse.get_pos()
-    click = pygame.mouse.get_pressed()
+    # Hover and clicks come from this frame's input snapshot
+    snapshot = controls.snapshot
+    rect = (x, y, width, height)
     
     current_color = color
     border_color = WHITE
@@ -200,41 +298,56 @@ def draw_button(text, font, color, x, y, width, height, hover_color, action=None
     if selected:
         current_color = hover_color
         border_color = YELLOW
-    elif x < mouse[0] < x + width and y < mouse[1] < y + height:
+    elif snapshot.hovering(rect):
         current_color = hover_color
     
-    pygame.draw.rect(screen, current_color, (x, y, width, height))
-    pygame.draw.rect(screen, border_color, (x, y, width, height), 3)
+    # Each button is a cached layer, rebuilt only when its colors change
+    layer = screens.get(("button", text, x, y), (current_color, border_color), build_button,
+                        text, font, width, height, current_color, border_color)
+    screen.blit(layer, (x, y))
     
-    draw_text(text, font, BLACK, x + width // 2, y + height // 2)
-    
-    if click[0] == 1 and x < mouse[0] < x + width and y < mouse[1] < y + height and action is not None:
+    if action is not None and snapshot.clicked(rect):
         return action
     return None
 
-def game_menu():
-    global game_state, points_to_win, difficulty, last_change_time, game_mode, crazy_mode
-
-    screen.blit(bg_img, (0, 0))
+def build_menu(mode):
+    surface = bg_img.copy()
 
     # Title with retro effect
-    draw_text("DJONG ULTIMATE", title_font, RED, WIDTH // 2 + 5, 105)
-    draw_text("DJONG ULTIMATE", title_font, WHITE, WIDTH // 2, 100)
+    draw_text("DJONG ULTIMATE", title_font, RED, WIDTH // 2 + 5, 105, surface)
+    draw_text("DJONG ULTIMATE", title_font, WHITE, WIDTH // 2, 100, surface)
+    draw_text("GAME MODE:", font, WHITE, WIDTH // 2, 300, surface)
+
+    if mode == SINGLE_PLAYER:
+        draw_text("DIFFICULTY:", font, WHITE, WIDTH // 2 , 440, surface)
+        # Draw W/S movement instruction at the bottom
+        move_text = textcache.render(font, "You're left paddle.. Use W and S keys to move up and down", True, WHITE)
+    else:
+        move_text = textcache.render(font, "Left Paddle W(up), S(down) -- Right Paddle UPkey and DOWNkey ", True, WHITE)
+    surface.blit(move_text, (WIDTH // 2 - move_text.get_width() // 2, HEIGHT - 50))
+
+    move_text = textcache.render(font, "Press B to Increase Ball Size and X to Reduce", True, WHITE)
+    surface.blit(move_text, (310,680))
+
+    pygame.draw.rect(surface, RED, (0, 0, WIDTH, HEIGHT), 10)
+    return surface
+
+def game_menu():
+    global game_state, points_to_win, difficulty, game_mode, crazy_mode
+
+    # Static parts of the menu are composed once per game mode
+    screen.blit(screens.get("menu", game_mode, build_menu, game_mode), (0, 0))
     
-    # Points to win selector
-    current_time = pygame.time.get_ticks()
+    # Points to win selector, one step per click
     draw_text(f"POINTS TO WIN: {points_to_win}", font, WHITE, WIDTH // 2, 200)
     
-    if draw_button("-", font, GREEN, WIDTH // 2 - 120, 230, 50, 50, YELLOW,"decrease") == "decrease" and current_time - last_change_time > change_delay:
+    if draw_button("-", font, GREEN, WIDTH // 2 - 120, 230, 50, 50, YELLOW,"decrease") == "decrease":
         points_to_win = max(1, points_to_win - 1)
-        last_change_time = current_time
     
-    if draw_button("+", font, GREEN, WIDTH // 2 + 70, 230, 50, 50, YELLOW,"increase") == "increase" and current_time - last_change_time > change_delay:
+    if draw_button("+", font, GREEN, WIDTH // 2 + 70, 230, 50, 50, YELLOW,"increase") == "increase":
         points_to_win = min(10, points_to_win + 1)
-        last_change_time = current_time
  
     # Game mode selector
-    draw_text("GAME MODE:", font, WHITE, WIDTH // 2, 300)
     single_action = draw_button("1 PLAYER", font, GREEN, WIDTH//2 - 150, 330, 140, 50, 
                               BLUE, "single", game_mode == SINGLE_PLAYER)
     multi_action = draw_button("2 PLAYERS", font, GREEN, WIDTH//2 + 10, 330, 140, 50, 
@@ -247,60 +360,107 @@ def game_menu():
     
     # Difficulty selector (only for single player)
     if game_mode == SINGLE_PLAYER:
-        draw_text("DIFFICULTY:", font, WHITE, WIDTH // 2 , 440)
-        easy_action = draw_button("EASY", font, GREEN, WIDTH//2 - 150, 470, 100, 50, 
+        easy_action = draw_button("EASY", font, GREEN, WIDTH//2 - 275, 470, 100, 50, 
                                 difficulty_colors[EASY], "easy", difficulty == EASY)
-        moderate_action = draw_button("NORMAL", font, GREEN, WIDTH//2 - 25, 470, 150, 50, 
+        moderate_action = draw_button("NORMAL", font, GREEN, WIDTH//2 - 150, 470, 150, 50, 
                                     difficulty_colors[MODERATE], "moderate", difficulty == MODERATE)
-        hard_action = draw_button("HARD", font, GREEN, WIDTH//2 + 175, 470, 100, 50, 
+        hard_action = draw_button("HARD", font, GREEN, WIDTH//2 + 25, 470, 100, 50, 
                                  difficulty_colors[HARD], "hard", difficulty == HARD)
-            # Draw W/S movement instruction at the bottom
-        move_text = font.render("You're left paddle.. Use W and S keys to move up and down", True, WHITE)
-        screen.blit(move_text, (WIDTH // 2 - move_text.get_width() // 2, HEIGHT - 50))
+        genius_action = draw_button("GENIUS", font, GREEN, WIDTH//2 + 150, 470, 130, 50,
+                                    PURPLE, "genius", difficulty == GENIUS)
+        trained_action = None
+        if TRAINED is not None:
+            trained_action = draw_button("TRAINED", font, GREEN, WIDTH//2 + 305, 470, 150, 50,
+                                         ORANGE, "trained", difficulty == TRAINED)
         if easy_action == "easy":
             difficulty = EASY
         elif moderate_action == "moderate":
             difficulty = MODERATE
         elif hard_action == "hard":
             difficulty = HARD
-    else:
-            
-        move_text = font.render("Left Paddle W(up), S(down) -- Right Paddle UPkey and DOWNkey ", True, WHITE)
-        screen.blit(move_text, (WIDTH // 2 - move_text.get_width() // 2, HEIGHT - 50))
-    
-
-    move_text = font.render("Press B to Increase Ball Size and X to Reduce", True, WHITE)
-    screen.blit(move_text, (310,680))
-           
-
+        elif genius_action == "genius":
+            difficulty = GENIUS
+        elif trained_action == "trained":
+            difficulty = TRAINED
     
     # Start button
     if draw_button("START", big_font, GREEN, WIDTH // 2 - 100, 550, 200, 80, YELLOW, "start"):
         game_state = PLAYING
         return True
-    pygame.draw.rect(screen, RED, (0, 0, WIDTH, HEIGHT), 10)
+    
+    if draw_button("STATS", font, GREEN, WIDTH // 2 + 150, 565, 150, 50, YELLOW, "stats"):
+        show_stats()
     return False
 
-def game_over_screen(player_won):
+def show_stats():
+    """ Switch to the stats screen; the query runs on a loader thread, never in the frame loop. """
+    global game_state, stats_loading
+    game_state = STATS
+    stats_loading = loader.background(matches.summary) if matches is not None else None
+
+def stats_lines():
+    if stats_loading is None:
+        return ["MATCH HISTORY IS OFF"]
+    if not stats_loading.done():
+        return ["LOADING..."]
+    if stats_loading.exception() is not None:
+        return ["MATCH HISTORY IS UNREADABLE"]
+    return history.describe(stats_loading.result())
+
+def build_stats():
+    surface = bg_img.copy()
+    draw_text("HIGH SCORES", title_font, RED, WIDTH // 2 + 5, 105, surface)
+    draw_text("HIGH SCORES", title_font, WHITE, WIDTH // 2, 100, surface)
+    line_font = pygame.font.Font(None, 40)
+    for i, line in enumerate(stats_lines()):
+        draw_text(line, line_font, WHITE, WIDTH // 2, 200 + 38 * i, surface)
+    pygame.draw.rect(surface, RED, (0, 0, WIDTH, HEIGHT), 10)
+    return surface
+
+def stats_screen():
     global game_state
-    
+
+    # Rebuilt once when the query lands
+    done = stats_loading is None or stats_loading.done()
+    screen.blit(screens.get("stats", (stats_loading, done), build_stats), (0, 0))
+
+    if draw_button("BACK", font, GREEN, WIDTH // 2 - 100, HEIGHT - 110, 200, 60, YELLOW, "back"):
+        game_state = MENU
+        return True
+    return False
+
+def save_match(match):
+    """ Log a finished match; the append and its fsync happen on a loader thread. """
+    if tally is not None:
+        flags = history.NETWORK if net is not None else 0
+        loader.background(matches.append, tally.record(match, flags))
+
+def build_game_over(player_won):
+    surface = pl_img.copy()
     overlay = pygame.Surface((WIDTH, HEIGHT), pygame.SRCALPHA)
     overlay.fill((0, 0, 0, 180))
-    screen.blit(overlay, (0, 0))
+    surface.blit(overlay, (0, 0))
     
     if player_won:
         # Victory graffiti effect
-        draw_text("VICTORY!", title_font, YELLOW, WIDTH // 2, HEIGHT // 2 - 80)
-        draw_text("VICTORY!", title_font, ORANGE, WIDTH // 2 + 5, HEIGHT // 2 - 75)
-        
-        # Particle effect
-        for _ in range(20):
-            x = random.randint(WIDTH//2 - 100, WIDTH//2 + 100)
-            y = random.randint(HEIGHT//2 - 50, HEIGHT//2 + 50)
-            pygame.draw.circle(screen, YELLOW, (x, y), random.randint(2, 5))
+        draw_text("VICTORY!", title_font, YELLOW, WIDTH // 2, HEIGHT // 2 - 80, surface)
+        draw_text("VICTORY!", title_font, ORANGE, WIDTH // 2 + 5, HEIGHT // 2 - 75, surface)
     else:
-        draw_text("GAME OVER", title_font, RED, WIDTH // 2, HEIGHT // 2 - 80)
-        draw_text("TRY AGAIN!", font, WHITE, WIDTH // 2, HEIGHT // 2 - 20)
+        draw_text("GAME OVER", title_font, RED, WIDTH // 2, HEIGHT // 2 - 80, surface)
+        draw_text("TRY AGAIN!", font, WHITE, WIDTH // 2, HEIGHT // 2 - 20, surface)
+    return surface
+
+def game_over_screen(player_won, frame_time=engine.DT):
+    global game_state
+    
+    screen.blit(screens.get("game_over", player_won, build_game_over, player_won), (0, 0))
+    
+    if player_won and random.random() < frame_time * 3:
+        # Fireworks, about three bursts a second
+        effects.emit(150, random.randint(WIDTH // 5, 4 * WIDTH // 5), random.randint(HEIGHT // 8, HEIGHT // 2),
+                     280, 1.4, choice(FIREWORK_COLORS), gravity=250)
+    effects.update(frame_time)
+    effects.draw(screen)
     
     # Restart button
     if draw_button("RESTART", font, GREEN, WIDTH // 2 - 100, HEIGHT // 2 + 100, 200, 60, YELLOW, "restart"):
@@ -309,88 +469,237 @@ def game_over_screen(player_won):
     
     # Quit button
     if draw_button("QUIT", font, RED, WIDTH // 2 - 100, HEIGHT // 2 + 180, 200, 60, ORANGE, "quit"):
-        pygame.quit()
-        sys.exit()
+        quit_game()
     
     return False
 
+def draw_profile_overlay(renderer):
+    # Refreshed four times a second so the overlay itself stays cheap
+    def build():
+        overlay_font = pygame.font.Font(None, 20)
+        lines = ["phase    p50   p95   p99"] + profiler.overlay_lines() + [renderer.overlay_line()]
+        if sfx is not None:
+            lines += sfx.overlay_lines()
+        surface = pygame.Surface((230, 16 * len(lines) + 8), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 160))
+        for i, line in enumerate(lines):
+            surface.blit(overlay_font.render(line, True, WHITE), (6, 4 + 16 * i))
+        return surface
+
+    surface = screens.get("profile", assets.ticks() // 250, build)
+    return screen.blit(surface, (12, 12))
+
+def spawn_effects(match, events):
+    """ Sparks off the paddle on a hit, and a short trail behind the ball. """
+    ball = match.ball
+    # In party mode match.hits has the ball of each HIT, in order
+    hits = iter(getattr(match, "hits", ()))
+    for kind, side in events:
+        if kind == engine.HIT:
+            left = side == engine.LEFT
+            hit = next(hits, ball)
+            effects.emit(30, hit.centerx, hit.centery, 260, 0.4, GREEN if left else RED,
+                         0.0 if left else math.pi, 1.1)
+    effects.emit(2, ball.centerx, ball.centery, 25, 0.3, ball.current_color)
+
+def play_frame(match, stepper, renderer, frame_time):
+    """ Advance the match by frame_time and draw it; True if only dirty rects need presenting. """
+    global game_state
+    if DIRTY_RECTS:
+        renderer.restore()
+    else:
+        screen.blit(pl_img, (0, 0))
+
+    # Left paddle is always W/S, right paddle is the bot or UP/DOWN
+    snapshot = controls.snapshot
+    live = (snapshot.bits(pygame.K_w, pygame.K_s), snapshot.bits(pygame.K_UP, pygame.K_DOWN))
+    rules = multiball if isinstance(match, multiball.MultiBallMatch) else engine
+    
+    # Ball logic, in fixed ticks however long the last frame took
+    for _ in range(stepper.advance(frame_time)):
+        if tape is not None and tape.finished(match):
+            game_state = MENU
+            break
+        inputs = live if tape is None else tape.inputs(match, live)
+        if net is not None and game_mode == MULTI_PLAYER:
+            inputs = (inputs[0], net.remote_input())
+        rules.step_paddles(match, inputs)
+        controls.applied()
+        profiler.mark("paddles")
+        events = rules.step_ball(match)
+        for kind, side in events:
+            if kind == engine.HIT:
+                sfx.play("collision")
+        spawn_effects(match, events)
+        if tally is not None:
+            tally.observe(match, events)
+        if net is not None:
+            net.publish(match, events)
+        if broadcast is not None:
+            broadcast.publish(match, events)
+        profiler.mark("ball")
+        if match.over:
+            save_match(match)
+            game_state = GAME_OVER
+            break
+    
+    # Draw elements, particles underneath
+    effects.update(frame_time)
+    trail = effects.draw(screen)
+    profiler.mark("effects")
+    alpha = stepper.alpha
+    sprites = [match.left.draw(GREEN, alpha), match.right.draw(RED, alpha)]
+    if isinstance(match, PartyMatch):
+        sprites += draw_balls(match, alpha)
+    else:
+        sprites.append(match.ball.draw(alpha))
+    if trail is not None:
+        sprites.append(trail)
+    profiler.mark("draw")
+    
+    # Draw scores
+    sprites.append(draw_text(f"{match.left.score}", big_font, GREEN, WIDTH // 4, 50))
+    sprites.append(draw_text(f"{match.right.score}", big_font, RED, 3 * WIDTH // 4, 50))
+    profiler.mark("text")
+    
+    if DIRTY_RECTS:
+        for rect in sprites:
+            renderer.mark(rect)
+    return DIRTY_RECTS
+
+def client_frame(match, stepper, renderer, frame_time):
+    """ PLAYING as a network client: predict our paddle, take everything else from the host. """
+    global game_state
+    if DIRTY_RECTS:
+        renderer.restore()
+    else:
+        screen.blit(pl_img, (0, 0))
+
+    # The client is the right paddle, on either set of keys
+    snapshot = controls.snapshot
+    bits = snapshot.bits(pygame.K_UP, pygame.K_DOWN) | snapshot.bits(pygame.K_w, pygame.K_s)
+    for _ in range(stepper.advance(frame_time)):
+        net.predict(match.right, bits, match.height)
+        controls.applied()
+    profiler.mark("paddles")
+    hits = net.render(match, frame_time)
+    if hits:
+        sfx.play("collision")
+    # Snapshots carry a hit count, not a side; the ball is still near the paddle
+    side = engine.LEFT if match.ball.centerx < match.width / 2 else engine.RIGHT
+    spawn_effects(match, [(engine.HIT, side)] * hits)
+    profiler.mark("ball")
+    if match.over:
+        game_state = GAME_OVER
+
+    effects.update(frame_time)
+    trail = effects.draw(screen)
+    profiler.mark("effects")
+    sprites = [match.left.draw(GREEN), match.right.draw(RED), match.ball.draw()]
+    if trail is not None:
+        sprites.append(trail)
+    profiler.mark("draw")
+    sprites.append(draw_text(f"{match.left.score}", big_font, GREEN, WIDTH // 4, 50))
+    sprites.append(draw_text(f"{match.right.score}", big_font, RED, 3 * WIDTH // 4, 50))
+    if not net.connected:
+        waiting = "SERVER FULL, RETRYING" if net.full else "WAITING FOR HOST"
+        sprites.append(draw_text(waiting, font, WHITE, WIDTH // 2, HEIGHT // 2 + 60))
+    profiler.mark("text")
+
+    if DIRTY_RECTS:
+        for rect in sprites:
+            renderer.mark(rect)
+    return DIRTY_RECTS
+
 def main():
-    global game_state, difficulty, crazy_mode, bs
+    global game_state, difficulty, crazy_mode, bs, game_mode, net, broadcast
     
-    player = Paddle(20, HEIGHT // 2 - 50, GREEN)
-    opponent = Paddle(WIDTH - 35, HEIGHT // 2 - 50, RED)
-    ball = Ball()
+    # The menu is the first thing that needs fonts and backgrounds; keep the
+    # window responsive until they have loaded
+    while not loader.ready((fonts_loading, backgrounds_loading, audio_loading)):
+        if controls.poll().quit:
+            quit_game()
+        clock.tick(FPS)
+    wait_for_assets()
+
+    if NET_HOST:
+        net = netplay.Host(netplay.link_from_env(os.environ, int(NET_HOST)), WIDTH, HEIGHT)
+        game_mode = MULTI_PLAYER
+    elif NET_JOIN:
+        net = netplay.Client(netplay.link_from_env(os.environ), netplay.parse_address(NET_JOIN))
+        game_state = PLAYING
+    client = isinstance(net, netplay.Client)
+    if SPECTATE:
+        broadcast = spectate.Broadcaster(int(SPECTATE))
+
+    match = start_replay(REPLAY) if REPLAY else new_match()
+    stepper = engine.FixedStep()
+    renderer = dirty.DirtyRenderer(screen, pl_img)
+    frame_time = 0.0
     
     while True:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_b and ball_size_changes:
-                    bs = min(50, bs * 2)
-                    ball.rect.size = (bs, bs)
-                if event.key == pygame.K_x and ball_size_changes:
-                    bs = max(10, bs // 2)
-                    ball.rect.size = (bs, bs)
+        profiler.begin_frame()
+        dirty_frame = False
+        snapshot = controls.poll()
+        if snapshot.quit:
+            quit_game()
+        if pygame.K_F3 in snapshot.pressed:
+            profiler.toggle()
+            renderer.invalidate()
+        if pygame.K_b in snapshot.pressed and ball_size_changes:
+            bs = min(50, bs * 2)
+            set_ball_size(match, bs)
+        if pygame.K_x in snapshot.pressed and ball_size_changes:
+            bs = max(10, bs // 2)
+            set_ball_size(match, bs)
+        
+        if net is not None:
+            net.poll(match)
+        profiler.mark("events")
         
         if game_state == MENU:
-           
-            screen.blit(bg_img, (0, 0))
             if game_menu():
-                player = Paddle(20, HEIGHT // 2 - 50, GREEN)
-                opponent = Paddle(WIDTH - 35, HEIGHT // 2 - 50, RED)
-                ball = Ball()
+                match = start_match()
+                stepper.reset()
+                renderer.invalidate()
         
         elif game_state == PLAYING:
-         
-            screen.blit(pl_img, (0, 0))
-
-            # Player controls
-            player.move(pygame.K_w, pygame.K_s)
-            
-            # Opponent controls
-            if game_mode == SINGLE_PLAYER:
-                opponent.ai_move(ball, difficulty)
+            if client:
+                dirty_frame = client_frame(match, stepper, renderer, frame_time)
             else:
-                opponent.move(pygame.K_UP, pygame.K_DOWN)
-            
-            # Ball logic
-            result = ball.move()
-            if result == "left":
-                player.score += 1
-                ball.reset()
-                if player.score >= points_to_win:
-                    game_state = GAME_OVER
-            elif result == "right":
-                opponent.score += 1
-                ball.reset()
-                if opponent.score >= points_to_win:
-                    game_state = GAME_OVER
-            
-            ball.collide(player)
-            ball.collide(opponent)
-            
-            # Draw elements
-            player.draw()
-            opponent.draw()
-            ball.draw()
-            
-            # Draw scores
-            draw_text(f"{player.score}", big_font, GREEN, WIDTH // 4, 50)
-            draw_text(f"{opponent.score}", big_font, RED, 3 * WIDTH // 4, 50)
+                dirty_frame = play_frame(match, stepper, renderer, frame_time)
+        
+        elif game_state == GAME_OVER and client:
+            # Only the host can start the next match; its snapshots say when it has
+            net.render(match, frame_time)
+            if not game_over_screen(match.right.score > match.left.score, frame_time) and not match.over:
+                game_state = PLAYING
+            if game_state != GAME_OVER:
+                effects.clear()
+                renderer.invalidate()
         
         elif game_state == GAME_OVER:
-            screen.blit(pl_img, (0, 0))
-            player_won = player.score > opponent.score
-            if game_over_screen(player_won):
-                player = Paddle(20, HEIGHT // 2 - 50, GREEN)
-                opponent = Paddle(WIDTH - 35, HEIGHT // 2 - 50, RED)
-                ball = Ball()
+            player_won = match.left.score > match.right.score
+            if game_over_screen(player_won, frame_time):
+                match = new_match()
         
-        pygame.display.flip()
-        clock.tick(FPS)
+        elif game_state == STATS:
+            stats_screen()
+        
+        if game_state != PLAYING:
+            profiler.mark("draw")
+        if profiler.enabled:
+            overlay = draw_profile_overlay(renderer)
+            if dirty_frame:
+                renderer.mark(overlay)
+        
+        if dirty_frame:
+            renderer.present()
+        else:
+            renderer.flip()
+        controls.presented()
+        profiler.mark("flip")
+        frame_time = clock.tick(FPS) / 1000.0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
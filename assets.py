@@ -0,0 +1,139 @@
+"""Background generation, the on-disk asset cache and startup timings.
+
+Backgrounds are stored pre-scaled as raw pixels in a content-addressed
+cache directory (PINGPONG_CACHE_DIR, default ~/.cache/pingpong), keyed by
+the source image bytes or by the generator and size. Warm starts load the
+raw pixels straight into a display-format surface instead of decoding and
+scaling a JPEG or drawing a gradient line by line.
+
+Set PINGPONG_STARTUP_TIMINGS=1 to print how long each startup stage took
+and the time to first frame.
+"""
+import hashlib
+import os
+import time
+from contextlib import contextmanager
+
+import pygame
+
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+BLUE = (50, 50, 255)
+
+# Bump when a generator's output changes, so old cache entries are ignored
+CACHE_VERSION = 1
+CACHE_DIR = os.environ.get("PINGPONG_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pingpong"))
+
+# (stage, seconds) in the order they finished, and (milestone, seconds since start)
+timings = []
+milestones = []
+_started = time.perf_counter()
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((name, time.perf_counter() - start))
+
+
+def ticks():
+    """ Milliseconds since startup, like pygame.time.get_ticks() but without pygame.init(). """
+    return int((time.perf_counter() - _started) * 1000)
+
+
+def milestone(name):
+    """ Record how long after startup something happened, e.g. the first frame. """
+    milestones.append((name, time.perf_counter() - _started))
+
+
+def report(out=None):
+    """ Print per-stage startup timings if PINGPONG_STARTUP_TIMINGS is set. """
+    if os.environ.get("PINGPONG_STARTUP_TIMINGS", "0") == "0":
+        return
+    lines = [f"{name:<20}{seconds * 1000:8.1f} ms" for name, seconds in timings]
+    lines += [f"{name:<20}{seconds * 1000:8.1f} ms after start" for name, seconds in milestones]
+    lines.append(f"{'total':<20}{(time.perf_counter() - _started) * 1000:8.1f} ms")
+    print("\n".join(lines), file=out)
+
+
+def gradient(size):
+    """ Retro blue to purple gradient, built as one array instead of a line per row. """
+    import numpy as np
+
+    width, height = size
+    pixels = np.empty((width, height, 3), dtype=np.uint8)
+    pixels[:, :, 0] = 50
+    pixels[:, :, 1] = 50
+    pixels[:, :, 2] = 100 + 155 * np.arange(height) // height
+    return pygame.surfarray.make_surface(pixels)
+
+
+def court(size):
+    """ Classic game background: black court, blue border, dashed center line. """
+    width, height = size
+    surface = pygame.Surface(size)
+    surface.fill(BLACK)
+    pygame.draw.rect(surface, BLUE, (0, 0, width, height), 10)
+    for y in range(30, height, 40):
+        pygame.draw.rect(surface, WHITE, (width // 2 - 2, y, 4, 20))
+    return surface
+
+
+def _cache_file(key):
+    return os.path.join(CACHE_DIR, hashlib.sha256(key).hexdigest() + ".rgb")
+
+
+def _load_cached(path, size):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) != size[0] * size[1] * 3:
+        return None
+    return pygame.image.frombuffer(data, size, "RGB")
+
+
+def _store(path, surface):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(pygame.image.tobytes(surface, "RGB"))
+        os.replace(tmp, path)
+    except OSError:
+        pass  # the cache is only an optimization
+
+
+def _display_format(surface):
+    return surface.convert() if pygame.display.get_surface() is not None else surface
+
+
+def background(filename, size, fallback):
+    """ Image scaled to size, or fallback(size) if it is missing, via the cache. """
+    try:
+        with open(filename, "rb") as f:
+            key = f.read()
+    except OSError:
+        key = None
+
+    if key is not None:
+        key = b"image:%d:%dx%d:" % (CACHE_VERSION, size[0], size[1]) + key
+    else:
+        key = b"generated:%d:%s:%dx%d" % (CACHE_VERSION, fallback.__name__.encode(), size[0], size[1])
+    path = _cache_file(key)
+
+    surface = _load_cached(path, size)
+    if surface is None:
+        if key.startswith(b"image:"):
+            try:
+                surface = pygame.transform.scale(pygame.image.load(filename), size)
+            except pygame.error:
+                surface = fallback(size)
+        else:
+            surface = fallback(size)
+        _store(path, surface)
+    return _display_format(surface)
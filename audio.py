@@ -0,0 +1,102 @@
+"""Low-latency sound effects.
+
+Effects are decoded to PCM once and cached next to the backgrounds (see
+assets.CACHE_DIR), so warm starts skip the MP3 decoder. Gameplay effects
+play on a pool of reserved channels that the music stream and
+Sound.play() never pick, and every play is counted as played, stolen
+(an effect was cut off to make room) or dropped.
+
+PINGPONG_AUDIO_BUFFER sets the mixer buffer in samples (smaller is lower
+latency, too small crackles).
+"""
+import hashlib
+import os
+
+import pygame
+
+import assets
+
+FREQUENCY = 44100
+BUFFER = int(os.environ.get("PINGPONG_AUDIO_BUFFER", "512"))
+EFFECT_CHANNELS = 4
+
+
+class AudioManager:
+    def __init__(self, frequency=FREQUENCY, buffer=BUFFER, effect_channels=EFFECT_CHANNELS):
+        pygame.mixer.init(frequency=frequency, buffer=buffer)
+        self.frequency, self.format, self.channels = pygame.mixer.get_init()
+        self.buffer = buffer
+
+        # The first channels are reserved for effects; music has its own stream
+        pygame.mixer.set_num_channels(max(pygame.mixer.get_num_channels(), effect_channels))
+        pygame.mixer.set_reserved(effect_channels)
+        self.pool = [pygame.mixer.Channel(i) for i in range(effect_channels)]
+        self.next = 0
+
+        self.effects = {}
+        self.played = 0
+        self.stolen = 0
+        self.dropped = 0
+
+    @property
+    def latency_ms(self):
+        """ Output latency added by the mixer buffer. """
+        return 1000.0 * self.buffer / self.frequency
+
+    def load(self, name, path):
+        """ Decode path to PCM once (cached on disk) and register it as effect `name`. """
+        with open(path, "rb") as f:
+            key = b"pcm:%d:%d:%d:" % (self.frequency, self.format, self.channels) + f.read()
+        cache_file = os.path.join(assets.CACHE_DIR, hashlib.sha256(key).hexdigest() + ".pcm")
+        try:
+            with open(cache_file, "rb") as f:
+                sound = pygame.mixer.Sound(buffer=f.read())
+        except OSError:
+            sound = pygame.mixer.Sound(path)
+            try:
+                os.makedirs(assets.CACHE_DIR, exist_ok=True)
+                tmp = f"{cache_file}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(sound.get_raw())
+                os.replace(tmp, cache_file)
+            except OSError:
+                pass  # the cache is only an optimization
+        self.effects[name] = sound
+        return sound
+
+    def play(self, name):
+        sound = self.effects.get(name)
+        if sound is None:
+            self.dropped += 1
+            return None
+
+        # Prefer an idle channel, otherwise cut off the next one in rotation,
+        # which is the one that started longest ago
+        start = self.next
+        for offset in range(len(self.pool)):
+            i = (start + offset) % len(self.pool)
+            if not self.pool[i].get_busy():
+                break
+        else:
+            i = start
+            self.stolen += 1
+        self.next = (i + 1) % len(self.pool)
+
+        channel = self.pool[i]
+        channel.play(sound)
+        self.played += 1
+        return channel
+
+    def overlay_lines(self):
+        """ Effect counts and mixer latency, for the profiler overlay. """
+        return [f"sfx     {self.played} played  {self.stolen} stolen",
+                f"sfx     {self.latency_ms:.1f} ms  {self.dropped} dropped"]
+
+    def stats(self):
+        return {
+            "played": self.played,
+            "stolen": self.stolen,
+            "dropped": self.dropped,
+            "buffer": self.buffer,
+            "latency_ms": self.latency_ms,
+        }
@@ -0,0 +1,373 @@
+"""Vectorized batch simulator.
+
+Holds N matches as structure-of-arrays state and advances all of them with
+NumPy array operations. The rules and the counter-based random numbers are
+the same as engine.py, so a seeded batch plays exactly the same matches as
+engine.step() does one at a time.
+
+    python batch.py --matches 10000 --left HARD --right MODERATE
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+
+import engine
+
+NO_SCORE = 0
+LEFT_SCORED = 1
+RIGHT_SCORED = 2
+
+# Bots can rally (or get the ball wedged) forever, so bulk runs are capped
+MAX_TICKS = 100000
+
+_U64 = np.uint64
+
+# Per-match arrays, gathered and scattered when run() compacts finished matches
+_FIELDS = ("seeds", "left_y", "right_y", "left_score", "right_score", "ball_x", "ball_y",
+           "ball_size_arr", "ball_dx", "ball_dy", "ball_speed", "tick", "winner", "hits", "max_speed",
+           "ball_version", "left_target", "right_target", "left_plan", "right_plan")
+
+
+def mix64(x):
+    # splitmix64 finalizer, uint64 arithmetic wraps like the & MASK64 in engine
+    x = x + _U64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> _U64(30))) * _U64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> _U64(27))) * _U64(0x94D049BB133111EB)
+    return x ^ (x >> _U64(31))
+
+
+def fold(y, low, high):
+    span = high - low
+    m = (y - low) % (2 * span)
+    return np.where(span <= 0, low, low + np.where(m <= span, m, 2 * span - m))
+
+
+def uniform(seeds, ticks, stream):
+    counter = ticks.astype(np.uint64) * _U64(4) + _U64(stream)
+    return (mix64(seeds ^ mix64(counter)) >> _U64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+
+class BatchMatch:
+    """ N independent matches with shared court size and rules.
+
+    Every array operation mirrors a float operation of the scalar engine in
+    the same order, so results are bit-identical.
+    """
+
+    def __init__(self, seeds, width=engine.WIDTH, height=engine.HEIGHT, points_to_win=5,
+                 crazy=False, ball_size=engine.BALL_SIZE, left_ai=None, right_ai=None):
+        if {left_ai, right_ai} & (engine.POLICIES.keys() | {engine.GENIUS}):
+            raise ValueError("GENIUS and trained policies only run in engine.step")
+        self.seeds = np.asarray(seeds, dtype=np.uint64)
+        n = len(self.seeds)
+        self.n = n
+        self.width = width
+        self.height = height
+        self.points_to_win = points_to_win
+        self.crazy = crazy
+        self.ball_size = ball_size
+        self.left_ai = left_ai
+        self.right_ai = right_ai
+
+        self.left_x = 20
+        self.right_x = width - 35
+        self.left_y = np.full(n, height // 2 - 50, dtype=np.float64)
+        self.right_y = np.full(n, height // 2 - 50, dtype=np.float64)
+        self.left_score = np.zeros(n, dtype=np.int32)
+        self.right_score = np.zeros(n, dtype=np.int32)
+
+        self.ball_x = np.full(n, width // 2 - ball_size // 2, dtype=np.float64)
+        self.ball_y = np.full(n, height // 2 - ball_size // 2, dtype=np.float64)
+        self.ball_size_arr = np.full(n, ball_size, dtype=np.int64)
+        self.ball_dx = np.zeros(n, dtype=np.float64)
+        self.ball_dy = np.zeros(n, dtype=np.float64)
+        self.ball_speed = np.zeros(n, dtype=np.float64)
+
+        self.tick = np.zeros(n, dtype=np.int64)
+        self.winner = np.zeros(n, dtype=np.int8)
+        self.hits = np.zeros(n, dtype=np.int64)
+        self.max_speed = np.zeros(n, dtype=np.float64)
+
+        # Cached bot intercepts, solved again only when ball_version moves on
+        self.ball_version = np.zeros(n, dtype=np.int64)
+        self.left_plan = np.full(n, -1, dtype=np.int64)
+        self.right_plan = np.full(n, -1, dtype=np.int64)
+        self.left_target = np.full(n, np.nan)
+        self.right_target = np.full(n, np.nan)
+
+        self._serve(np.ones(n, dtype=bool))
+
+    @property
+    def done(self):
+        return self.winner != NO_SCORE
+
+    def _serve(self, mask):
+        if not mask.any():
+            return
+        idx = np.nonzero(mask)[0]
+        seeds, ticks = self.seeds[idx], self.tick[idx]
+        xdir = np.where(uniform(seeds, ticks, engine.SERVE_X_STREAM) < 0.5, -1.0, 1.0)
+        ydir = np.where(uniform(seeds, ticks, engine.SERVE_Y_STREAM) < 0.5, -1.0, 1.0)
+        size = self.ball_size_arr[idx]
+        self.ball_x[idx] = self.width // 2 - size // 2
+        self.ball_y[idx] = self.height // 2 - size // 2
+        self.ball_size_arr[idx] = self.ball_size
+        self.ball_dx[idx] = engine.BALL_SPEED * xdir
+        self.ball_dy[idx] = engine.BALL_SPEED * ydir
+        self.ball_speed[idx] = engine.BALL_SPEED
+        self.ball_version[idx] += 1
+
+    def _move(self, y, bits, active):
+        top_ok = y > 0
+        up = active & ((bits & engine.UP) != 0) & top_ok
+        y = np.where(up, y - engine.PADDLE_SPEED, y)
+        down = active & ((bits & engine.DOWN) != 0) & (y + engine.PADDLE_HEIGHT < self.height)
+        return np.where(down, y + engine.PADDLE_SPEED, y)
+
+    def _plan(self, x, side, active):
+        """ Refresh the cached intercepts of one side's paddle where they are stale. """
+        if side == engine.LEFT:
+            plan, target = self.left_plan, self.left_target
+        else:
+            plan, target = self.right_plan, self.right_target
+        stale = active & (plan != self.ball_version)
+        idx = np.nonzero(stale)[0]
+        if len(idx):
+            size = self.ball_size_arr[idx]
+            bx, by, dx, dy = self.ball_x[idx], self.ball_y[idx], self.ball_dx[idx], self.ball_dy[idx]
+            faces = np.where(x + engine.PADDLE_WIDTH / 2 > bx + size / 2, x, x + engine.PADDLE_WIDTH)
+            right_lead = (dx > 0) & (bx + size <= faces)
+            left_lead = ~right_lead & (dx < 0) & (bx >= faces)
+            lead = np.where(right_lead, bx + size, bx)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                top = by + dy / dx * (faces - lead)
+                solved = fold(top, 0, self.height - size) + size / 2
+            target[idx] = np.where(right_lead | left_lead, solved, np.nan)
+            plan[idx] = self.ball_version[idx]
+        return target
+
+    def _ai_move(self, y, x, difficulty, stream, side, active):
+        speed = engine.PADDLE_SPEED
+        centery = y + engine.PADDLE_HEIGHT / 2
+        ball_centery = self.ball_y + self.ball_size_arr / 2
+        if difficulty == engine.EASY:
+            active = active & (uniform(self.seeds, self.tick, stream) > 0.7)
+            target, step = ball_centery, speed * 0.7
+        elif difficulty == engine.MODERATE:
+            target, step = ball_centery, speed * 0.9
+        else:
+            target = self._plan(x, side, active)
+            if difficulty == engine.PERFECT:
+                aim = np.where(target < self.height / 2, -engine.PERFECT_AIM, engine.PERFECT_AIM)
+                target = np.where(np.isnan(target), self.height / 2, target + aim)
+                limit = speed * 1.2
+                step = np.maximum(-limit, np.minimum(target - centery, limit))
+                moved = np.maximum(0, np.minimum(y + step, self.height - engine.PADDLE_HEIGHT))
+                return np.where(active, moved, y)
+            target = np.where(np.isnan(target), self.height / 2, target)
+            target = np.maximum(50, np.minimum(target, self.height - 50))
+            step = speed * 1.1
+
+        up = active & (target < centery) & (y > 0)
+        down = active & ~up & (target > centery) & (y + engine.PADDLE_HEIGHT < self.height)
+        y = np.where(up, y - step, y)
+        return np.where(down, y + step, y)
+
+    def _collide(self, paddle_x, paddle_y, prev_x, prev_y, live, side):
+        size = self.ball_size_arr
+        x, y, dx = self.ball_x, self.ball_y, self.ball_dx
+        paddle_centerx = paddle_x + engine.PADDLE_WIDTH / 2
+        prev_centerx = x + size / 2 + (prev_x - x)
+        if side == engine.LEFT:
+            toward = live & (dx < 0) & (paddle_centerx < prev_centerx)
+            face = paddle_x + engine.PADDLE_WIDTH
+            lead, prev_lead = x, prev_x
+            crossed = (prev_lead >= face) & (face > lead)
+        else:
+            toward = live & (dx > 0) & (prev_centerx < paddle_centerx)
+            face = paddle_x
+            lead, prev_lead = x + size, prev_x + size
+            crossed = (prev_lead <= face) & (face < lead)
+
+        # t is only meaningful where the face was crossed
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = (prev_lead - face) / (prev_lead - lead)
+            swept_y = prev_y + (y - prev_y) * t
+        swept = (swept_y < paddle_y + engine.PADDLE_HEIGHT) & (paddle_y < swept_y + size)
+        overlaps = ((x < paddle_x + engine.PADDLE_WIDTH) & (paddle_x < x + size)
+                    & (y < paddle_y + engine.PADDLE_HEIGHT) & (paddle_y < y + size))
+        hit = toward & np.where(crossed, swept, overlaps)
+
+        idx = np.nonzero(hit)[0]
+        if len(idx):
+            if side == engine.LEFT:
+                self.ball_x[idx] = face
+            else:
+                self.ball_x[idx] = face - size[idx]
+            paddle_centery = paddle_y[idx] + engine.PADDLE_HEIGHT / 2
+            ball_centery = self.ball_y[idx] + size[idx] / 2
+            relative_intersect = (paddle_centery - ball_centery) / (engine.PADDLE_HEIGHT / 2)
+            bounce_angle = relative_intersect * (5 * 3.14159 / 12)
+            speed = np.minimum(self.ball_speed[idx] * 1.05, engine.MAX_BALL_SPEED)
+            # Hits are sparse, so use math.sin to stay bit-identical with the scalar engine
+            sines = np.array([math.sin(math.radians(a * 180 / 3.14159)) for a in bounce_angle])
+            self.ball_speed[idx] = speed
+            self.ball_dx[idx] = -self.ball_dx[idx]
+            self.ball_dy[idx] = -speed * sines
+            self.hits[idx] += 1
+            self.ball_version[idx] += 1
+            self.max_speed[idx] = np.maximum(self.max_speed[idx], speed)
+        return hit
+
+    def step(self, inputs=None):
+        """ Advance every unfinished match by one fixed tick.
+
+        inputs is an optional (n, 2) array of UP/DOWN bits for paddles that
+        are not bot-controlled. Returns (left_hit, right_hit, scored) arrays.
+        """
+        active = ~self.done
+        if inputs is None:
+            inputs = np.zeros((self.n, 2), dtype=np.uint8)
+
+        if self.left_ai is None:
+            self.left_y = self._move(self.left_y, inputs[:, 0], active)
+        else:
+            self.left_y = self._ai_move(self.left_y, self.left_x, self.left_ai, engine.LEFT_AI_STREAM,
+                                        engine.LEFT, active)
+        if self.right_ai is None:
+            self.right_y = self._move(self.right_y, inputs[:, 1], active)
+        else:
+            self.right_y = self._ai_move(self.right_y, self.right_x, self.right_ai, engine.RIGHT_AI_STREAM,
+                                         engine.RIGHT, active)
+
+        factor = engine.CRAZY_FACTOR if self.crazy else 1
+        steps = np.maximum(1, np.ceil(np.maximum(np.abs(self.ball_dx * factor),
+                                                 np.abs(self.ball_dy * factor)) / engine.MAX_SUBSTEP))
+        size = self.ball_size_arr
+        left_hit = np.zeros(self.n, dtype=bool)
+        right_hit = np.zeros(self.n, dtype=bool)
+        scored = np.zeros(self.n, dtype=np.int8)
+        live = active.copy()
+        for k in range(int(steps[active].max()) if active.any() else 0):
+            live &= k < steps
+            prev_x, prev_y = self.ball_x, self.ball_y
+            self.ball_x = np.where(live, prev_x + self.ball_dx * factor / steps, prev_x)
+            self.ball_y = np.where(live, prev_y + self.ball_dy * factor / steps, prev_y)
+
+            top = live & (self.ball_y <= 0)
+            bottom = live & ~top & (self.ball_y + size >= self.height)
+            self.ball_y = np.where(top, -self.ball_y,
+                                   np.where(bottom, 2 * (self.height - size) - self.ball_y, self.ball_y))
+            self.ball_dy = np.where(top, np.abs(self.ball_dy),
+                                    np.where(bottom, -np.abs(self.ball_dy), self.ball_dy))
+
+            right_out = live & (self.ball_x <= 0)
+            left_out = live & ~right_out & (self.ball_x + size >= self.width)
+
+            hit_l = self._collide(self.left_x, self.left_y, prev_x, prev_y, live, engine.LEFT)
+            hit_r = self._collide(self.right_x, self.right_y, prev_x, prev_y, live & ~hit_l, engine.RIGHT)
+            left_hit |= hit_l
+            right_hit |= hit_r
+
+            missed = ~(hit_l | hit_r)
+            left_scored = left_out & missed
+            right_scored = right_out & missed
+            scored[left_scored] = LEFT_SCORED
+            scored[right_scored] = RIGHT_SCORED
+            live &= ~(left_scored | right_scored)
+
+        self.left_score += scored == LEFT_SCORED
+        self.right_score += scored == RIGHT_SCORED
+        self._serve(scored != NO_SCORE)
+        self.winner[(scored == LEFT_SCORED) & (self.left_score >= self.points_to_win)] = LEFT_SCORED
+        self.winner[(scored == RIGHT_SCORED) & (self.right_score >= self.points_to_win)] = RIGHT_SCORED
+
+        self.tick += active
+        return left_hit, right_hit, scored
+
+    def subset(self, rows):
+        """ Copy of the given matches as a smaller batch. """
+        sub = object.__new__(BatchMatch)
+        sub.__dict__.update(self.__dict__)
+        for name in _FIELDS:
+            setattr(sub, name, getattr(self, name)[rows])
+        sub.n = len(rows)
+        return sub
+
+    def merge(self, rows, sub):
+        for name in _FIELDS:
+            getattr(self, name)[rows] = getattr(sub, name)
+
+    def run(self, max_ticks=None):
+        """ Step until every match is finished (or has played max_ticks frames).
+
+        Once most matches are over the unfinished ones are compacted into a
+        smaller batch, so long rallies don't keep paying for finished rows.
+        """
+        while True:
+            active = ~self.done
+            if max_ticks is not None:
+                active &= self.tick < max_ticks
+            count = int(active.sum())
+            if count == 0:
+                return self
+            if count < self.n // 2:
+                rows = np.nonzero(active)[0]
+                self.merge(rows, self.subset(rows).run(max_ticks))
+                return self
+            self.step()
+
+
+def verify(n=64, seed=0, max_ticks=MAX_TICKS, **kwargs):
+    """ Play n seeded matches both ways and return the indices that differ. """
+    seeds = [engine.mix64(seed + i) for i in range(n)]
+    batch = BatchMatch(seeds, **kwargs).run(max_ticks)
+    mismatched = []
+    for i, s in enumerate(seeds):
+        match = engine.run(engine.Match(seed=s, **kwargs), max_ticks)
+        if (match.tick != batch.tick[i] or match.left.score != batch.left_score[i]
+                or match.right.score != batch.right_score[i]):
+            mismatched.append(i)
+    return mismatched
+
+
+DIFFICULTIES = {"EASY": engine.EASY, "MODERATE": engine.MODERATE, "HARD": engine.HARD,
+                "PERFECT": engine.PERFECT}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk bot-vs-bot statistics")
+    parser.add_argument("--matches", type=int, default=10000)
+    parser.add_argument("--left", choices=DIFFICULTIES, default="HARD")
+    parser.add_argument("--right", choices=DIFFICULTIES, default="MODERATE")
+    parser.add_argument("--points", type=int, default=5)
+    parser.add_argument("--crazy", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-frames", type=int, default=MAX_TICKS)
+    parser.add_argument("--verify", type=int, default=0, metavar="N",
+                        help="also replay N matches through engine.step and compare")
+    args = parser.parse_args()
+
+    kwargs = dict(points_to_win=args.points, crazy=args.crazy,
+                  left_ai=DIFFICULTIES[args.left], right_ai=DIFFICULTIES[args.right])
+    seeds = [engine.mix64(args.seed + i) for i in range(args.matches)]
+    start = time.perf_counter()
+    batch = BatchMatch(seeds, **kwargs).run(args.max_frames)
+    elapsed = time.perf_counter() - start
+
+    frames = int(batch.tick.sum())
+    print(f"{args.matches} matches, {frames} frames in {elapsed:.2f}s ({frames / elapsed:,.0f} frames/s)")
+    print(f"{args.left} (left) wins: {np.mean(batch.winner == LEFT_SCORED):.1%}")
+    print(f"{args.right} (right) wins: {np.mean(batch.winner == RIGHT_SCORED):.1%}")
+    print(f"unfinished after {args.max_frames} frames: {np.mean(batch.winner == NO_SCORE):.1%}")
+    print(f"average match length: {batch.tick.mean():.0f} frames, paddle hits: {batch.hits.mean():.1f}")
+
+    if args.verify:
+        mismatched = verify(args.verify, args.seed, args.max_frames, **kwargs)
+        print(f"scalar check: {args.verify - len(mismatched)}/{args.verify} identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+"""Micro and macro benchmarks with a baseline comparison.
+
+Micro benchmarks time the engine hot paths (ball movement, the swept
+paddle collision, each bot tier, a GENIUS search), the frontends' text
+and button drawing, and a 500-ball multi-ball tick. Macro benchmarks time whole
+MENU, PLAYING and GAME_OVER frames of project.py (800x600) and DJONG
+ULTIMATE.py (1200x800, also with crazy mode, the largest ball and 500
+balls), and 10k live particles. Everything runs on SDL's dummy video and
+audio drivers, so it works headless and in CI.
+
+    python bench.py run --out baseline.json
+    python bench.py run --out current.json --baseline baseline.json
+    python bench.py compare baseline.json current.json --threshold 0.1
+
+Each frontend opens its own display, so each one is benchmarked in a
+child process. Comparisons use the best round of each benchmark, which is
+the least noisy, and exit with status 1 if anything got slower than the
+threshold.
+
+The allocation guard checks that the steady-state MENU, PLAYING and
+GAME_OVER frames have bounded retained allocations. Frames still allocate
+temporaries (a few KB at their peak), so it runs them under tracemalloc
+and exits with status 1 if a frame allocates more than --max-bytes (99th
+percentile of the memory a frame holds at its peak) or keeps more than
+--max-kept new memory blocks a frame on average, counted after a full
+collection so garbage waiting for the GC isn't mistaken for a leak:
+
+    python bench.py allocs --frames 600
+"""
+import argparse
+import array
+import gc
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+os.environ.setdefault("PINGPONG_HISTORY", "0")  # benchmarks play matches nobody should see in the stats
+
+import engine
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FRONTENDS = ("project.py", "DJONG ULTIMATE.py")
+ROUNDS = 5
+ROUND_TIME = 0.2  # seconds per round, --quick uses a quarter of it
+
+# Allocation guard: frame loops it checks, and its default limits
+ALLOC_STATES = ("menu_frame", "playing_frame", "playing_frame_crazy", "game_over_frame_won",
+                "game_over_frame_lost")
+ALLOC_FRAMES = 600
+ALLOC_WARMUP = 3000  # frames for caches (ours, NumPy's, pygame's) to fill up first
+MAX_FRAME_BYTES = 8192
+# A leak of one object a frame is 1.0. Garbage is collected before both
+# snapshots, and what is left (cached score texts, pygame's own bookkeeping)
+# measures 0.01-0.25 over 300-600 frames, so 0.5 leaves twice the worst
+MAX_KEPT_BLOCKS = 0.5
+
+
+def measure(fn, rounds=ROUNDS, round_time=ROUND_TIME):
+    """ Time fn() like timeit.autorange: grow the loop until a round takes round_time. """
+    fn()  # warm caches and lazy builds
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= round_time / 4 or number >= 1 << 24:
+            break
+        number *= 4
+    number = max(1, int(number * round_time / max(elapsed, 1e-9)))
+
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    times.sort()
+    return {"best_us": times[0] * 1e6, "median_us": times[len(times) // 2] * 1e6,
+            "number": number, "rounds": rounds}
+
+
+def engine_benchmarks():
+    """ {name: fn} for the pygame-free hot paths. """
+    benches = {}
+
+    match = engine.Match(seed=1)
+    ball = match.ball
+
+    def ball_move():
+        result, wall = ball.move(match.width, match.height)
+        if result is not None:
+            match.serve()
+    benches["engine/ball_move"] = ball_move
+
+    paddle = match.left
+
+    def ball_collide():
+        # A sub-step that crosses the left paddle's face, so the full swept test runs
+        ball.x, ball.y, ball.dx = paddle.right - 2, paddle.centery, -ball.speed
+        ball.collide(paddle, paddle.right + 3, paddle.centery)
+    benches["engine/ball_collide"] = ball_collide
+
+    for name, difficulty in (("easy", engine.EASY), ("moderate", engine.MODERATE),
+                             ("hard", engine.HARD), ("perfect", engine.PERFECT)):
+        bot = engine.Match(seed=2)
+
+        def ai_move(bot=bot, difficulty=difficulty):
+            bot.right.ai_move(bot.ball, difficulty, bot.height, 0.9)
+            bot.right.y = bot.height / 2 - bot.right.height / 2
+        benches[f"engine/ai_move_{name}"] = ai_move
+
+    solver = engine.Match(seed=3)
+
+    def plan():
+        # A new trajectory every call, so the intercept is solved, not looked up
+        solver.ball.version += 1
+        solver.right.plan(solver.ball, solver.height)
+    benches["engine/plan_solve"] = plan
+
+    import lookahead
+    thinker = engine.Match(seed=6)
+    thinker.ball.dx = abs(thinker.ball.dx)  # coming at the right paddle, so the full search runs
+    snapshot = lookahead.Snapshot.of(thinker, thinker.right)
+    benches["engine/genius_decide"] = lambda: lookahead.decide(snapshot, time.perf_counter() + lookahead.BUDGET)
+
+    ticking = engine.Match(seed=4, points_to_win=10 ** 9, left_ai=engine.HARD, right_ai=engine.HARD)
+    benches["engine/step"] = lambda: engine.step(ticking)
+
+    import multiball
+    width, height = multiball.COURT
+    party = multiball.MultiBallMatch(width, height, points_to_win=10 ** 9, seed=5, left_ai=engine.HARD,
+                                     right_ai=engine.HARD, balls=500)
+    benches["engine/multiball_step_500"] = lambda: multiball.step(party)
+    return benches
+
+
+def load_frontend(filename):
+    path = os.path.join(HERE, filename)
+    name = os.path.splitext(filename)[0].lower().replace(" ", "_")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    cwd = os.getcwd()
+    os.chdir(HERE)  # the frontends load their assets by relative path
+    try:
+        spec.loader.exec_module(module)
+        module.wait_for_assets()
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+def frontend_benchmarks(game):
+    """ {name: fn} for one frontend module, prefixed with its resolution. """
+    import pygame
+
+    import dirty
+    import particles
+
+    prefix = f"{game.WIDTH}x{game.HEIGHT}"
+    benches = {}
+
+    benches[f"{prefix}/draw_text"] = lambda: game.draw_text("10", game.big_font, game.GREEN, 200, 50)
+    benches[f"{prefix}/draw_button"] = lambda: game.draw_button(
+        "START", game.big_font, game.GREEN, game.WIDTH // 2 - 100, 400, 200, 80, game.YELLOW, "start")
+
+    def menu():
+        game.game_state = game.MENU
+        game.game_menu()
+        pygame.display.flip()
+    benches[f"{prefix}/menu_frame"] = menu
+
+    def game_over(player_won):
+        game.game_state = game.GAME_OVER
+        game.game_over_screen(player_won)
+        pygame.display.flip()
+    benches[f"{prefix}/game_over_frame_won"] = lambda: game_over(True)
+    benches[f"{prefix}/game_over_frame_lost"] = lambda: game_over(False)
+
+    # The PLAYING background is the court in project.py and pl-img in DJONG
+    background = getattr(game, "court_img", None) or game.pl_img
+    state = {}
+
+    def playing(dirty_rects=True, crazy=False, ball_size=engine.BALL_SIZE, balls=1):
+        def setup():
+            game.points_to_win = 10 ** 9  # never leave PLAYING mid-benchmark
+            game.DIRTY_RECTS = dirty_rects
+            if hasattr(game, "crazy_mode"):
+                game.game_mode = game.SINGLE_PLAYER
+                game.crazy_mode, game.bs = crazy, ball_size
+            if hasattr(game, "BALLS"):
+                game.BALLS = balls
+            state["match"] = game.new_match()
+            state["stepper"] = engine.FixedStep()
+            state["renderer"] = dirty.DirtyRenderer(game.screen, background)
+            state["current"] = frame
+
+        def frame():
+            if state.get("current") is not frame:
+                setup()
+            game.game_state = game.PLAYING
+            if game.play_frame(state["match"], state["stepper"], state["renderer"], engine.DT):
+                state["renderer"].present()
+            else:
+                state["renderer"].flip()
+        # Pixels pushed per frame, averaged over the frames measure() ran
+        frame.pixels = lambda: state["renderer"].stats()["average_pixels"]
+        return frame
+
+    swarm = particles.Particles(seed=1)
+
+    def particles_10k():
+        # Update and draw a pool held at 10k live particles
+        while swarm.count < 10000:
+            swarm.emit(500, swarm.rng.uniform(0, game.WIDTH), swarm.rng.uniform(0, game.HEIGHT / 2),
+                       300, 1.5, game.YELLOW, gravity=300)
+        swarm.update(engine.DT)
+        swarm.draw(game.screen)
+    benches[f"{prefix}/particles_10k"] = particles_10k
+
+    benches[f"{prefix}/playing_frame"] = playing()
+    benches[f"{prefix}/playing_frame_full_redraw"] = playing(dirty_rects=False)
+    if hasattr(game, "crazy_mode"):
+        benches[f"{prefix}/playing_frame_crazy"] = playing(crazy=True)
+        benches[f"{prefix}/playing_frame_ball_50"] = playing(ball_size=50)
+        benches[f"{prefix}/playing_frame_crazy_ball_50"] = playing(crazy=True, ball_size=50)
+    if hasattr(game, "BALLS"):
+        benches[f"{prefix}/playing_frame_balls_500"] = playing(balls=500)
+    return benches
+
+
+def measure_allocations(fn, frames=ALLOC_FRAMES, warmup=ALLOC_WARMUP):
+    """ Steady-state allocations of a frame loop: per-frame peaks, memory kept and GC runs. """
+    from controls import controls
+
+    def frame():
+        controls.poll()  # the main loop reads input every frame too
+        fn()
+
+    collections = []
+
+    def collected(phase, info):
+        if phase == "stop":
+            collections.append(info["generation"])
+
+    # Preallocated and unboxed, so recording a peak isn't itself counted as kept
+    peaks = array.array("q", bytes(8 * frames))
+    # Traced from the start of the warm-up, so a cache swapping an old entry
+    # for a new one doesn't count as keeping memory
+    tracemalloc.start()
+    try:
+        for _ in range(warmup):
+            frame()
+        start = _traced()
+        gc.callbacks.append(collected)
+        for i in range(frames):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            frame()
+            peaks[i] = tracemalloc.get_traced_memory()[1] - before
+        gc.callbacks.remove(collected)
+        end = _traced()
+    finally:
+        tracemalloc.stop()
+        if collected in gc.callbacks:
+            gc.callbacks.remove(collected)
+    peaks = sorted(peaks)
+    return {"frames": frames, "p50_bytes": peaks[frames // 2], "p99_bytes": peaks[min(frames - 1, frames * 99 // 100)],
+            "kept_bytes_per_frame": (end[1] - start[1]) / frames,
+            "kept_blocks_per_frame": (end[0] - start[0]) / frames,
+            "collections": len(collections)}
+
+
+def _traced():
+    """ (blocks, bytes) tracemalloc holds, after collecting garbage that only waits for the GC. """
+    gc.collect()
+    traces = tracemalloc.take_snapshot().traces
+    return len(traces), sum(trace.size for trace in traces)
+
+
+def run_frontend(filename, out, round_time, filter_text=None, frames=None):
+    """ Benchmark one frontend, or with frames set, run the allocation guard on it. """
+    game = load_frontend(filename)
+    benches = frontend_benchmarks(game)
+    if frames:
+        results = {name: measure_allocations(fn, frames) for name, fn in benches.items()
+                   if name.split("/")[1] in ALLOC_STATES and (not filter_text or filter_text in name)}
+    else:
+        results = {}
+        for name, fn in benches.items():
+            if not filter_text or filter_text in name:
+                results[name] = measure(fn, round_time=round_time)
+                if hasattr(fn, "pixels"):
+                    results[name]["pixels_per_frame"] = fn.pixels()
+    with open(out, "w") as f:
+        json.dump(results, f)
+
+
+def run_children(filter_text=None, extra=()):
+    """ {name: result} from run_frontend in a child process per frontend. """
+    results = {}
+    for filename in FRONTENDS:
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "results.json")
+            command = [sys.executable, os.path.abspath(__file__), "frontend", filename, out, *extra]
+            if filter_text:
+                command += ["--filter", filter_text]
+            subprocess.run(command, check=True)
+            with open(out) as f:
+                results.update(json.load(f))
+    return results
+
+
+def run_all(round_time, filter_text=None):
+    results = {}
+    for name, fn in engine_benchmarks().items():
+        if not filter_text or filter_text in name:
+            results[name] = measure(fn, round_time=round_time)
+            print(f"{name:<44}{results[name]['best_us']:12.3f} us")
+
+    for name, result in run_children(filter_text, ["--round-time", str(round_time)]).items():
+        results[name] = result
+        pixels = f"{result['pixels_per_frame']:12,.0f} px/frame" if "pixels_per_frame" in result else ""
+        print(f"{name:<44}{result['best_us']:12.3f} us{pixels}")
+    return results
+
+
+def check_allocations(frames, max_bytes, max_kept, filter_text=None):
+    """ Run the allocation guard; returns the names over either limit. """
+    failed = []
+    print(f"{'frame loop':<36}{'p50 B':>8}{'p99 B':>8}{'kept B/f':>10}{'blocks/f':>10}{'gc runs':>9}")
+    for name, result in run_children(filter_text, ["--frames", str(frames)]).items():
+        over = result["p99_bytes"] > max_bytes or result["kept_blocks_per_frame"] > max_kept
+        if over:
+            failed.append(name)
+        print(f"{name:<36}{result['p50_bytes']:8d}{result['p99_bytes']:8d}{result['kept_bytes_per_frame']:10.1f}"
+              f"{result['kept_blocks_per_frame']:10.3f}{result['collections']:9d}{'  OVER' if over else ''}")
+    print(f"limits: {max_bytes} B per frame (p99), {max_kept} blocks kept per frame")
+    return failed
+
+
+def metadata():
+    import numpy
+    import pygame
+    return {"python": platform.python_version(), "pygame": pygame.version.ver,
+            "numpy": numpy.__version__, "platform": platform.platform(),
+            "machine": platform.machine(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(baseline, current, threshold):
+    """ Print a table of changes; returns the names that regressed by more than threshold. """
+    regressions = []
+    print(f"{'benchmark':<44}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name in sorted(set(baseline) | set(current)):
+        if name not in baseline or name not in current:
+            print(f"{name:<44}{'only in ' + ('current' if name in current else 'baseline'):>33}")
+            continue
+        before, after = baseline[name]["best_us"], current[name]["best_us"]
+        change = after / before - 1 if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<44}{before:10.3f}us{after:10.3f}us{change:+9.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ping Pong benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks")
+    run.add_argument("--out", help="save results as JSON")
+    run.add_argument("--baseline", help="compare against a saved run")
+    run.add_argument("--threshold", type=float, default=0.1, help="allowed slowdown (0.1 = 10%%)")
+    run.add_argument("--filter", help="only benchmarks whose name contains this")
+    run.add_argument("--quick", action="store_true", help="shorter rounds, noisier numbers")
+
+    diff = commands.add_parser("compare", help="compare two saved runs")
+    diff.add_argument("baseline")
+    diff.add_argument("current")
+    diff.add_argument("--threshold", type=float, default=0.1)
+
+    allocs = commands.add_parser("allocs", help="fail if steady-state frames allocate too much")
+    allocs.add_argument("--frames", type=int, default=ALLOC_FRAMES)
+    allocs.add_argument("--max-bytes", type=int, default=MAX_FRAME_BYTES, help="per frame, 99th percentile")
+    allocs.add_argument("--max-kept", type=float, default=MAX_KEPT_BLOCKS, help="new memory blocks kept per frame")
+    allocs.add_argument("--filter", help="only frame loops whose name contains this")
+
+    child = commands.add_parser("frontend", help=argparse.SUPPRESS)
+    child.add_argument("filename")
+    child.add_argument("out")
+    child.add_argument("--round-time", type=float, default=ROUND_TIME)
+    child.add_argument("--filter")
+    child.add_argument("--frames", type=int, help="run the allocation guard instead")
+
+    args = parser.parse_args()
+
+    if args.command == "frontend":
+        run_frontend(args.filename, args.out, args.round_time, args.filter, args.frames)
+        return
+
+    if args.command == "allocs":
+        sys.exit(1 if check_allocations(args.frames, args.max_bytes, args.max_kept, args.filter) else 0)
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        with open(args.current) as f:
+            current = json.load(f)["results"]
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+    results = run_all(ROUND_TIME / 4 if args.quick else ROUND_TIME, args.filter)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"meta": metadata(), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print()
+        sys.exit(1 if compare(baseline, results, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Event-driven input, read once per frame.
+
+poll() at the top of the frame drains the pygame event queue into a
+Snapshot stamped with the time it was read: the keys held, the keys and
+mouse clicks that went down since the last frame, and the mouse position.
+The rest of the frame reads only that snapshot, so the input can't change
+halfway through a frame, and buttons fire once on the click instead of on
+every frame the mouse button is held.
+
+It also measures input latency: the time from the snapshot that first
+saw a key change to the flip of the first frame whose physics used it
+(play_frame calls applied(), the loop calls presented() after the flip).
+The time the event sat in the queue before poll() isn't visible to
+pygame, so this is up to one frame short of the full key-to-photon delay.
+"""
+import time
+from collections import deque
+
+import pygame
+
+import engine
+from profiler import percentile, profiler
+
+WINDOW = 900  # latency samples kept for percentiles
+STALE = 0.25  # a key change no tick has used after this long wasn't gameplay input
+NOTHING = frozenset()
+
+
+class Snapshot:
+    """ Input for one frame. """
+
+    def __init__(self, time, held=frozenset(), pressed=frozenset(), mouse=(0, 0), clicks=(), events=(),
+                 quit=False):
+        self.time = time
+        self.held = held
+        self.pressed = pressed
+        self.mouse = mouse
+        self.clicks = clicks
+        self.events = events
+        self.quit = quit
+
+    def bits(self, up_key, down_key):
+        """ Engine input bits from two held keys. """
+        return (engine.UP if up_key in self.held else 0) | (engine.DOWN if down_key in self.held else 0)
+
+    def clicked(self, rect):
+        """ True if a left click landed in rect this frame. """
+        x, y, width, height = rect
+        return any(x < cx < x + width and y < cy < y + height for cx, cy in self.clicks)
+
+    def hovering(self, rect):
+        x, y, width, height = rect
+        return x < self.mouse[0] < x + width and y < self.mouse[1] < y + height
+
+
+class Controls:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.held = set()
+        self.mouse = (0, 0)
+        self.snapshot = Snapshot(clock())
+        self.latencies = deque(maxlen=WINDOW)
+        self._changed = None  # snapshot time of the oldest key change no tick has used yet
+        self._applied = None  # ... that a tick used this frame, waiting for the flip
+
+    def poll(self):
+        now = self.clock()
+        pressed = set()
+        clicks = []
+        quit = False
+        keys_changed = False
+        events = pygame.event.get()
+        for event in events:
+            if event.type == pygame.KEYDOWN:
+                self.held.add(event.key)
+                pressed.add(event.key)
+                keys_changed = True
+            elif event.type == pygame.KEYUP:
+                self.held.discard(event.key)
+                keys_changed = True
+            elif event.type == pygame.MOUSEMOTION:
+                self.mouse = event.pos
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                self.mouse = event.pos
+                clicks.append(event.pos)
+            elif event.type == pygame.WINDOWFOCUSLOST:
+                # Keys released in another window never send a KEYUP here
+                self.held.clear()
+                keys_changed = True
+            elif event.type == pygame.QUIT:
+                quit = True
+
+        if self._changed is not None and now - self._changed > STALE:
+            self._changed = None
+        if self._changed is None and keys_changed:
+            self._changed = now
+        # Most frames change nothing, so they share last frame's key sets
+        held = frozenset(self.held) if keys_changed else self.snapshot.held
+        self.snapshot = Snapshot(now, held, frozenset(pressed) if pressed else NOTHING, self.mouse, clicks, events,
+                                 quit)
+        return self.snapshot
+
+    def applied(self):
+        """ A physics tick used this frame's input. """
+        if self._changed is not None:
+            self._applied = self._changed
+            self._changed = None
+
+    def presented(self):
+        """ The frame is on screen; record the latency of any input it applied. """
+        if self._applied is not None:
+            latency = self.clock() - self._applied
+            self._applied = None
+            self.latencies.append(latency)
+            profiler.sample("input", latency)
+
+    def stats(self):
+        values = list(self.latencies)
+        return {
+            "samples": len(values),
+            "latency_p50_ms": percentile(values, 50) * 1000,
+            "latency_p95_ms": percentile(values, 95) * 1000,
+            "latency_p99_ms": percentile(values, 99) * 1000,
+            "latency_max_ms": max(values, default=0.0) * 1000,
+        }
+
+
+controls = Controls()
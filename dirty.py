@@ -0,0 +1,99 @@
+"""Dirty-rectangle rendering for the PLAYING screen.
+
+Only the ball, the paddles and the scores change between frames, so
+instead of blitting the whole court and flipping the display every frame
+the renderer restores last frame's sprite bounds from the background,
+lets the caller draw, and pushes just the old and new bounds with
+display.update(rects).
+
+Past MAX_RECTS rects (a multi-ball party) merging and pushing them one by
+one costs more than redrawing the background and flipping the whole
+frame, so that's what it does instead.
+"""
+import pygame
+
+MAX_RECTS = 64
+
+
+def merge(rects):
+    """ Union overlapping rects so no pixel is pushed twice. """
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        i = 0
+        while i < len(merged):
+            if merged[i].colliderect(rect):
+                rect.union_ip(merged.pop(i))
+                i = 0
+            else:
+                i += 1
+        merged.append(rect)
+    return merged
+
+
+class DirtyRenderer:
+    def __init__(self, screen, background):
+        self.screen = screen
+        self.background = background
+        self.previous = []
+        self.current = []
+        self.full = True
+        # Pixels pushed to the display in the last frame, and in total
+        self.pixels = 0
+        self.total_pixels = 0
+        self.frames = 0
+
+    def invalidate(self):
+        """ Redraw and push the whole screen on the next frame. """
+        self.full = True
+
+    def restore(self):
+        if self.full or len(self.previous) > MAX_RECTS:
+            self.screen.blit(self.background, (0, 0))
+        else:
+            for rect in self.previous:
+                self.screen.blit(self.background, rect, rect)
+
+    def mark(self, rect):
+        # Sprites hand over a fresh Rect; only tuples need converting
+        self.current.append(rect if isinstance(rect, pygame.Rect) else pygame.Rect(rect))
+
+    def flip(self):
+        """ Push the whole screen, for frames drawn without the renderer (menus, game over). """
+        pygame.display.flip()
+        self._count(self.screen.get_width() * self.screen.get_height())
+        self.previous.clear()
+        self.current.clear()
+        self.full = True  # the next dirty frame starts from a clean background
+
+    def _count(self, pixels):
+        self.pixels = pixels
+        self.total_pixels += pixels
+        self.frames += 1
+
+    def present(self):
+        if self.full or len(self.previous) + len(self.current) > MAX_RECTS:
+            pygame.display.flip()
+            self._count(self.screen.get_width() * self.screen.get_height())
+            self.full = False
+        else:
+            rects = merge(self.previous + self.current)
+            pygame.display.update(rects)
+            self._count(sum(rect.width * rect.height for rect in rects))
+        # Reuse both lists rather than allocating a new one every frame
+        self.previous, self.current = self.current, self.previous
+        self.current.clear()
+
+    def overlay_line(self):
+        """ The last frame's pushed pixels, for the profiler overlay. """
+        area = self.screen.get_width() * self.screen.get_height()
+        return f"pixels  {self.pixels / 1000:7.1f}k {self.pixels / area:6.1%}"
+
+    def stats(self):
+        area = self.screen.get_width() * self.screen.get_height()
+        average = self.total_pixels / self.frames if self.frames else 0
+        return {
+            "pixels": self.pixels,
+            "average_pixels": average,
+            "average_fraction": average / area,
+        }
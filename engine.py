@@ -0,0 +1,439 @@
+"""Headless Ping Pong rules.
+
+Pure game logic with no display or mixer dependency. Both frontends
+(project.py and DJONG ULTIMATE.py) drive a Match through step() and only
+draw the result, so matches can also be simulated without a window.
+"""
+import math
+import random
+
+# Default court
+WIDTH, HEIGHT = 800, 600
+
+PADDLE_WIDTH, PADDLE_HEIGHT = 15, 100
+PADDLE_SPEED = 5
+BALL_SIZE = 20
+BALL_SPEED = 5
+MAX_BALL_SPEED = 12
+CRAZY_FACTOR = 1.5
+PERFECT_AIM = 35  # how far off-centre PERFECT takes the ball, to angle it away
+
+# Difficulty levels
+EASY = 0
+MODERATE = 1
+HARD = 2
+PERFECT = 3
+GENIUS = 4  # the planning bot, installed by lookahead.install()
+
+# Trained bots registered with register_policy() get difficulties after GENIUS
+POLICIES = {}
+
+# Input bits, one byte per paddle per frame
+UP = 1
+DOWN = 2
+
+# Sides
+LEFT = "left"
+RIGHT = "right"
+
+# Event kinds returned by step()
+HIT = "hit"
+WALL = "wall"
+SCORE = "score"
+GAME_OVER = "game_over"
+
+# Random streams, so every draw is addressed by (seed, tick, stream)
+LEFT_AI_STREAM = 0
+RIGHT_AI_STREAM = 1
+SERVE_X_STREAM = 2
+SERVE_Y_STREAM = 3
+
+# Physics runs at a fixed rate, independent of how often frames are drawn
+TICK_RATE = 90
+DT = 1.0 / TICK_RATE
+# Longest frame the accumulator will catch up on, so a stall can't spiral
+MAX_FRAME_TIME = 0.25
+# The ball never moves further than this in one sub-step
+MAX_SUBSTEP = PADDLE_WIDTH / 2
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(x):
+    # splitmix64 finalizer
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def uniform(seed, tick, stream):
+    """ Counter-based random number in [0, 1) for a given seed, tick and stream. """
+    return (mix64(seed ^ mix64(tick * 4 + stream)) >> 11) * (1.0 / (1 << 53))
+
+
+def fold(y, low, high):
+    """ Reflect y back into [low, high] the way the walls would bounce it. """
+    span = high - low
+    if span <= 0:
+        return low
+    m = (y - low) % (2 * span)
+    return low + (m if m <= span else 2 * span - m)
+
+
+def intercept_y(ball, x, height):
+    """ Ball center y when its leading edge reaches x, folding in wall bounces.
+
+    Returns None if the ball is moving away from x. The ratio dy/dx is all
+    that matters, so ball speed and crazy mode don't enter into it.
+    """
+    if ball.dx > 0 and ball.right <= x:
+        lead = ball.right
+    elif ball.dx < 0 and ball.left >= x:
+        lead = ball.left
+    else:
+        return None
+    top = ball.y + ball.dy / ball.dx * (x - lead)
+    return fold(top, 0, height - ball.height) + ball.height / 2
+
+
+class Body:
+    """ Axis-aligned box with float position and the position of the previous tick. """
+
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.prev_x = x
+        self.prev_y = y
+        self.width = width
+        self.height = height
+
+    @property
+    def top(self):
+        return self.y
+
+    @property
+    def bottom(self):
+        return self.y + self.height
+
+    @property
+    def left(self):
+        return self.x
+
+    @property
+    def right(self):
+        return self.x + self.width
+
+    @property
+    def centerx(self):
+        return self.x + self.width / 2
+
+    @property
+    def centery(self):
+        return self.y + self.height / 2
+
+    def remember(self):
+        self.prev_x = self.x
+        self.prev_y = self.y
+
+    def at(self, alpha):
+        """ Position interpolated between the previous and the current tick. """
+        return (self.prev_x + (self.x - self.prev_x) * alpha,
+                self.prev_y + (self.y - self.prev_y) * alpha)
+
+    def overlaps(self, other):
+        return (self.x < other.right and other.x < self.right
+                and self.y < other.bottom and other.y < self.bottom)
+
+
+class Paddle(Body):
+    def __init__(self, x, y):
+        super().__init__(x, y, PADDLE_WIDTH, PADDLE_HEIGHT)
+        self.speed = PADDLE_SPEED
+        self.score = 0
+        self.target = None
+        self.plan_version = -1
+
+    def move(self, bits, height):
+        if bits & UP and self.top > 0:
+            self.y -= self.speed
+        if bits & DOWN and self.bottom < height:
+            self.y += self.speed
+
+    def ai_move(self, ball, difficulty, height, roll=0.0):
+        if difficulty == EASY:
+            if roll > 0.7:
+                if ball.centery < self.centery and self.top > 0:
+                    self.y -= self.speed * 0.7
+                elif ball.centery > self.centery and self.bottom < height:
+                    self.y += self.speed * 0.7
+        elif difficulty == MODERATE:
+            if ball.centery < self.centery and self.top > 0:
+                self.y -= self.speed * 0.9
+            elif ball.centery > self.centery and self.bottom < height:
+                self.y += self.speed * 0.9
+        elif difficulty == HARD:
+            predicted_y = self.plan(ball, height)
+            if predicted_y is None:
+                predicted_y = height / 2
+            predicted_y = max(50, min(predicted_y, height - 50))
+
+            if predicted_y < self.centery and self.top > 0:
+                self.y -= self.speed * 1.1
+            elif predicted_y > self.centery and self.bottom < height:
+                self.y += self.speed * 1.1
+        elif difficulty == PERFECT:
+            predicted_y = self.plan(ball, height)
+            if predicted_y is None:
+                predicted_y = height / 2
+            elif predicted_y < height / 2:
+                predicted_y -= PERFECT_AIM  # meet it low on the paddle, sending it down
+            else:
+                predicted_y += PERFECT_AIM
+            limit = self.speed * 1.2
+            step = max(-limit, min(predicted_y - self.centery, limit))
+            self.y = max(0, min(self.y + step, height - self.height))
+        else:
+            raise ValueError(f"unknown difficulty {difficulty!r}")
+
+    def plan(self, ball, height):
+        """ Intercept of the ball with this paddle's face.
+
+        Solved only when the ball's trajectory changes (paddle hit, serve,
+        resize); wall bounces are already folded into the solution, so every
+        other tick is just this cached lookup.
+        """
+        if self.plan_version != ball.version:
+            face = self.left if self.centerx > ball.centerx else self.right
+            self.target = intercept_y(ball, face, height)
+            self.plan_version = ball.version
+        return self.target
+
+
+class Ball(Body):
+    def __init__(self, x, y, size=BALL_SIZE):
+        super().__init__(x, y, size, size)
+        self.dx = BALL_SPEED
+        self.dy = BALL_SPEED
+        self.speed = BALL_SPEED
+        # Bumped whenever the trajectory changes, to invalidate bot plans
+        self.version = 0
+
+    def substeps(self, factor=1):
+        return max(1, math.ceil(max(abs(self.dx * factor), abs(self.dy * factor)) / MAX_SUBSTEP))
+
+    def move(self, width, height, factor=1, steps=1):
+        """ Move one sub-step and bounce off the walls.
+
+        Returns (scoring side or None, whether a wall was hit).
+        """
+        self.x += self.dx * factor / steps
+        self.y += self.dy * factor / steps
+
+        wall = False
+        if self.top <= 0:
+            self.y = -self.y
+            self.dy = abs(self.dy)
+            wall = True
+        elif self.bottom >= height:
+            self.y = 2 * (height - self.height) - self.y
+            self.dy = -abs(self.dy)
+            wall = True
+
+        if self.left <= 0:
+            return RIGHT, wall
+        if self.right >= width:
+            return LEFT, wall
+        return None, wall
+
+    def collide(self, paddle, prev_x, prev_y):
+        """ Swept test of the sub-step from (prev_x, prev_y) against a paddle's face.
+
+        Only a ball moving towards the paddle can hit it, so a ball that is
+        already inside the paddle is pushed out instead of bouncing forever.
+        """
+        if self.dx < 0 and paddle.centerx < self.centerx + (prev_x - self.x):
+            face, lead, prev_lead = paddle.right, self.left, prev_x
+            crossed = prev_lead >= face > lead
+        elif self.dx > 0 and self.centerx + (prev_x - self.x) < paddle.centerx:
+            face, lead, prev_lead = paddle.left, self.right, prev_x + self.width
+            crossed = prev_lead <= face < lead
+        else:
+            return False
+
+        if crossed:
+            t = (prev_lead - face) / (prev_lead - lead)
+            y = prev_y + (self.y - prev_y) * t
+            if not (y < paddle.bottom and paddle.top < y + self.height):
+                return False
+        elif not self.overlaps(paddle):
+            return False
+
+        self.x = face if self.dx < 0 else face - self.width
+        self.bounce(paddle)
+        return True
+
+    def bounce(self, paddle):
+        relative_intersect = (paddle.centery - self.centery) / (paddle.height / 2)
+        bounce_angle = relative_intersect * (5 * 3.14159 / 12)
+
+        self.speed = min(self.speed * 1.05, MAX_BALL_SPEED)
+        self.dx = -self.dx
+        self.dy = -self.speed * math.sin(math.radians(bounce_angle * 180 / 3.14159))
+        self.version += 1
+
+    def serve(self, width, height, xdir, ydir, size=None):
+        # Center with the current size first, like pygame's rect.center then rect.size
+        self.x = width // 2 - self.width // 2
+        self.y = height // 2 - self.height // 2
+        if size is not None:
+            self.width = self.height = size
+        self.remember()
+        self.dx = BALL_SPEED * xdir
+        self.dy = BALL_SPEED * ydir
+        self.speed = BALL_SPEED
+        self.version += 1
+
+
+class FixedStep:
+    """ Accumulates real frame time and hands out whole physics ticks.
+
+    alpha is how far the renderer is between the last two ticks, for
+    interpolating what it draws.
+    """
+
+    def __init__(self, rate=TICK_RATE):
+        self.dt = 1.0 / rate
+        self.accumulator = 0.0
+
+    def reset(self):
+        self.accumulator = 0.0
+
+    def advance(self, frame_time):
+        self.accumulator += min(frame_time, MAX_FRAME_TIME)
+        ticks = int(self.accumulator / self.dt)
+        self.accumulator -= ticks * self.dt
+        return ticks
+
+    @property
+    def alpha(self):
+        return min(1.0, self.accumulator / self.dt)
+
+
+class Match:
+    """ One game: two paddles, a ball and the score.
+
+    left_ai/right_ai hold a difficulty for bot-controlled paddles, or None
+    for paddles driven by the input bits passed to step().
+    """
+
+    paddle_class = Paddle
+    ball_class = Ball
+
+    def __init__(self, width=WIDTH, height=HEIGHT, points_to_win=5, seed=None,
+                 crazy=False, ball_size=BALL_SIZE, left_ai=None, right_ai=None):
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.width = width
+        self.height = height
+        self.points_to_win = points_to_win
+        self.seed = seed & MASK64
+        self.crazy = crazy
+        self.ball_size = ball_size
+        self.left_ai = left_ai
+        self.right_ai = right_ai
+        self.tick = 0
+        self.winner = None
+
+        self.left = self.paddle_class(20, height // 2 - 50)
+        self.right = self.paddle_class(width - 35, height // 2 - 50)
+        self.ball = self.ball_class(width // 2 - ball_size // 2, height // 2 - ball_size // 2, ball_size)
+        self.serve()
+
+    @property
+    def over(self):
+        return self.winner is not None
+
+    def random(self, stream):
+        return uniform(self.seed, self.tick, stream)
+
+    def serve(self):
+        xdir = -1 if self.random(SERVE_X_STREAM) < 0.5 else 1
+        ydir = -1 if self.random(SERVE_Y_STREAM) < 0.5 else 1
+        self.ball.serve(self.width, self.height, xdir, ydir, self.ball_size)
+
+    def set_ball_size(self, size):
+        self.ball_size = size
+        self.ball.width = self.ball.height = size
+        self.ball.version += 1
+
+
+def register_policy(policy):
+    """ Make policy(match, paddle) -> input bits selectable as a bot difficulty. """
+    difficulty = max(POLICIES.keys() | {GENIUS}) + 1
+    POLICIES[difficulty] = policy
+    return difficulty
+
+
+def _drive(match, paddle, ai, bits, stream, ball=None):
+    if ai is None:
+        paddle.move(bits, match.height)
+    elif ai in POLICIES:
+        # Policies press the same buttons as a player, at the same paddle speed
+        paddle.move(POLICIES[ai](match, paddle), match.height)
+    else:
+        roll = match.random(stream) if ai == EASY else 0.0
+        paddle.ai_move(match.ball if ball is None else ball, ai, match.height, roll)
+
+
+def step(match, inputs=(0, 0)):
+    """ Advance a match by one fixed tick and return the list of (kind, side) events. """
+    if match.over:
+        return []
+    step_paddles(match, inputs)
+    return step_ball(match)
+
+
+def step_paddles(match, inputs=(0, 0)):
+    """ First half of step(): move both paddles from their inputs or bots. """
+    for body in (match.left, match.right, match.ball):
+        body.remember()
+
+    _drive(match, match.left, match.left_ai, inputs[0], LEFT_AI_STREAM)
+    _drive(match, match.right, match.right_ai, inputs[1], RIGHT_AI_STREAM)
+
+
+def step_ball(match):
+    """ Second half of step(): move the ball in sub-steps, bounce and score. """
+    events = []
+    ball = match.ball
+    factor = CRAZY_FACTOR if match.crazy else 1
+    steps = ball.substeps(factor)
+    for _ in range(steps):
+        prev_x, prev_y = ball.x, ball.y
+        result, wall = ball.move(match.width, match.height, factor, steps)
+        if wall:
+            events.append((WALL, None))
+        if ball.collide(match.left, prev_x, prev_y):
+            events.append((HIT, LEFT))
+        elif ball.collide(match.right, prev_x, prev_y):
+            events.append((HIT, RIGHT))
+        elif result is not None:
+            scorer = match.left if result == LEFT else match.right
+            scorer.score += 1
+            events.append((SCORE, result))
+            match.serve()
+            if scorer.score >= match.points_to_win:
+                match.winner = result
+                events.append((GAME_OVER, result))
+            break
+
+    match.tick += 1
+    return events
+
+
+def run(match, max_ticks=None):
+    """ Play a bot-vs-bot match to the end without rendering. """
+    while not match.over and (max_ticks is None or match.tick < max_ticks):
+        step(match)
+    return match
@@ -0,0 +1,367 @@
+"""Reinforcement-learning environments for training a paddle bot.
+
+The agent plays the left paddle against one of the built-in bots. The API
+follows Gym: reset() returns (observation, info) and step(action) returns
+(observation, reward, terminated, truncated, info). Actions are 0 (stay),
+1 (up) and 2 (down); observations are six floats, mirrored so the agent
+always defends the left goal:
+
+    ball x, ball y, ball dx, ball dy, own paddle y, opponent paddle y
+
+The reward is +1 for a point won, -1 for a point lost and a small bonus for
+each return. PongEnv wraps one engine.Match, VectorEnv steps N matches per
+call on batch.BatchMatch and auto-resets the finished ones, and ProcVectorEnv
+splits a VectorEnv across worker processes for parallel rollouts.
+
+A trained LinearPolicy is a bot difficulty like EASY/MODERATE/HARD once it
+is registered with engine.register_policy(), and DJONG ULTIMATE.py offers
+it in the menu when started with PINGPONG_POLICY=<file>:
+
+    python gymenv.py train --opponent MODERATE --out policy.npy
+    python gymenv.py evaluate policy.npy --opponent HARD
+    python gymenv.py bench --envs 256 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import engine
+from batch import DIFFICULTIES, LEFT_SCORED, RIGHT_SCORED, BatchMatch
+
+ACTIONS = (0, engine.UP, engine.DOWN)  # action index -> input bits
+OBS_SIZE = 6
+HIT_REWARD = 0.1
+MAX_STEPS = 30 * engine.TICK_RATE  # episodes are cut off after 30 seconds of play
+
+_ACTION_BITS = np.array(ACTIONS, dtype=np.uint8)
+
+
+def observe(match, paddle):
+    """ Observation for the paddle's side of a live engine.Match. """
+    ball = match.ball
+    if paddle is match.left:
+        x, dx, opponent = ball.centerx / match.width, ball.dx, match.right
+    else:
+        x, dx, opponent = 1 - ball.centerx / match.width, -ball.dx, match.left
+    return np.array((x, ball.centery / match.height, dx / engine.MAX_BALL_SPEED,
+                     ball.dy / engine.MAX_BALL_SPEED, paddle.centery / match.height,
+                     opponent.centery / match.height), dtype=np.float32)
+
+
+def observe_batch(batch):
+    """ Observations for the left paddles of a BatchMatch, one row per match. """
+    half = batch.ball_size_arr / 2
+    obs = np.empty((batch.n, OBS_SIZE), dtype=np.float32)
+    obs[:, 0] = (batch.ball_x + half) / batch.width
+    obs[:, 1] = (batch.ball_y + half) / batch.height
+    obs[:, 2] = batch.ball_dx / engine.MAX_BALL_SPEED
+    obs[:, 3] = batch.ball_dy / engine.MAX_BALL_SPEED
+    obs[:, 4] = (batch.left_y + engine.PADDLE_HEIGHT / 2) / batch.height
+    obs[:, 5] = (batch.right_y + engine.PADDLE_HEIGHT / 2) / batch.height
+    return obs
+
+
+class PongEnv:
+    """ One match against a bot; an episode ends when the match does. """
+
+    def __init__(self, opponent=engine.HARD, points_to_win=1, seed=0, max_steps=MAX_STEPS,
+                 hit_reward=HIT_REWARD, **settings):
+        self.opponent = opponent
+        self.points_to_win = points_to_win
+        self.seed = seed
+        self.max_steps = max_steps
+        self.hit_reward = hit_reward
+        self.settings = settings
+        self.episodes = 0
+        self.match = None
+        self.done = True  # step() needs a reset() first, and again after every episode
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.seed, self.episodes = seed, 0
+        self.match = engine.Match(points_to_win=self.points_to_win, seed=engine.mix64(self.seed + self.episodes),
+                                  right_ai=self.opponent, **self.settings)
+        self.episodes += 1
+        self.done = False
+        return observe(self.match, self.match.left), {}
+
+    def step(self, action):
+        if self.done:
+            raise RuntimeError("step() called on a finished episode; call reset() first")
+        match = self.match
+        reward = 0.0
+        for kind, side in engine.step(match, (ACTIONS[action], 0)):
+            if kind == engine.SCORE:
+                reward += 1.0 if side == engine.LEFT else -1.0
+            elif kind == engine.HIT and side == engine.LEFT:
+                reward += self.hit_reward
+        terminated = match.over
+        truncated = not terminated and match.tick >= self.max_steps
+        self.done = terminated or truncated
+        info = {"tick": match.tick, "score": (match.left.score, match.right.score)}
+        return observe(match, match.left), reward, terminated, truncated, info
+
+
+class VectorEnv:
+    """ n PongEnvs stepped together; finished episodes restart in the same step.
+
+    step() takes an array of n actions and returns arrays of n observations,
+    rewards and flags. The observation of a finished row is already the first
+    one of its next episode; info holds the finished episodes' returns and
+    lengths (NaN in rows that are still playing).
+    """
+
+    def __init__(self, n, opponent=engine.HARD, points_to_win=1, seed=0, max_steps=MAX_STEPS,
+                 hit_reward=HIT_REWARD, **settings):
+        self.n = n
+        self.seed = seed
+        self.max_steps = max_steps
+        self.hit_reward = hit_reward
+        self.settings = dict(settings, points_to_win=points_to_win, right_ai=opponent)
+        self.episodes = 0
+        self.batch = None
+        self.returns = np.zeros(n)
+
+    def _seeds(self, count):
+        seeds = [engine.mix64(self.seed + self.episodes + i) for i in range(count)]
+        self.episodes += count
+        return seeds
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.seed, self.episodes = seed, 0
+        self.batch = BatchMatch(self._seeds(self.n), **self.settings)
+        self.returns[:] = 0
+        return observe_batch(self.batch), {}
+
+    def step(self, actions):
+        batch = self.batch
+        inputs = np.zeros((self.n, 2), dtype=np.uint8)
+        inputs[:, 0] = _ACTION_BITS[actions]
+        left_hit, _, scored = batch.step(inputs)
+
+        rewards = (scored == LEFT_SCORED).astype(np.float64) - (scored == RIGHT_SCORED) + self.hit_reward * left_hit
+        terminated = batch.done.copy()
+        truncated = ~terminated & (batch.tick >= self.max_steps)
+        self.returns += rewards
+
+        finished = terminated | truncated
+        episode_return = np.where(finished, self.returns, np.nan)
+        episode_length = np.where(finished, batch.tick, np.nan)
+        if finished.any():
+            rows = np.nonzero(finished)[0]
+            batch.merge(rows, BatchMatch(self._seeds(len(rows)), **self.settings))
+            self.returns[rows] = 0
+        info = {"episode_return": episode_return, "episode_length": episode_length}
+        return observe_batch(batch), rewards, terminated, truncated, info
+
+
+def _worker(conn, n, settings):
+    env = VectorEnv(n, **settings)
+    while True:
+        try:
+            command, arg = conn.recv()
+        except EOFError:
+            return
+        if command == "step":
+            conn.send(env.step(arg))
+        elif command == "reset":
+            conn.send(env.reset(arg))
+        else:
+            return
+
+
+class ProcVectorEnv:
+    """ A VectorEnv of n rows split across worker processes.
+
+    Every worker steps its share at the same time, so rollouts scale with
+    the cores, at the cost of pickling the arrays through a pipe each step.
+    """
+
+    def __init__(self, n, workers=None, seed=0, **settings):
+        workers = min(n, workers or os.cpu_count() or 1)
+        self.n = n
+        self.sizes = [len(rows) for rows in np.array_split(np.arange(n), workers)]
+        self.offsets = np.cumsum(self.sizes)[:-1]
+        self.conns = []
+        self.processes = []
+        for i, size in enumerate(self.sizes):
+            parent, child = multiprocessing.Pipe()
+            # Workers draw episode seeds from far apart ranges
+            worker_settings = dict(settings, seed=seed + (i << 40))
+            process = multiprocessing.Process(target=_worker, args=(child, size, worker_settings), daemon=True)
+            process.start()
+            self.conns.append(parent)
+            self.processes.append(process)
+
+    def _gather(self):
+        results = [conn.recv() for conn in self.conns]
+        return [np.concatenate(part) for part in zip(*(r[:-1] for r in results))], [r[-1] for r in results]
+
+    def reset(self, seed=None):
+        for i, conn in enumerate(self.conns):
+            conn.send(("reset", None if seed is None else seed + (i << 40)))
+        (obs,), _ = self._gather()
+        return obs, {}
+
+    def step(self, actions):
+        for conn, part in zip(self.conns, np.split(np.asarray(actions), self.offsets)):
+            conn.send(("step", part))
+        (obs, rewards, terminated, truncated), infos = self._gather()
+        info = {key: np.concatenate([i[key] for i in infos]) for key in infos[0]}
+        return obs, rewards, terminated, truncated, info
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(("close", None))
+        for process in self.processes:
+            process.join()
+
+
+class LinearPolicy:
+    """ Scores each action as a linear function of the observation and picks the best. """
+
+    def __init__(self, weights):
+        self.weights = np.asarray(weights, dtype=np.float64).reshape(len(ACTIONS), OBS_SIZE + 1)
+
+    def act(self, obs):
+        return np.argmax(obs @ self.weights[:, :-1].T + self.weights[:, -1], axis=-1)
+
+    def __call__(self, match, paddle):
+        return ACTIONS[self.act(observe(match, paddle))]
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.save(f, self.weights)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path))
+
+
+def train(opponent=engine.MODERATE, generations=30, population=32, envs=8, steps=1500, elite=0.2,
+          seed=0, log=print):
+    """ Cross-entropy method over LinearPolicy weights.
+
+    Each generation samples a population of weight sets around the current
+    mean, plays every candidate on its own envs rows of one VectorEnv, and
+    refits the mean and spread to the best candidates.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (len(ACTIONS), OBS_SIZE + 1)
+    mean, std = np.zeros(shape), np.ones(shape)
+    env = VectorEnv(population * envs, opponent=opponent, seed=seed)
+    keep = max(2, int(population * elite))
+    for generation in range(generations):
+        weights = mean + std * rng.standard_normal((population,) + shape)
+        obs, _ = env.reset(seed + generation * population * envs * 100)
+        totals = np.zeros(population)
+        start = time.perf_counter()
+        for _ in range(steps):
+            scores = (np.einsum("pkf,paf->pka", obs.reshape(population, envs, OBS_SIZE), weights[:, :, :-1])
+                      + weights[:, None, :, -1])
+            obs, rewards, _, _, _ = env.step(scores.argmax(-1).ravel())
+            totals += rewards.reshape(population, envs).sum(1)
+        elapsed = time.perf_counter() - start
+        best = np.argsort(totals)[::-1][:keep]
+        mean, std = weights[best].mean(0), weights[best].std(0) + 0.05
+        log(f"generation {generation + 1}/{generations}: best {totals[best[0]] / envs:+.2f}, "
+            f"elite {totals[best].mean() / envs:+.2f} per {steps} steps, "
+            f"{population * envs * steps / elapsed:,.0f} steps/s")
+    return LinearPolicy(mean)
+
+
+def evaluate(policy, opponent=engine.HARD, matches=50, points_to_win=5, seed=0, max_ticks=engine.TICK_RATE * 600):
+    """ Win rate of a policy as a bot difficulty in full engine matches. """
+    difficulty = engine.register_policy(policy)
+    wins = 0
+    try:
+        for i in range(matches):
+            match = engine.Match(points_to_win=points_to_win, seed=engine.mix64(seed + i),
+                                 left_ai=difficulty, right_ai=opponent)
+            engine.run(match, max_ticks)
+            wins += match.winner == engine.LEFT
+    finally:
+        del engine.POLICIES[difficulty]  # only registered for these matches
+    return wins / matches
+
+
+def throughput(make_env, n, seconds):
+    """ Environment steps per second with random actions, resetting finished episodes like a rollout. """
+    env = make_env()
+    env.reset()
+    rng = np.random.default_rng(0)
+    actions = rng.integers(0, len(ACTIONS), size=(256, n))
+    steps = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for row in actions[:16]:
+            if n > 1:
+                env.step(row)  # vector envs reset their finished rows themselves
+            else:
+                _, _, terminated, truncated, _ = env.step(int(row[0]))
+                if terminated or truncated:
+                    env.reset()
+        steps += 16
+    elapsed = time.perf_counter() - start
+    if hasattr(env, "close"):
+        env.close()
+    return steps * n / elapsed
+
+
+def bench(envs, workers, seconds, opponent):
+    cores = os.cpu_count() or 1
+    rows = [("PongEnv", 1, 1, lambda: PongEnv(opponent)),
+            ("VectorEnv", envs, 1, lambda: VectorEnv(envs, opponent)),
+            ("ProcVectorEnv", envs, workers, lambda: ProcVectorEnv(envs, workers, opponent=opponent))]
+    print(f"{'environment':<16}{'envs':>6}{'workers':>9}{'steps/s':>14}{'steps/s/core':>15}")
+    for name, n, used, make_env in rows:
+        rate = throughput(make_env, n, seconds)
+        print(f"{name:<16}{n:>6}{used:>9}{rate:>14,.0f}{rate / min(used, cores):>15,.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and benchmark paddle bots")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    fit = commands.add_parser("train", help="train a linear policy with the cross-entropy method")
+    fit.add_argument("--opponent", choices=DIFFICULTIES, default="MODERATE")
+    fit.add_argument("--generations", type=int, default=30)
+    fit.add_argument("--population", type=int, default=32)
+    fit.add_argument("--envs", type=int, default=8, help="episodes per candidate at once")
+    fit.add_argument("--steps", type=int, default=1500, help="steps per generation")
+    fit.add_argument("--seed", type=int, default=0)
+    fit.add_argument("--out", default="policy.npy")
+
+    score = commands.add_parser("evaluate", help="win rate of a saved policy against a bot")
+    score.add_argument("policy")
+    score.add_argument("--opponent", choices=DIFFICULTIES, default="HARD")
+    score.add_argument("--matches", type=int, default=50)
+    score.add_argument("--points", type=int, default=5)
+
+    speed = commands.add_parser("bench", help="environment steps per second per core")
+    speed.add_argument("--envs", type=int, default=256)
+    speed.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    speed.add_argument("--seconds", type=float, default=2.0)
+    speed.add_argument("--opponent", choices=DIFFICULTIES, default="HARD")
+
+    args = parser.parse_args()
+
+    if args.command == "train":
+        policy = train(DIFFICULTIES[args.opponent], args.generations, args.population, args.envs,
+                       args.steps, seed=args.seed)
+        policy.save(args.out)
+        print(f"saved {args.out}")
+    elif args.command == "evaluate":
+        policy = LinearPolicy.load(args.policy)
+        rate = evaluate(policy, DIFFICULTIES[args.opponent], args.matches, args.points)
+        print(f"won {rate:.0%} of {args.matches} matches against {args.opponent}")
+    else:
+        bench(args.envs, args.workers, args.seconds, DIFFICULTIES[args.opponent])
+
+
+if __name__ == "__main__":
+    main()
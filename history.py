@@ -0,0 +1,329 @@
+"""Persistent match history: an append-only log of fixed-width records.
+
+Every finished match is appended as one little-endian struct record
+(settings, final score, rally and ball-speed stats, a CRC32). Because every
+record is the same size, record i sits at HEADER + i * RECORD and the log
+is its own index: queries memory-map the file as a NumPy structured array
+and reduce whole columns, so win rates or the fastest ball over millions of
+matches take milliseconds and read only the columns they touch.
+
+Appends are crash-safe without a journal. Each record goes out in a single
+write on an O_APPEND descriptor followed by fsync, so a crash can only ever
+leave a torn or garbage record at the very end. Readers ignore a partial
+tail and a last record whose CRC doesn't match, and the next append cuts
+both off before writing. compact() rewrites the log keeping only records
+that pass their CRC (optionally only the newest, or only recent ones) and
+swaps it in with a rename.
+
+The frontends log to PINGPONG_HISTORY (default
+~/.local/share/pingpong/matches.pphist) and show the stats from the menu.
+
+    python history.py stats
+    python history.py compact --keep 100000
+    python history.py bench --matches 1000000
+"""
+import argparse
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+import engine
+
+MAGIC = b"PPHS"
+VERSION = 1
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".local", "share", "pingpong", "matches.pphist")
+
+DIFFICULTY_NAMES = ("EASY", "NORMAL", "HARD", "PERFECT", "GENIUS")
+TWO_PLAYERS = -1  # difficulty of a match with no bot
+
+# Flags
+CRAZY = 1
+NETWORK = 2
+
+# (name, struct code) of every record field, in file order
+FIELDS = (
+    ("time", "d"),  # unix time the match ended
+    ("seed", "Q"),
+    ("ticks", "I"),
+    ("width", "H"),
+    ("height", "H"),
+    ("points_to_win", "H"),
+    ("left_score", "H"),
+    ("right_score", "H"),
+    ("difficulty", "b"),  # the right-hand bot, or TWO_PLAYERS
+    ("flags", "B"),
+    ("winner", "b"),  # 0 left, 1 right
+    ("longest_rally", "H"),  # paddle hits in the longest point
+    ("hits", "I"),
+    ("top_speed", "f"),  # pixels per tick
+    ("ball_size", "H"),
+    ("balls", "H"),
+)
+_FORMAT = "<" + "".join(code for _, code in FIELDS)
+_RECORD = struct.Struct(_FORMAT + "5xI")  # reserved bytes, then the CRC32 of everything before it
+_HEADER = struct.Struct("<4sHH8x")  # magic, version, record size
+
+DTYPE = np.dtype({
+    # The reserved bytes are a field too, so copies of records carry them and keep their CRC valid
+    "names": [name for name, _ in FIELDS] + ["reserved", "crc"],
+    "formats": ["<" + code for _, code in FIELDS] + ["V5", "<u4"],
+    "offsets": [struct.calcsize("<" + _FORMAT[1:1 + i]) for i in range(len(FIELDS) + 1)] + [_RECORD.size - 4],
+    "itemsize": _RECORD.size,
+})
+
+
+class HistoryError(Exception):
+    pass
+
+
+def pack(**fields):
+    """ One record's bytes, CRC included. """
+    body = struct.pack(_FORMAT, *(fields[name] for name, _ in FIELDS)) + bytes(5)
+    return body + struct.pack("<I", zlib.crc32(body))
+
+
+def _intact(record):
+    return zlib.crc32(record[:-4]) == struct.unpack_from("<I", record, len(record) - 4)[0]
+
+
+def _read(fd, offset, size):
+    os.lseek(fd, offset, os.SEEK_SET)  # os.pread isn't on Windows
+    return os.read(fd, size)
+
+
+class Tally:
+    """ Rally and ball-speed stats of one live match, fed its events tick by tick. """
+
+    def __init__(self):
+        self.hits = 0
+        self.rally = 0
+        self.longest_rally = 0
+        self.top_speed = float(engine.BALL_SPEED)  # the serve
+
+    def observe(self, match, events):
+        hitters = getattr(match, "hits", None)  # multi-ball matches say which ball hit
+        hit = 0
+        for kind, side in events:
+            if kind == engine.HIT:
+                ball = match.ball if hitters is None else hitters[hit]
+                hit += 1
+                self.hits += 1
+                self.rally += 1
+                self.longest_rally = max(self.longest_rally, self.rally)
+                self.top_speed = max(self.top_speed, ball.speed)
+            elif kind == engine.SCORE:
+                self.rally = 0
+
+    def record(self, match, flags=0):
+        """ The log record of a finished match. """
+        return pack(time=time.time(), seed=match.seed, ticks=match.tick, width=match.width, height=match.height,
+                    points_to_win=match.points_to_win, left_score=match.left.score,
+                    right_score=match.right.score,
+                    difficulty=TWO_PLAYERS if match.right_ai is None else match.right_ai,
+                    flags=flags | (CRAZY if match.crazy else 0),
+                    winner=0 if match.winner == engine.LEFT else 1,
+                    longest_rally=min(self.longest_rally, 0xFFFF), hits=self.hits, top_speed=self.top_speed,
+                    ball_size=match.ball_size, balls=len(getattr(match, "balls", (match.ball,))))
+
+
+class MatchLog:
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, record):
+        """ Durably add one packed record to the end of the log. """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size < _HEADER.size:
+                os.ftruncate(fd, 0)
+                os.write(fd, _HEADER.pack(MAGIC, VERSION, _RECORD.size))
+            else:
+                self._check_header(_read(fd, 0, _HEADER.size))
+                # Cut off whatever a crash left behind: a partial record, or a
+                # whole-sized one that never got its real contents
+                whole = _HEADER.size + (size - _HEADER.size) // _RECORD.size * _RECORD.size
+                if whole > _HEADER.size and not _intact(_read(fd, whole - _RECORD.size, _RECORD.size)):
+                    whole -= _RECORD.size
+                if whole != size:
+                    os.ftruncate(fd, whole)
+            os.write(fd, record)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _check_header(self, data):
+        try:
+            magic, version, size = _HEADER.unpack_from(data)
+        except struct.error:
+            raise HistoryError(f"{self.path}: truncated header")
+        if magic != MAGIC or version != VERSION or size != _RECORD.size:
+            raise HistoryError(f"{self.path}: not a version {VERSION} match history")
+
+    def records(self):
+        """ Every record as a read-only structured array, memory-mapped when there are any. """
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return np.zeros(0, DTYPE)
+        if size < _HEADER.size:
+            return np.zeros(0, DTYPE)
+        with open(self.path, "rb") as f:
+            self._check_header(f.read(_HEADER.size))
+            count = (size - _HEADER.size) // _RECORD.size
+            # Only the last record can be torn; the rest were fsynced before it was written
+            if count:
+                f.seek(_HEADER.size + (count - 1) * _RECORD.size)
+                if not _intact(f.read(_RECORD.size)):
+                    count -= 1
+        if not count:
+            return np.zeros(0, DTYPE)
+        return np.memmap(self.path, DTYPE, "r", offset=_HEADER.size, shape=(count,))
+
+    def summary(self, best=5):
+        return summarize(self.records(), best)
+
+    def compact(self, keep=None, since=None):
+        """ Rewrite the log with only intact records, the newest keep of them and none older than since.
+
+        Returns (kept, dropped).
+        """
+        records = self.records()
+        data = records.tobytes()
+        size = _RECORD.size
+        intact = np.fromiter((_intact(data[i:i + size]) for i in range(0, len(data), size)), bool, len(records))
+        if since is not None:
+            intact &= records["time"] >= since
+        index = np.flatnonzero(intact)
+        if keep is not None:
+            index = index[len(index) - min(keep, len(index)):]
+        kept = records[index]
+        del records
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, size))
+            f.write(kept.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        return len(kept), len(data) // size - len(kept)
+
+
+def summarize(records, best=5):
+    """ Win rates per difficulty, rally lengths, fastest ball and the best wins. """
+    difficulty = records["difficulty"]
+    solo = difficulty >= 0
+    levels = difficulty[solo].astype(np.intp)
+    won = records["winner"][solo] == 0  # the player is always the left paddle
+    played = np.bincount(levels)
+    wins = np.bincount(levels, weights=won, minlength=len(played))
+    points = records["left_score"].sum(dtype=np.int64) + records["right_score"].sum(dtype=np.int64)
+
+    # Best wins against a bot: hardest bot first, then biggest margin, then quickest
+    winners = np.flatnonzero(solo & (records["winner"] == 0))
+    margin = records["left_score"][winners].astype(np.int64) - records["right_score"][winners]
+    order = np.lexsort((records["ticks"][winners], -margin, -records["difficulty"][winners]))[:best]
+    top = records[winners[order]]
+
+    return {
+        "matches": len(records),
+        "solo": int(solo.sum()),
+        "win_rates": {int(level): (int(wins[level]), int(played[level])) for level in np.flatnonzero(played)},
+        "average_rally": float(records["hits"].sum(dtype=np.int64) / points) if points else 0.0,
+        "longest_rally": int(records["longest_rally"].max(initial=0)),
+        "fastest_ball": float(records["top_speed"].max(initial=0)) * engine.TICK_RATE,
+        "best": [(int(r["difficulty"]), int(r["left_score"]), int(r["right_score"]), int(r["ticks"]),
+                  float(r["time"])) for r in top],
+    }
+
+
+def difficulty_name(level):
+    return DIFFICULTY_NAMES[level] if level < len(DIFFICULTY_NAMES) else f"BOT {level}"
+
+
+def describe(summary):
+    """ The summary as lines of text, for the terminal and the in-game stats screen. """
+    if not summary["matches"]:
+        return ["NO MATCHES PLAYED YET"]
+    lines = [f"MATCHES {summary['matches']}   VS BOT {summary['solo']}"]
+    for level, (wins, played) in sorted(summary["win_rates"].items()):
+        lines.append(f"{difficulty_name(level)}: WON {100 * wins / played:.0f}% OF {played}")
+    lines.append(f"AVERAGE RALLY {summary['average_rally']:.1f} HITS   LONGEST {summary['longest_rally']}")
+    lines.append(f"FASTEST BALL {summary['fastest_ball']:.0f} PX/S")
+    if summary["best"]:
+        lines.append("BEST WINS")
+    for level, left, right, ticks, when in summary["best"]:
+        seconds = ticks // engine.TICK_RATE
+        lines.append(f"{difficulty_name(level)}  {left}-{right}  {seconds // 60}:{seconds % 60:02d}  "
+                     f"{time.strftime('%Y-%m-%d', time.localtime(when))}")
+    return lines
+
+
+def synthetic(path, matches, seed=0):
+    """ Fill a log with matches random results, to time queries at scale. """
+    rng = np.random.default_rng(seed)
+    records = np.zeros(matches, DTYPE)
+    records["time"] = time.time() - rng.uniform(0, 365 * 86400, matches)
+    records["seed"] = rng.integers(0, 2 ** 63, matches, dtype=np.uint64)
+    records["width"], records["height"], records["points_to_win"] = 800, 600, 5
+    records["difficulty"] = rng.integers(TWO_PLAYERS, 3, matches)
+    records["winner"] = rng.integers(0, 2, matches)
+    loser = rng.integers(0, 5, matches)
+    records["left_score"] = np.where(records["winner"] == 0, 5, loser)
+    records["right_score"] = np.where(records["winner"] == 1, 5, loser)
+    points = 5 + loser
+    records["hits"] = points * rng.integers(1, 12, matches)
+    records["longest_rally"] = rng.integers(1, 40, matches)
+    records["ticks"] = points * rng.integers(200, 900, matches)
+    records["top_speed"] = rng.uniform(engine.BALL_SPEED, engine.MAX_BALL_SPEED, matches)
+    records["ball_size"], records["balls"] = engine.BALL_SIZE, 1
+    data = bytearray(records.tobytes())
+    size = _RECORD.size
+    for offset in range(0, len(data), size):
+        struct.pack_into("<I", data, offset + size - 4, zlib.crc32(data[offset:offset + size - 4]))
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, size))
+        f.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match history stats and maintenance")
+    parser.add_argument("--file", default=os.environ.get("PINGPONG_HISTORY", DEFAULT_PATH))
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="print win rates, rallies and the best wins")
+    compact = commands.add_parser("compact", help="drop damaged and old records")
+    compact.add_argument("--keep", type=int, help="keep only the newest N matches")
+    compact.add_argument("--days", type=float, help="drop matches older than this many days")
+    bench = commands.add_parser("bench", help="time the stats query over a synthetic log")
+    bench.add_argument("--matches", type=int, default=1000000)
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print("\n".join(describe(MatchLog(args.file).summary())))
+    elif args.command == "compact":
+        since = None if args.days is None else time.time() - args.days * 86400
+        kept, dropped = MatchLog(args.file).compact(args.keep, since)
+        print(f"{args.file}: kept {kept} matches, dropped {dropped}")
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            log = MatchLog(os.path.join(directory, "bench.pphist"))
+            synthetic(log.path, args.matches)
+            start = time.perf_counter()
+            summary = log.summary()
+            elapsed = time.perf_counter() - start
+            print("\n".join(describe(summary)))
+            print(f"stats over {args.matches} matches ({os.path.getsize(log.path) / 1e6:.0f} MB) "
+                  f"took {elapsed * 1000:.1f} ms")
+            del summary, log
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Cached, pre-composited layers for the menu and game over screens.
+
+A layer is a surface built once by a callback and reused every frame until
+it is invalidated or its key changes. The key is whatever state the layer
+depends on (hover and selection for a button, the game mode for the menu
+background), so only the pieces whose state moved get rebuilt.
+"""
+
+
+class LayerCache:
+    def __init__(self):
+        self.layers = {}
+        self.stale = set()
+        self.builds = 0
+        self.reuses = 0
+
+    def get(self, name, key, build, *args):
+        """ Surface for layer `name`, rebuilt with build(*args) if stale or `key` changed.
+
+        Passing args instead of a closure keeps cache hits from allocating
+        a new function every frame.
+        """
+        entry = self.layers.get(name)
+        if entry is not None and entry[0] == key and name not in self.stale:
+            self.reuses += 1
+            return entry[1]
+        surface = build(*args)
+        self.layers[name] = (key, surface)
+        self.stale.discard(name)
+        self.builds += 1
+        return surface
+
+    def invalidate(self, *names):
+        """ Mark layers stale so they are rebuilt on next use (all layers if none given). """
+        self.stale.update(names or self.layers)
+
+    def stats(self):
+        return {"layers": len(self.layers), "builds": self.builds, "reuses": self.reuses}
+
+
+screens = LayerCache()
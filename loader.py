@@ -0,0 +1,30 @@
+"""Background loading of fonts, backgrounds, sounds and music.
+
+The frontends open their window and show a first frame straight away,
+then hand the slow startup work (SysFont scanning, mixer init, decoding
+audio, backgrounds) to a small thread pool. Each job returns a future;
+the menu waits on them only when it first needs them. In game, the same
+threads save and query the match history off the frame loop.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import assets
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="loader")
+
+
+def submit(name, fn, *args):
+    """ Run fn(*args) in the background as a timed startup stage. """
+    def job():
+        with assets.stage(name):
+            return fn(*args)
+    return _executor.submit(job)
+
+
+def ready(futures):
+    return all(future.done() for future in futures)
+
+
+def background(fn, *args):
+    """ Run fn(*args) in the background, untimed, for work that comes up in game. """
+    return _executor.submit(fn, *args)
@@ -0,0 +1,333 @@
+"""GENIUS: a bot that plans its shots on a worker thread.
+
+The other tiers react to where the ball is now. GENIUS searches over where
+the ball will go. For a ball coming at it, it tries contact points along its
+paddle face. For each one it plays the rally forward with the engine's own
+rules: the flight to its face, Ball.bounce off its paddle, the flight to the
+far side. Then it rolls out the opponent's likely returns from there and
+keeps the shot that leaves the opponent furthest from the ball. That usually
+means aiming the bounce into the far corner, as long as GENIUS can still
+recover from the returns. For a ball going away, it waits where the
+opponent's returns land.
+
+Search is anytime: a coarse sweep of contact points, widest spread first,
+then refinement around the best one until the per-decision budget
+(PINGPONG_BOT_BUDGET, milliseconds) runs out. The deadline is checked after
+every candidate, so a decision overruns it by at most one evaluation. It
+runs on a daemon thread, and the thread yields the GIL between rounds. The game loop and the thread share two dicts:
+
+- The loop publishes a snapshot of the match into requests.
+- The thread publishes its latest Plan into plans.
+
+Both are keyed by (match number, side), so a plan never carries over into
+another match. Each side only replaces whole immutable tuples, so neither
+takes a lock or waits for the other; the thread sleeps on an Event that the
+loop sets when it posts a request. Until a plan for the ball's current trajectory
+arrives, the paddle tracks the plain intercept like HARD does.
+
+install() makes the bot playable as engine.GENIUS. Its moves depend
+on thread timing, so recordings store its presses as inputs (replay.py).
+To compare planned play against the other tiers, with every decision made
+inline so the runs are repeatable:
+
+    python lookahead.py --matches 20 --budget 2
+"""
+import argparse
+import math
+import os
+import threading
+import time
+import weakref
+from collections import deque, namedtuple
+
+import engine
+
+BUDGET = float(os.environ.get("PINGPONG_BOT_BUDGET", "2")) / 1000  # seconds per decision
+REPLAN_TICKS = 9  # re-aim this often while the ball is on its way, as the opponent moves
+REACTION_TICKS = int(0.2 * engine.TICK_RATE)  # assumed delay before the opponent starts moving
+OPPONENT_SPEED = 1.2 * engine.PADDLE_SPEED  # as fast as the fastest bot
+SWEEP = 9  # contact points in the first, coarse round
+RETURNS = 5  # opponent contact points rolled out per candidate shot
+DECISIONS_KEPT = 1000  # decision times a threaded planner keeps, for percentiles
+
+# target: paddle center y to be at; version: the ball trajectory it was planned for
+Plan = namedtuple("Plan", "version tick target score rounds")
+
+
+class _Paddle:
+    """ Just enough of a paddle for Ball.bounce. """
+
+    def __init__(self, centery, height):
+        self.centery = centery
+        self.height = height
+
+
+def _flight(ball, face, height, factor):
+    """ (ball center y, ticks) when ball's leading edge reaches x == face. """
+    lead = ball.right if ball.dx > 0 else ball.left
+    y = engine.intercept_y(ball, face, height)
+    return y, abs(face - lead) / (abs(ball.dx) * factor)
+
+
+def _shot(x, centery, size, dx, speed, paddle_centery, paddle_height):
+    """ A ball of size leaving a paddle at x after Ball.bounce, given where on the paddle it hit. """
+    ball = engine.Ball(x, centery - size / 2, size)
+    ball.dx, ball.speed = dx, speed
+    ball.bounce(_Paddle(paddle_centery, paddle_height))
+    return ball
+
+
+class Snapshot(namedtuple("Snapshot", "tick version ball_x ball_y dx dy speed size own_face own_y opp_face opp_y "
+                                      "paddle_height width height factor")):
+    """ Everything a decision needs, copied out of the match by the game loop. """
+
+    @classmethod
+    def of(cls, match, paddle):
+        ball = match.ball
+        opponent = match.right if paddle is match.left else match.left
+        left = paddle is match.left
+        return cls(match.tick, ball.version, ball.x, ball.y, ball.dx, ball.dy, ball.speed, ball.width,
+                   paddle.right if left else paddle.left, paddle.centery,
+                   opponent.left if left else opponent.right, opponent.centery,
+                   paddle.height, match.width, match.height, engine.CRAZY_FACTOR if match.crazy else 1)
+
+    def ball(self):
+        ball = engine.Ball(self.ball_x, self.ball_y, self.size)
+        ball.dx, ball.dy, ball.speed = self.dx, self.dy, self.speed
+        return ball
+
+    def coming(self):
+        return (self.dx < 0) == (self.own_face < self.width / 2)
+
+
+def _reach_gap(need, half, speed, ticks):
+    """ How far short of reaching need a paddle center moving at speed for ticks falls (negative: spare). """
+    return abs(need) - half - speed * max(0.0, ticks)
+
+
+def evaluate(s, hit_y, offset):
+    """ Score of meeting the ball at hit_y with the paddle center offset from it; higher is better. """
+    half = s.paddle_height / 2
+    target = min(max(hit_y + offset, half), s.height - half)
+    side = 1 if s.own_face < s.opp_face else -1  # direction the shot travels
+    shot = _shot(s.own_face if side > 0 else s.own_face - s.size, hit_y, s.size, -side * abs(s.dx), s.speed,
+                 target, s.paddle_height)
+    arrival, flight = _flight(shot, s.opp_face, s.height, s.factor)
+    # How far the opponent is from getting a paddle on it in time; positive means a winner
+    score = -_reach_gap(arrival - s.opp_y, half + s.size / 2, OPPONENT_SPEED, flight - REACTION_TICKS)
+
+    # Their likely returns, from anywhere on their paddle, and whether we get back to them
+    worst = -math.inf
+    for k in range(RETURNS):
+        their_offset = (2 * k / (RETURNS - 1) - 1) * (half - 4)
+        back = _shot(s.opp_face - s.size if side > 0 else s.opp_face, arrival, s.size, shot.dx, shot.speed,
+                     arrival + their_offset, s.paddle_height)
+        back_y, back_flight = _flight(back, s.own_face, s.height, s.factor)
+        worst = max(worst, _reach_gap(back_y - target, half, engine.PADDLE_SPEED, flight + back_flight))
+    return score - 2 * max(0.0, worst)
+
+
+def _coarse_to_fine(n):
+    """ 0..n-1 ordered so every prefix is spread across the range (n = 2**k + 1). """
+    order = [0, n - 1]
+    step = n - 1
+    while step > 1:
+        order += range(step // 2, n - 1, step)
+        step //= 2
+    return order
+
+
+_SWEEP_ORDER = _coarse_to_fine(SWEEP)
+
+
+def decide(s, deadline):
+    """ Best Plan for snapshot s found before deadline (perf_counter seconds). """
+    ball = s.ball()
+    half = s.paddle_height / 2
+    if not s.coming():
+        # Wait where the opponent's returns land, from where the ball reaches them
+        arrival, _ = _flight(ball, s.opp_face, s.height, s.factor)
+        if arrival is None:  # already past them
+            return Plan(s.version, s.tick, s.height / 2, 0.0, 0)
+        landings = []
+        for k in range(RETURNS):
+            their_offset = (2 * k / (RETURNS - 1) - 1) * (half - 4)
+            back = _shot(s.opp_face - s.size if s.dx > 0 else s.opp_face, arrival, s.size, s.dx, s.speed,
+                         arrival + their_offset, s.paddle_height)
+            landings.append(_flight(back, s.own_face, s.height, s.factor)[0])
+        target = (min(landings) + max(landings)) / 2
+        return Plan(s.version, s.tick, target, 0.0, 1)
+
+    hit_y, ticks = _flight(ball, s.own_face, s.height, s.factor)
+    if hit_y is None:  # already past us
+        return Plan(s.version, s.tick, s.own_y, -math.inf, 0)
+    limit = half - 4  # keep the ball well on the paddle
+    # Contact points we can still get to in time
+    low = max(-limit, s.own_y - engine.PADDLE_SPEED * ticks - hit_y)
+    high = min(limit, s.own_y + engine.PADDLE_SPEED * ticks - hit_y)
+    if low > high:
+        return Plan(s.version, s.tick, hit_y, -math.inf, 0)
+
+    step = (high - low) / (SWEEP - 1)
+    best_score = -math.inf
+    for i in _SWEEP_ORDER:
+        offset = low + i * step
+        score = evaluate(s, hit_y, offset)
+        if score > best_score:
+            best_score, best = score, offset
+        if time.perf_counter() >= deadline:
+            return Plan(s.version, s.tick, hit_y + best, best_score, 0)
+    done = 1
+    while step > 0.5:
+        time.sleep(0)  # let the game loop have the GIL between rounds
+        step /= 2
+        for offset in (best - step, best + step):
+            if time.perf_counter() >= deadline:
+                return Plan(s.version, s.tick, hit_y + best, best_score, done)
+            if low <= offset <= high:
+                score = evaluate(s, hit_y, offset)
+                if score > best_score:
+                    best_score, best = score, offset
+        done += 1
+    return Plan(s.version, s.tick, hit_y + best, best_score, done)
+
+
+def bits_toward(paddle, target, height):
+    """ Input bits that move paddle's center toward target. """
+    gap = target - paddle.centery
+    if gap < -paddle.speed / 2 and paddle.top > 0:
+        return engine.UP
+    if gap > paddle.speed / 2 and paddle.bottom < height:
+        return engine.DOWN
+    return 0
+
+
+class Planner:
+    """ engine policy: reads the latest plan in the game loop, searches on a worker thread.
+
+    With threaded=False every decision is made inline within the budget,
+    which is slower per tick but repeatable.
+    """
+
+    def __init__(self, budget=BUDGET, threaded=True):
+        self.budget = budget
+        self.threaded = threaded
+        self.replayable = not threaded  # see replay.Recording.of
+        self.requests = {}  # (match number, side): Snapshot, written by the game loop
+        self.plans = {}  # (match number, side): Plan, written by the planner
+        # Seconds each decision took; inline runs keep them all for the CLI's percentiles
+        self.decisions = deque(maxlen=DECISIONS_KEPT if threaded else None)
+        self._pressed = {}  # (match number, side): (tick, bits), so repeat calls in a tick agree
+        # Numbers for live matches; unlike id(), never reused by a later match
+        self._numbers = weakref.WeakKeyDictionary()
+        self._next_number = 0
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _number(self, match):
+        number = self._numbers.get(match)
+        if number is None:
+            number = self._numbers[match] = self._next_number
+            self._next_number += 1
+            # A new match: forget what was planned for the ones that are gone
+            live = set(self._numbers.values())
+            for table in (self.requests, self.plans, self._pressed):
+                for key in [key for key in table if key[0] not in live]:
+                    table.pop(key, None)
+        return number
+
+    def __call__(self, match, paddle):
+        key = (self._number(match), engine.LEFT if paddle is match.left else engine.RIGHT)
+        pressed = self._pressed.get(key)
+        if pressed is not None and pressed[0] == match.tick:
+            return pressed[1]
+
+        plan = self.plans.get(key)
+        ball = match.ball
+        stale = plan is None or plan.version != ball.version or match.tick - plan.tick >= REPLAN_TICKS
+        if stale:
+            request = Snapshot.of(match, paddle)
+            if self.threaded:
+                self.requests[key] = request
+                self._wake.set()
+                self._start()
+            else:
+                self._decide(key, request)
+                plan = self.plans[key]
+        if plan is None or plan.version != ball.version:
+            # Nothing planned for this trajectory yet: track the intercept like HARD
+            target = paddle.plan(ball, match.height)
+            target = match.height / 2 if target is None else target
+        else:
+            target = plan.target
+        bits = bits_toward(paddle, target, match.height)
+        self._pressed[key] = (match.tick, bits)
+        return bits
+
+    def _decide(self, key, request):
+        start = time.perf_counter()
+        self.plans[key] = decide(request, start + self.budget)
+        self.decisions.append(time.perf_counter() - start)
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="lookahead", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        done = {}  # key: the request last planned for
+        while True:
+            self._wake.wait()  # no polling between matches or in menus
+            self._wake.clear()
+            requests = list(self.requests.items())
+            for key, request in requests:
+                if done.get(key) is not request:
+                    done[key] = request
+                    self._decide(key, request)
+            done = {key: request for key, request in requests if done.get(key) is request}
+
+
+planner = Planner()
+
+
+def install(policy=None):
+    """ Make GENIUS (the threaded planner unless policy is given) playable; returns engine.GENIUS. """
+    engine.POLICIES[engine.GENIUS] = planner if policy is None else policy
+    return engine.GENIUS
+
+
+def main():
+    from profiler import percentile
+
+    parser = argparse.ArgumentParser(description="GENIUS against the other bots, deciding inline")
+    parser.add_argument("--matches", type=int, default=20, help="matches against each opponent")
+    parser.add_argument("--points", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=BUDGET * 1000, help="milliseconds per decision")
+    parser.add_argument("--max-ticks", type=int, default=120 * engine.TICK_RATE)
+    args = parser.parse_args()
+
+    inline = Planner(args.budget / 1000, threaded=False)
+    install(inline)
+    for name, opponent in (("EASY", engine.EASY), ("MODERATE", engine.MODERATE), ("HARD", engine.HARD),
+                           ("PERFECT", engine.PERFECT)):
+        won = lost = scored = conceded = 0
+        for i in range(args.matches):
+            # GENIUS plays both sides
+            left = i % 2 == 0
+            match = engine.Match(points_to_win=args.points, seed=i, left_ai=engine.GENIUS if left else opponent,
+                                 right_ai=opponent if left else engine.GENIUS)
+            engine.run(match, args.max_ticks)
+            mine, theirs = (match.left.score, match.right.score) if left else (match.right.score, match.left.score)
+            won += mine > theirs
+            lost += mine < theirs
+            scored += mine
+            conceded += theirs
+        print(f"GENIUS vs {name:<8} won {won}, lost {lost}, drawn {args.matches - won - lost}, "
+              f"points {scored}-{conceded}")
+    decisions = inline.decisions
+    print(f"{len(decisions)} decisions: p50 {percentile(decisions, 50) * 1000:.2f} ms, "
+          f"p99 {percentile(decisions, 99) * 1000:.2f} ms, budget {args.budget:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
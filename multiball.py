@@ -0,0 +1,312 @@
+"""Multi-ball party mode.
+
+MultiBallMatch is an engine.Match with any number of balls of mixed
+sizes. Each ball moves, bounces off walls and paddles and scores exactly
+like the single ball in engine.step_ball; a ball that scores is served
+again on its own. After every ball has moved, balls that overlap bounce
+off each other (elastic, heavier balls push harder).
+
+Candidate pairs come from a uniform-grid spatial hash with cells as wide
+as the largest ball, so each ball is only tested against the few balls in
+its own and neighbouring cells rather than all the others, and the cost
+of a tick grows linearly with the number of balls. Bots chase whichever
+ball will reach them first.
+
+    python multiball.py --balls 50 100 200 500 1000
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+
+import engine
+
+SIZES = (10, 20, 30, 40, 50)
+MIN_DX = engine.BALL_SPEED / 2  # balls knocked sideways still cross the court
+
+# Event kind for a ball-ball bounce, next to engine's HIT/WALL/SCORE
+BOUNCE = "bounce"
+
+# Ball k's versions start at k * stride, so a bot's cached plan for one
+# ball can never be mistaken for another's
+_VERSION_STRIDE = 1 << 32
+_FIRST_STREAM = engine.SERVE_Y_STREAM + 1
+
+COURT = (1200, 800)  # the DJONG ULTIMATE court
+DENSITY_BALLS = 500  # bench crowding: this many balls on the full court
+
+
+class SpatialHash:
+    """ Uniform grid broad phase.
+
+    Cells are as wide as the largest ball and every ball is filed under the
+    cell of its center, so two balls can only touch if their cells are the
+    same or neighbours. Sorting the cell keys makes each cell a contiguous
+    run, and each ball looks up its own cell and the four neighbours
+    after it (the other four see it from their side), so every pair is
+    found once, with no set to deduplicate.
+    """
+
+    def __init__(self, cell):
+        self.cell = cell
+        self.candidates = 0  # pairs handed to the narrow phase by the last call
+
+    def pairs(self, x, y, size):
+        """ Index arrays (i, j) of every pair of balls that might touch. """
+        half = size / 2
+        cx = ((x + half) // self.cell).astype(np.int64)
+        cy = ((y + half) // self.cell).astype(np.int64)
+        cx -= cx.min()
+        cy -= cy.min()
+        # A spare row keeps cy + 1 and cy - 1 from wrapping into the next column
+        rows = int(cy.max()) + 2
+        keys = cx * rows + cy
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        position = np.arange(len(keys))
+
+        starts, ends = [position + 1], [np.searchsorted(keys, keys, "right")]
+        for offset in (1, rows - 1, rows, rows + 1):
+            starts.append(np.searchsorted(keys, keys + offset, "left"))
+            ends.append(np.searchsorted(keys, keys + offset, "right"))
+        start, end = np.concatenate(starts), np.concatenate(ends)
+        counts = np.maximum(end - start, 0)
+        total = int(counts.sum())
+        self.candidates = total
+        owner = np.repeat(np.tile(position, len(starts)), counts)
+        other = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(total)
+        return order[owner], order[other]
+
+
+def all_pairs(x, y, size):
+    """ Every pair, for comparing against the spatial hash. """
+    return np.triu_indices(len(x), 1)
+
+
+class MultiBallMatch(engine.Match):
+    def __init__(self, width=engine.WIDTH, height=engine.HEIGHT, points_to_win=5, seed=None,
+                 crazy=False, ball_size=engine.BALL_SIZE, left_ai=None, right_ai=None, balls=8, sizes=SIZES):
+        self.sizes = sizes
+        self.balls = []
+        super().__init__(width, height, points_to_win, seed, crazy, ball_size, left_ai, right_ai)
+        self.balls = [self.ball] + [self.ball_class(0, 0, ball_size) for _ in range(balls - 1)]
+        for k, ball in enumerate(self.balls):
+            ball.version = k * _VERSION_STRIDE
+            if k:
+                self.serve_ball(k)
+        self.grid = SpatialHash(max(max(sizes), ball_size))
+        self.hits = []  # balls that hit a paddle in the last tick, in HIT event order
+
+    def serve_ball(self, k):
+        """ Serve ball k from a random height on the center line, with a random size. """
+        ball = self.balls[k]
+        stream = _FIRST_STREAM + 4 * k
+        size = self.sizes[int(self.random(stream) * len(self.sizes))]
+        xdir = -1 if self.random(stream + 1) < 0.5 else 1
+        ydir = -1 if self.random(stream + 2) < 0.5 else 1
+        ball.serve(self.width, self.height, xdir, ydir, size)
+        ball.y = self.random(stream + 3) * (self.height - size)
+        ball.remember()
+
+
+def threat(match, paddle):
+    """ The ball that will reach paddle first, or the nearest one if none is coming. """
+    left = paddle is match.left
+    best, best_time = None, math.inf
+    for ball in match.balls:
+        if left:
+            gap, coming = ball.x - paddle.right, ball.dx < 0
+        else:
+            gap, coming = paddle.x - ball.right, ball.dx > 0
+        if coming and gap >= 0 and gap < best_time * abs(ball.dx):
+            best, best_time = ball, gap / abs(ball.dx)
+    if best is None:
+        best = min(match.balls, key=lambda ball: abs(ball.centerx - paddle.centerx))
+    return best
+
+
+def step(match, inputs=(0, 0)):
+    """ engine.step() for a MultiBallMatch. """
+    if match.over:
+        return []
+    step_paddles(match, inputs)
+    return step_ball(match)
+
+
+def step_paddles(match, inputs=(0, 0)):
+    for body in [match.left, match.right] + match.balls:
+        body.remember()
+    for paddle, ai, bits, stream in ((match.left, match.left_ai, inputs[0], engine.LEFT_AI_STREAM),
+                                     (match.right, match.right_ai, inputs[1], engine.RIGHT_AI_STREAM)):
+        engine._drive(match, paddle, ai, bits, stream, None if ai is None else threat(match, paddle))
+
+
+def step_ball(match):
+    """ Move every ball like engine.step_ball, then bounce the ones that touch. """
+    events = []
+    match.hits = []
+    factor = engine.CRAZY_FACTOR if match.crazy else 1
+    left, right = match.left, match.right
+    for k, ball in enumerate(match.balls):
+        steps = ball.substeps(factor)
+        for _ in range(steps):
+            prev_x, prev_y = ball.x, ball.y
+            result, wall = ball.move(match.width, match.height, factor, steps)
+            if wall:
+                events.append((engine.WALL, None))
+            # collide() can only succeed once the ball is past the paddle's
+            # face, so most of the court skips both calls
+            if ball.x < left.x + left.width and ball.collide(left, prev_x, prev_y):
+                events.append((engine.HIT, engine.LEFT))
+                match.hits.append(ball)
+            elif ball.x + ball.width > right.x and ball.collide(right, prev_x, prev_y):
+                events.append((engine.HIT, engine.RIGHT))
+                match.hits.append(ball)
+            elif result is not None:
+                scorer = match.left if result == engine.LEFT else match.right
+                scorer.score += 1
+                events.append((engine.SCORE, result))
+                match.serve_ball(k)
+                if scorer.score >= match.points_to_win:
+                    match.winner = result
+                    events.append((engine.GAME_OVER, result))
+                break
+        if match.over:
+            break
+
+    balls = match.balls
+    count = len(balls)
+    x = np.fromiter([ball.x for ball in balls], np.float64, count)
+    y = np.fromiter([ball.y for ball in balls], np.float64, count)
+    size = np.fromiter([ball.width for ball in balls], np.float64, count)
+    i, j = match.grid.pairs(x, y, size)
+    # Narrow phase in one go; only the few pairs that overlap get bounced
+    half = size / 2
+    nx = x[j] + half[j] - x[i] - half[i]
+    ny = y[j] + half[j] - y[i] - half[i]
+    touching = nx * nx + ny * ny < (half[i] + half[j]) ** 2
+    for a, b in zip(i[touching].tolist(), j[touching].tolist()):
+        if collide_balls(balls[a], balls[b], match.height):
+            events.append((BOUNCE, None))
+
+    match.tick += 1
+    return events
+
+
+def collide_balls(a, b, height):
+    """ Elastic bounce between two overlapping balls, mass by area; True if they bounced. """
+    ra, rb = a.width / 2, b.width / 2
+    nx = b.x + rb - a.x - ra
+    ny = b.y + rb - a.y - ra
+    reach = ra + rb
+    distance_sq = nx * nx + ny * ny
+    if distance_sq >= reach * reach:
+        return False
+    distance = math.sqrt(distance_sq)
+    if distance == 0:
+        nx, ny, distance = 1.0, 0.0, 1.0
+    nx /= distance
+    ny /= distance
+
+    # Push apart along the normal so they don't stay stuck together
+    ma, mb = ra * ra, rb * rb
+    overlap = reach - distance
+    a.x -= nx * overlap * mb / (ma + mb)
+    a.y -= ny * overlap * mb / (ma + mb)
+    b.x += nx * overlap * ma / (ma + mb)
+    b.y += ny * overlap * ma / (ma + mb)
+    for ball in (a, b):
+        ball.y = max(0, min(ball.y, height - ball.height))
+
+    approach = (a.dx - b.dx) * nx + (a.dy - b.dy) * ny
+    if approach <= 0:
+        return False  # already separating
+    impulse = 2 * approach / (ma + mb)
+    a.dx -= impulse * mb * nx
+    a.dy -= impulse * mb * ny
+    b.dx += impulse * ma * nx
+    b.dy += impulse * ma * ny
+    for ball in (a, b):
+        _limit(ball)
+    return True
+
+
+def _limit(ball):
+    speed = math.hypot(ball.dx, ball.dy)
+    if speed > engine.MAX_BALL_SPEED:
+        ball.dx *= engine.MAX_BALL_SPEED / speed
+        ball.dy *= engine.MAX_BALL_SPEED / speed
+    if abs(ball.dx) < MIN_DX:
+        ball.dx = MIN_DX if ball.dx >= 0 else -MIN_DX
+    ball.speed = min(math.hypot(ball.dx, ball.dy), engine.MAX_BALL_SPEED)
+    ball.version += 1
+
+
+def court(count, density_balls=DENSITY_BALLS):
+    """ A court holding count balls as densely as density_balls fill the full-size one. """
+    scale = math.sqrt(count / density_balls)
+    return round(COURT[0] * scale), round(COURT[1] * scale)
+
+
+def time_ticks(count, ticks, size=COURT, broad=None, seed=0):
+    """ (seconds per tick, candidate pairs per tick) for count balls on a court of size. """
+    match = MultiBallMatch(size[0], size[1], points_to_win=10 ** 9, seed=seed, left_ai=engine.HARD,
+                           right_ai=engine.HARD, balls=count)
+    if broad is not None:
+        match.grid.pairs = broad
+    for _ in range(10):  # let the serve pile-up spread out
+        step(match)
+    candidates = 0
+    start = time.perf_counter()
+    for _ in range(ticks):
+        step(match)
+        candidates += match.grid.candidates if broad is None else count * (count - 1) // 2
+    return (time.perf_counter() - start) / ticks, candidates / ticks
+
+
+def bench(counts, ticks, naive_limit, fixed=False, seed=0):
+    """ Per-tick physics time for each ball count, with the spatial hash and all-pairs.
+
+    The court grows with the ball count unless fixed, so every count sees
+    the same crowding and a linear broad phase shows a flat cost per ball.
+    """
+    rows = []
+    for count in counts:
+        size = COURT if fixed else court(count)
+        row = {"balls": count, "court": size}
+        row["grid"], row["grid_pairs"] = time_ticks(count, ticks, size, seed=seed)
+        if count <= naive_limit:
+            row["all_pairs"], row["all_pairs_pairs"] = time_ticks(count, ticks, size, all_pairs, seed)
+        rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-ball physics scaling benchmark")
+    parser.add_argument("--balls", type=int, nargs="+", default=[50, 100, 200, 500, 1000])
+    parser.add_argument("--ticks", type=int, default=200)
+    parser.add_argument("--naive-limit", type=int, default=500, help="largest count to also time all-pairs at")
+    parser.add_argument("--fixed-court", action="store_true",
+                        help="keep every count on the full-size court instead of scaling it to constant density")
+    args = parser.parse_args()
+
+    rows = bench(args.balls, args.ticks, args.naive_limit, args.fixed_court)
+    print(f"{'balls':>6}{'court':>11}{'tick ms':>9}{'us/ball':>9}{'pairs':>8}{'all-pairs ms':>14}{'pairs':>9}")
+    for row in rows:
+        naive = f"{row['all_pairs'] * 1000:14.2f}{row['all_pairs_pairs']:9.0f}" if "all_pairs" in row else ""
+        print(f"{row['balls']:>6}{'%dx%d' % row['court']:>11}{row['grid'] * 1000:9.2f}"
+              f"{row['grid'] / row['balls'] * 1e6:9.2f}{row['grid_pairs']:8.0f}{naive}")
+    first, last = rows[0], rows[-1]
+    growth = (last["grid"] / last["balls"]) / (first["grid"] / first["balls"])
+    print(f"cost per ball grows {growth:.2f}x from {first['balls']} to {last['balls']} balls (1.00x is linear)")
+
+    budget = engine.DT * 1000
+    seconds, _ = time_ticks(DENSITY_BALLS, args.ticks)
+    verdict = "within" if seconds * 1000 <= budget else "over"
+    print(f"{DENSITY_BALLS} balls on the {COURT[0]}x{COURT[1]} court: {seconds * 1000:.2f} ms per tick, "
+          f"{verdict} the {budget:.1f} ms frame budget at {engine.TICK_RATE} Hz")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,549 @@
+"""Networked two-player mode over UDP.
+
+The host runs the only simulation: its player has the left paddle and the
+client's inputs drive the right one. Every tick the host sends a snapshot
+of the match; the client never simulates the ball, it renders it
+INTERP_DELAY behind the newest snapshot, interpolating between the two it
+is between, so late and lost packets don't show. The client's own paddle
+is predicted: each input is applied locally as soon as it is pressed and
+sent to the host, and when a snapshot says which input the host has
+applied so far, the paddle is reset to the host's position and the inputs
+after that one are replayed on top.
+
+Snapshots are delta-compressed against the newest one the client has
+acknowledged: a field mask says which fields changed, and only those are
+sent. Inputs repeat the last INPUT_REDUNDANCY ticks, so a lost packet is
+covered by the next one.
+
+Sockets are served by an asyncio loop on its own thread, so the render
+loop never waits on the network. Link can delay, jitter and drop outgoing
+packets to simulate a bad connection, and
+
+    python netplay.py selftest --rtt 100 --jitter 20 --loss 0.05
+
+plays a bot on each side over localhost and reports frame times, bandwidth,
+mispredictions and interpolation error.
+"""
+import argparse
+import asyncio
+import bisect
+import random
+import struct
+import threading
+import time
+from collections import deque
+
+import engine
+
+PORT = 50007
+JOIN, WELCOME, INPUT, SNAPSHOT, REDIRECT, FULL = range(6)
+
+SCALE = 8  # positions travel as 1/8 px fixed point
+INPUT_REDUNDANCY = 8
+HISTORY = 128  # snapshots kept as delta baselines
+MAX_INPUT_LEAD = 6  # inputs the host buffers before it skips ahead
+INTERP_DELAY = 0.1  # seconds the client renders behind the newest snapshot
+JOIN_RETRY = 0.25
+FULL_RETRY = 2.0  # seconds before joining again after a FULL
+PEER_TIMEOUT = 5.0  # seconds of silence before the host lets someone else join in the peer's place
+KEEPALIVE = 1.0  # a connected client that sent nothing for this long repeats its JOIN
+SERVE_JUMP = 100  # px; a bigger ball move between snapshots is a serve, not motion
+
+# type, snapshot number, snapshots back to the baseline (0 = keyframe),
+# last input applied, field mask
+_HEADER = struct.Struct("<BIBIH")
+_FIELDS = [struct.Struct("<" + fmt) for fmt in ("h", "h", "h", "h", "B", "B", "B", "b", "B")]
+BALL_X, BALL_Y, LEFT_Y, RIGHT_Y, LEFT_SCORE, RIGHT_SCORE, BALL_SIZE, WINNER, HITS = range(len(_FIELDS))
+_INPUT = struct.Struct("<BIIB")  # type, newest snapshot received, newest input sequence, count
+_WELCOME = struct.Struct("<BHH")  # type, width, height
+_REDIRECT = struct.Struct("<BH")  # type, port to join instead
+_WINNERS = {None: -1, engine.LEFT: 0, engine.RIGHT: 1}
+_KEYFRAME = (1 << len(_FIELDS)) - 1  # field mask of a snapshot sent without a baseline
+
+
+def snapshot_state(match, hits):
+    return (round(match.ball.x * SCALE), round(match.ball.y * SCALE),
+            round(match.left.y * SCALE), round(match.right.y * SCALE),
+            match.left.score, match.right.score, match.ball.width, _WINNERS[match.winner], hits & 0xFF)
+
+
+def redirect(port):
+    """ Packet telling a joining client to join on another port instead. """
+    return _REDIRECT.pack(REDIRECT, port)
+
+
+def refuse():
+    """ Packet telling a joining client the server has no room for it right now. """
+    return bytes([FULL])
+
+
+def encode(number, state, ack, baseline=None):
+    """ Snapshot packet; with a (number, state) baseline only changed fields are sent. """
+    mask = 0
+    body = []
+    for i, value in enumerate(state):
+        if baseline is None or baseline[1][i] != value:
+            mask |= 1 << i
+            body.append(_FIELDS[i].pack(value))
+    back = 0 if baseline is None else number - baseline[0]
+    return _HEADER.pack(SNAPSHOT, number, back, ack, mask) + b"".join(body)
+
+
+def decode(data, baselines):
+    """ (number, state, ack), or None if the packet is malformed or its baseline is unknown. """
+    if len(data) < _HEADER.size:
+        return None
+    _, number, back, ack, mask = _HEADER.unpack_from(data)
+    if len(data) != _HEADER.size + sum(field.size for i, field in enumerate(_FIELDS) if mask & 1 << i):
+        return None
+    baseline = None
+    if back:
+        baseline = baselines.get(number - back)
+        if baseline is None:
+            return None
+    elif mask != _KEYFRAME:
+        return None
+    offset = _HEADER.size
+    state = []
+    for i, field in enumerate(_FIELDS):
+        if mask & 1 << i:
+            state.append(field.unpack_from(data, offset)[0])
+            offset += field.size
+        else:
+            state.append(baseline[i])
+    return number, tuple(state), ack
+
+
+class Link(asyncio.DatagramProtocol):
+    """ A UDP socket on an asyncio loop in a background thread.
+
+    send() may be called from any thread; received datagrams queue up until
+    receive() drains them. lag (seconds), jitter (extra random seconds) and
+    loss (probability) are applied to outgoing packets.
+    """
+
+    def __init__(self, port=0, lag=0.0, jitter=0.0, loss=0.0, seed=None):
+        self.lag = lag
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.queue = deque()
+        self.sent = self.received = self.dropped = self.bytes_sent = 0
+        self.error = None
+
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(port, ready), daemon=True)
+        self.thread.start()
+        ready.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self, port, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.transport, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(lambda: self, local_addr=("0.0.0.0", port)))
+        except OSError as e:
+            self.error = e
+            ready.set()
+            return
+        self.port = self.transport.get_extra_info("sockname")[1]
+        ready.set()
+        self.loop.run_forever()
+        self.transport.close()
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        self.queue.append((data, addr))
+
+    def send(self, data, addr):
+        self.loop.call_soon_threadsafe(self._send, data, addr)
+
+    def _send(self, data, addr):
+        if self.loss and self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        self.sent += 1
+        self.bytes_sent += len(data)
+        delay = self.lag + self.rng.random() * self.jitter
+        if delay > 0:
+            self.loop.call_later(delay, self.transport.sendto, data, addr)
+        else:
+            self.transport.sendto(data, addr)
+
+    def receive(self):
+        while self.queue:
+            yield self.queue.popleft()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(1.0)
+
+    def stats(self):
+        return {"sent": self.sent, "received": self.received, "dropped": self.dropped,
+                "bytes_sent": self.bytes_sent}
+
+
+class Host:
+    """ Authoritative peer: feeds the client's inputs into the match and publishes snapshots. """
+
+    def __init__(self, link, width, height):
+        self.link = link
+        self.width = width
+        self.height = height
+        self.peer = None
+        self.heard = 0.0  # when the peer last sent anything
+        self.number = 0
+        self.history = {}
+        self.hits = 0
+        self.keyframes = self.deltas = self.snapshot_bytes = 0
+        self._reset_inputs()
+
+    def _reset_inputs(self):
+        self.pending = {}
+        self.next_input = None
+        self.newest_input = 0
+        self.bits = 0
+        self.acked = None
+
+    @property
+    def connected(self):
+        return self.peer is not None
+
+    def poll(self, match=None):
+        for data, addr in self.link.receive():
+            self.handle(data, addr)
+
+    def handle(self, data, addr):
+        if not data:
+            return  # stray datagram; anything can arrive on an open port
+        now = time.perf_counter()
+        if addr == self.peer:
+            self.heard = now
+        if data[0] == JOIN:
+            if addr != self.peer:
+                # Only take over a seat that is empty or has gone quiet
+                if self.peer is not None and now - self.heard < PEER_TIMEOUT:
+                    return
+                self.peer = addr
+                self.heard = now
+                self._reset_inputs()
+            self.link.send(_WELCOME.pack(WELCOME, self.width, self.height), addr)
+        elif data[0] == INPUT and addr == self.peer:
+            self._input(data)
+
+    def _input(self, data):
+        if len(data) < _INPUT.size:
+            return
+        _, ack, newest, count = _INPUT.unpack_from(data)
+        if len(data) != _INPUT.size + count or not 0 < count <= newest:
+            return
+        if ack and (self.acked is None or ack > self.acked):
+            self.acked = ack
+        first = newest - count + 1
+        if self.next_input is None:
+            self.next_input = first
+        for i, bits in enumerate(data[_INPUT.size:_INPUT.size + count]):
+            if first + i >= self.next_input:
+                self.pending[first + i] = bits
+        self.newest_input = max(self.newest_input, newest)
+
+    def remote_input(self):
+        """ The client's bits for this tick, or its last bits again if they have not arrived. """
+        if self.next_input is None:
+            return 0
+        if self.newest_input - self.next_input > MAX_INPUT_LEAD:
+            # The client's clock runs ahead of ours; skip rather than lag further behind
+            for seq in range(self.next_input, self.newest_input - 2):
+                self.pending.pop(seq, None)
+            self.next_input = self.newest_input - 2
+        if self.next_input in self.pending:
+            self.bits = self.pending.pop(self.next_input)
+            self.next_input += 1
+        elif self.next_input < self.newest_input:
+            self.next_input += 1  # lost for good, later inputs already arrived
+        return self.bits
+
+    def publish(self, match, events=()):
+        """ Send the state after this tick, against the newest snapshot the client has. """
+        self.hits += sum(1 for kind, side in events if kind == engine.HIT)
+        self.number += 1
+        state = snapshot_state(match, self.hits)
+        self.history[self.number] = state
+        self.history.pop(self.number - HISTORY, None)
+        if self.peer is None:
+            return
+
+        baseline = None
+        if self.acked is not None and self.acked in self.history:
+            baseline = (self.acked, self.history[self.acked])
+        ack = 0 if self.next_input is None else self.next_input - 1
+        packet = encode(self.number, state, ack, baseline)
+        if baseline is None:
+            self.keyframes += 1
+        else:
+            self.deltas += 1
+        self.snapshot_bytes += len(packet)
+        self.link.send(packet, self.peer)
+
+    def stats(self):
+        sent = self.keyframes + self.deltas
+        return {"keyframes": self.keyframes, "deltas": self.deltas,
+                "bytes_per_snapshot": self.snapshot_bytes / sent if sent else 0.0}
+
+
+class Client:
+    """ Remote peer: predicts its own (right) paddle and interpolates everything else. """
+
+    def __init__(self, link, address):
+        self.link = link
+        self.address = address
+        self.size = None
+        self.baselines = {}
+        self.numbers = []  # received snapshot numbers in order, for interpolation
+        self.states = {}
+        self.newest = 0
+        self.ack = 0
+        self.seq = 0
+        self.history = deque(maxlen=256)  # (seq, bits) the host has not applied yet
+        self.render_number = None
+        self.rendered = None
+        self.received = self.mispredictions = self.underruns = 0
+        self.full = False  # the server turned the last JOIN away
+        self._last_join = None
+        self._last_sent = 0.0
+
+    @property
+    def connected(self):
+        return self.size is not None
+
+    def poll(self, match=None, height=None):
+        """ Handle packets; with a match, reconcile its right paddle with the newest snapshot. """
+        now = time.perf_counter()
+        if self.size is None and (self._last_join is None or now - self._last_join > JOIN_RETRY):
+            self.link.send(bytes([JOIN]), self.address)
+            self._last_join = self._last_sent = now
+        elif self.size is not None and now - self._last_sent > KEEPALIVE:
+            # Keeps our seat while menus and the game-over screen send no inputs
+            self.link.send(bytes([JOIN]), self.address)
+            self._last_sent = now
+
+        newest = self.newest
+        for data, addr in self.link.receive():
+            if not data:
+                continue
+            if data[0] == WELCOME and len(data) == _WELCOME.size:
+                self.size = _WELCOME.unpack(data)[1:]
+                self.full = False
+            elif data[0] == REDIRECT and len(data) == _REDIRECT.size and self.size is None:
+                # A match server hands us to the worker that runs our room
+                self.address = (self.address[0], _REDIRECT.unpack(data)[1])
+                self._last_join = None
+                self.full = False
+            elif data[0] == FULL and self.size is None:
+                self.full = True
+                self._last_join = now + FULL_RETRY - JOIN_RETRY
+            elif data[0] == SNAPSHOT:
+                self._snapshot(data)
+        if match is not None and self.newest != newest:
+            self._reconcile(match.right, match.height if height is None else height)
+
+    def _snapshot(self, data):
+        decoded = decode(data, self.baselines)
+        if decoded is None:
+            return
+        number, state, ack = decoded
+        if number in self.states:
+            return
+        self.received += 1
+        self.baselines[number] = state
+        if len(self.baselines) > HISTORY:
+            # Evict the whole tail: the snapshot exactly HISTORY back may never have arrived
+            cutoff = max(number, self.newest) - HISTORY
+            for old in [n for n in self.baselines if n <= cutoff]:
+                del self.baselines[old]
+        self.states[number] = state
+        bisect.insort(self.numbers, number)
+        while len(self.numbers) > HISTORY:
+            del self.states[self.numbers.pop(0)]
+        if number > self.newest:
+            self.newest = number
+            self.ack = ack
+
+    def _reconcile(self, paddle, height):
+        while self.history and self.history[0][0] <= self.ack:
+            self.history.popleft()
+        predicted = paddle.y
+        paddle.y = self.states[self.newest][RIGHT_Y] / SCALE
+        for seq, bits in self.history:
+            paddle.move(bits, height)
+        if abs(paddle.y - predicted) > 0.5:
+            self.mispredictions += 1
+
+    def predict(self, paddle, bits, height):
+        """ Apply this tick's input locally right away and send it to the host. """
+        self.seq += 1
+        self.history.append((self.seq, bits))
+        paddle.move(bits, height)
+        recent = list(self.history)[-INPUT_REDUNDANCY:]
+        packet = _INPUT.pack(INPUT, self.newest, self.seq, len(recent)) + bytes(b for _, b in recent)
+        self.link.send(packet, self.address)
+        self._last_sent = time.perf_counter()
+
+    def render(self, match, frame_time):
+        """ Move the ball and the host's paddle to the interpolated state; returns new paddle hits. """
+        if not self.numbers:
+            return 0
+        target = self.newest - INTERP_DELAY * engine.TICK_RATE
+        if self.render_number is None or abs(self.render_number - target) > engine.TICK_RATE / 2:
+            self.render_number = target  # first snapshot, or after a long stall
+        else:
+            # Drift towards the target instead of jumping, so jitter doesn't stutter
+            rate = 1 + max(-0.1, min(0.05 * (target - self.render_number), 0.1))
+            self.render_number += frame_time * engine.TICK_RATE * rate
+
+        i = bisect.bisect_right(self.numbers, self.render_number)
+        if i == len(self.numbers):
+            self.underruns += 1
+            a = b = self.states[self.numbers[-1]]
+            t = 0.0
+        elif i == 0:
+            a = b = self.states[self.numbers[0]]
+            t = 0.0
+        else:
+            before, after = self.numbers[i - 1], self.numbers[i]
+            a, b = self.states[before], self.states[after]
+            t = (self.render_number - before) / (after - before)
+
+        ball_x = a[BALL_X] + (b[BALL_X] - a[BALL_X]) * t
+        ball_y = a[BALL_Y] + (b[BALL_Y] - a[BALL_Y]) * t
+        if abs(b[BALL_X] - a[BALL_X]) > SERVE_JUMP * SCALE or a[LEFT_SCORE:RIGHT_SCORE + 1] != b[LEFT_SCORE:RIGHT_SCORE + 1]:
+            ball_x, ball_y = a[BALL_X], a[BALL_Y]
+        match.ball.x, match.ball.y = ball_x / SCALE, ball_y / SCALE
+        match.ball.width = match.ball.height = a[BALL_SIZE]
+        match.left.y = (a[LEFT_Y] + (b[LEFT_Y] - a[LEFT_Y]) * t) / SCALE
+        match.left.score, match.right.score = a[LEFT_SCORE], a[RIGHT_SCORE]
+        match.winner = (None, engine.LEFT, engine.RIGHT)[a[WINNER] + 1]
+        for body in (match.ball, match.left, match.right):
+            body.remember()
+
+        hits = 0 if self.rendered is None else (a[HITS] - self.rendered[HITS]) & 0xFF
+        self.rendered = a
+        return hits
+
+    def stats(self):
+        return {"snapshots": self.received, "mispredictions": self.mispredictions,
+                "underruns": self.underruns, "pending_inputs": len(self.history)}
+
+
+def link_from_env(environ, port=0, seed=None):
+    """ Link with the simulator settings PINGPONG_NET_RTT/JITTER (ms) and PINGPONG_NET_LOSS. """
+    rtt = float(environ.get("PINGPONG_NET_RTT", "0")) / 1000
+    jitter = float(environ.get("PINGPONG_NET_JITTER", "0")) / 1000
+    loss = float(environ.get("PINGPONG_NET_LOSS", "0"))
+    # Each peer delays its own packets, so half the round trip each way
+    return Link(port, rtt / 2, jitter, loss, seed)
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return (host or "127.0.0.1", int(port) if port else PORT)
+
+
+def selftest(seconds, rtt, jitter, loss, seed=1):
+    """ Host and client bots over localhost at 90 FPS; returns a dict of results. """
+    lag = rtt / 2000
+    host_link = Link(0, lag, jitter / 1000, loss, seed)
+    client_link = Link(0, lag, jitter / 1000, loss, seed + 1)
+    try:
+        return _selftest(host_link, client_link, seconds)
+    finally:
+        host_link.close()
+        client_link.close()
+
+
+def _selftest(host_link, client_link, seconds):
+    match = engine.Match(seed=1, points_to_win=10 ** 9, left_ai=engine.HARD)
+    host = Host(host_link, match.width, match.height)
+    client = Client(client_link, ("127.0.0.1", host_link.port))
+    view = engine.Match(match.width, match.height)
+    host_stepper = engine.FixedStep()
+    client_stepper = engine.FixedStep()
+
+    truth = {}  # snapshot number: host ball position, to measure interpolation error
+    errors = []
+    work = []
+    frame = 1.0 / engine.TICK_RATE
+    start = next_frame = previous = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        began = time.perf_counter()
+        frame_time, previous = began - previous, began
+
+        host.poll()
+        for _ in range(host_stepper.advance(frame_time)):
+            events = engine.step(match, (0, host.remote_input()))
+            host.publish(match, events)
+            truth[host.number] = (match.ball.x, match.ball.y)
+            truth.pop(host.number - 4 * HISTORY, None)
+
+        client.poll(view)
+        for _ in range(client_stepper.advance(frame_time)):
+            # The client bot chases the ball it sees
+            gap = view.ball.centery - view.right.centery
+            bits = engine.DOWN if gap > 10 else engine.UP if gap < -10 else 0
+            client.predict(view.right, bits, view.height)
+        client.render(view, frame_time)
+
+        if client.render_number is not None and client.render_number >= 1:
+            n = int(client.render_number)
+            if n in truth and n + 1 in truth:
+                f = client.render_number - n
+                x = truth[n][0] + (truth[n + 1][0] - truth[n][0]) * f
+                y = truth[n][1] + (truth[n + 1][1] - truth[n][1]) * f
+                if abs(truth[n + 1][0] - truth[n][0]) < SERVE_JUMP:
+                    errors.append(((view.ball.x - x) ** 2 + (view.ball.y - y) ** 2) ** 0.5)
+
+        work.append(time.perf_counter() - began)
+        next_frame += frame
+        delay = next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_frame = time.perf_counter()
+
+    work.sort()
+    errors.sort()
+    frames = len(work)
+    return {
+        "frames": frames,
+        "fps": frames / seconds,
+        "frame_work_p50_ms": work[frames // 2] * 1000,
+        "frame_work_p99_ms": work[int(frames * 0.99)] * 1000,
+        "host": host.stats(),
+        "client": client.stats(),
+        "ball_error_p50_px": errors[len(errors) // 2] if errors else 0.0,
+        "ball_error_p95_px": errors[int(len(errors) * 0.95)] if errors else 0.0,
+        "host_link": host_link.stats(),
+        "client_link": client_link.stats(),
+        "score": (match.left.score, match.right.score),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Networked play tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    test = commands.add_parser("selftest", help="bot vs bot over localhost through the simulator")
+    test.add_argument("--seconds", type=float, default=10)
+    test.add_argument("--rtt", type=float, default=100, help="simulated round trip, ms")
+    test.add_argument("--jitter", type=float, default=20, help="extra random delay per packet, ms")
+    test.add_argument("--loss", type=float, default=0.02, help="packet loss probability")
+    args = parser.parse_args()
+
+    results = selftest(args.seconds, args.rtt, args.jitter, args.loss)
+    for key, value in results.items():
+        print(f"{key:<20}{value}")
+
+
+if __name__ == "__main__":
+    main()
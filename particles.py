@@ -0,0 +1,284 @@
+"""Pooled particle effects: victory bursts, paddle-hit sparks, ball trails.
+
+Every particle lives in preallocated structure-of-arrays NumPy buffers
+(position, velocity, age, lifetime, color, gravity). Live particles are
+packed at the front, so emitting fills a slice, update() is a handful of
+array operations over all of them, and dead ones are dropped by compacting
+in place. Every intermediate lives in scratch buffers allocated up front
+too, so a frame creates no arrays for the garbage collector or the
+allocator to deal with.
+
+Drawing blends each particle's color with the background by its remaining
+life, then writes all of them into the surface pixels in one batch per
+stamp offset. A blit per particle costs about a microsecond in pygame,
+which at 10k particles is more than a whole 90 FPS frame.
+
+    python particles.py --particles 10000
+"""
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+import pygame
+
+CAPACITY = 16384
+SIZE = 2  # particles are SIZE x SIZE pixel squares
+
+_FIELDS = ("x", "y", "vx", "vy", "age", "life", "gravity", "color")
+
+
+class Particles:
+    def __init__(self, capacity=CAPACITY, size=SIZE, seed=None):
+        self.capacity = capacity
+        self.size = size
+        self.x = np.zeros(capacity, dtype=np.float32)
+        self.y = np.zeros(capacity, dtype=np.float32)
+        self.vx = np.zeros(capacity, dtype=np.float32)
+        self.vy = np.zeros(capacity, dtype=np.float32)
+        self.age = np.zeros(capacity, dtype=np.float32)
+        self.life = np.ones(capacity, dtype=np.float32)
+        self.gravity = np.zeros(capacity, dtype=np.float32)
+        self.color = np.zeros((capacity, 3), dtype=np.float32)
+        self.count = 0
+        self.dropped = 0  # emits that didn't fit
+        self.rng = np.random.default_rng(seed)
+
+        # Scratch space for every intermediate, so frames allocate no arrays
+        self._float = np.zeros(capacity, dtype=np.float32)
+        self._color = np.zeros((capacity, 3), dtype=np.float32)
+        self._fade = np.zeros(capacity, dtype=np.float32)
+        self._visible_fade = np.zeros(capacity, dtype=np.float32)
+        self._value = np.zeros(capacity, dtype=np.float32)
+        self._delta = np.zeros(capacity, dtype=np.float32)
+        self._mask = np.zeros(capacity, dtype=bool)
+        self._test = np.zeros(capacity, dtype=bool)
+        self._ix = np.zeros(capacity, dtype=np.intp)
+        self._iy = np.zeros(capacity, dtype=np.intp)
+        self._index = np.zeros(capacity, dtype=np.intp)
+        self._visible_index = np.zeros(capacity, dtype=np.intp)
+        self._slot = np.zeros(capacity, dtype=np.intp)
+        self._kept_index = np.zeros(capacity + 1, dtype=np.intp)  # last slot takes the dropped
+        self._arange = np.arange(capacity)
+        self._corner = np.zeros(capacity, dtype=np.intp)
+        self._background = np.zeros(capacity, dtype=np.uint32)
+        self._channel = np.zeros(capacity, dtype=np.uint32)
+        self._packed = np.zeros(capacity, dtype=np.uint32)
+
+    def clear(self):
+        self.count = 0
+
+    def emit(self, count, x, y, speed, life, color, angle=0.0, spread=math.pi, gravity=0.0):
+        """ count particles from (x, y), heading angle +- spread radians.
+
+        speed is in pixels per second and life in seconds; each particle
+        gets a random share of both so a burst doesn't move as a ring.
+        """
+        n = min(count, self.capacity - self.count)
+        self.dropped += count - n
+        if n <= 0:
+            return
+        s = slice(self.count, self.count + n)
+        share = self._float[:n]
+        self.rng.random(dtype=np.float32, out=share)
+        share *= 2 * spread
+        share += angle - spread
+        np.cos(share, out=self.vx[s])
+        np.sin(share, out=self.vy[s])
+        self.rng.random(dtype=np.float32, out=share)
+        share *= 0.7 * speed
+        share += 0.3 * speed
+        self.vx[s] *= share
+        self.vy[s] *= share
+        self.rng.random(dtype=np.float32, out=share)
+        share *= 0.4 * life
+        share += 0.6 * life
+        self.life[s] = share
+        self.x[s] = x
+        self.y[s] = y
+        self.age[s] = 0
+        self.gravity[s] = gravity
+        self.color[s] = color
+        self.count += n
+
+    def update(self, dt):
+        n = self.count
+        if not n:
+            return
+        step = self._float[:n]
+        np.multiply(self.gravity[:n], dt, out=step)
+        self.vy[:n] += step
+        np.multiply(self.vx[:n], dt, out=step)
+        self.x[:n] += step
+        np.multiply(self.vy[:n], dt, out=step)
+        self.y[:n] += step
+        self.age[:n] += dt
+
+        alive = np.less(self.age[:n], self.life[:n], out=self._mask[:n])
+        if not alive.all():
+            kept = self._kept(alive)
+            for name in _FIELDS:
+                field = getattr(self, name)
+                spare = self._color if field.ndim == 2 else self._float
+                np.take(field[:n], kept, axis=0, out=spare[:len(kept)], mode="clip")
+                field[:len(kept)] = spare[:len(kept)]
+            self.count = len(kept)
+
+    def _kept(self, mask):
+        """ Indices of mask's True entries, in order, in scratch space. """
+        # np.compress and np.flatnonzero allocate these every call
+        n = len(mask)
+        slot = self._slot[:n]
+        np.copyto(slot, mask)
+        np.cumsum(slot, out=slot)
+        kept = int(slot[-1])
+        slot -= 1
+        dropped = np.logical_not(mask, out=self._test[:n])
+        np.copyto(slot, self.capacity, where=dropped)
+        np.put(self._kept_index, slot, self._arange[:n], mode="clip")
+        return self._kept_index[:kept]
+
+    def draw(self, surface):
+        """ Blend every live particle into surface; returns the rect drawn over, or None. """
+        n = self.count
+        if not n:
+            return None
+        if surface.get_bytesize() != 4:
+            return self._draw_each(surface)  # the batched writes below assume 32-bit pixels
+        width, height = surface.get_size()
+        pitch = surface.get_pitch() // 4
+        size = self.size
+        x, y = self._ix[:n], self._iy[:n]
+        np.copyto(x, self.x[:n], casting="unsafe")
+        np.copyto(y, self.y[:n], casting="unsafe")
+        on, test = self._mask[:n], self._test[:n]
+        np.greater_equal(x, 0, out=on)
+        on &= np.less_equal(x, width - size, out=test)
+        on &= np.greater_equal(y, 0, out=test)
+        on &= np.less_equal(y, height - size, out=test)
+
+        # Offsets of each particle's corner in the surface's pixel buffer
+        index = np.multiply(y, pitch, out=self._index[:n])
+        index += x
+        fade = np.divide(self.age[:n], self.life[:n], out=self._fade[:n])
+        np.subtract(1, fade, out=fade)
+        color = self.color[:n]
+        visible = n
+        if not on.all():
+            kept = self._kept(on)
+            visible = len(kept)
+            if not visible:
+                return None
+            index = np.take(index, kept, out=self._visible_index[:visible], mode="clip")
+            fade = np.take(fade, kept, out=self._visible_fade[:visible], mode="clip")
+            color = np.take(color, kept, axis=0, out=self._color[:visible], mode="clip")
+        left, top = int(x.min(where=on, initial=width)), int(y.min(where=on, initial=height))
+        right, bottom = int(x.max(where=on, initial=0)), int(y.max(where=on, initial=0))
+
+        # Blend against the background under each particle's corner once,
+        # then stamp the packed pixel into the whole square
+        shifts, masks = surface.get_shifts(), surface.get_masks()
+        background, channel = self._background[:visible], self._channel[:visible]
+        packed, value, delta = self._packed[:visible], self._value[:visible], self._delta[:visible]
+        buffer = surface.get_buffer()  # locks the surface until released
+        try:
+            pixels = np.frombuffer(buffer, dtype=np.uint32)
+            np.take(pixels, index, out=background, mode="clip")
+            packed.fill(masks[3])
+            for c in range(3):
+                np.right_shift(background, shifts[c], out=channel)
+                channel &= 0xFF
+                np.copyto(value, channel, casting="unsafe")
+                np.subtract(color[:, c], value, out=delta)
+                delta *= fade
+                value += delta
+                np.copyto(channel, value, casting="unsafe")
+                channel <<= shifts[c]
+                packed |= channel
+            corner = self._corner[:visible]
+            for dx in range(size):
+                for dy in range(size):
+                    np.add(index, dy * pitch + dx, out=corner)
+                    np.put(pixels, corner, packed, mode="clip")
+        finally:
+            del pixels, buffer
+        return pygame.Rect(left, top, right - left + size, bottom - top + size)
+
+    def _draw_each(self, surface):
+        """ draw() for 8, 16 and 24-bit surfaces: a read and a fill per particle. """
+        width, height = surface.get_size()
+        size = self.size
+        drawn = None
+        for i in range(self.count):
+            x, y = int(self.x[i]), int(self.y[i])
+            if not (0 <= x <= width - size and 0 <= y <= height - size):
+                continue
+            fade = 1 - self.age[i] / self.life[i]
+            background = surface.get_at((x, y))
+            color = [int(b + (c - b) * fade) for b, c in zip(background[:3], self.color[i])]
+            rect = surface.fill(color, (x, y, size, size))
+            drawn = rect if drawn is None else drawn.union(rect)
+        return drawn
+
+    def stats(self):
+        return {"live": self.count, "capacity": self.capacity, "dropped": self.dropped}
+
+
+def benchmark(particles=10000, seconds=3.0, width=1200, height=800, fps=90):
+    """ Hold a steady particle count on a dummy display; returns per-frame timings. """
+    from profiler import percentile
+
+    screen = pygame.display.set_mode((width, height))
+    background = pygame.Surface((width, height)).convert()
+    background.fill((20, 20, 40))
+    effects = Particles(capacity=max(CAPACITY, particles), seed=1)
+    rng = np.random.default_rng(2)
+    colors = ((255, 255, 50), (255, 150, 50), (50, 255, 50), (255, 50, 50))
+    dt = 1.0 / fps
+    frames, update, draw = [], [], []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        # Top the pool back up with bursts, like a victory screen gone wild
+        while effects.count < particles:
+            effects.emit(min(200, particles - effects.count), rng.uniform(0, width), rng.uniform(0, height / 2),
+                         300, 1.5, colors[rng.integers(len(colors))], gravity=300)
+        screen.blit(background, (0, 0))
+        before = time.perf_counter()
+        effects.update(dt)
+        middle = time.perf_counter()
+        effects.draw(screen)
+        after = time.perf_counter()
+        pygame.display.flip()
+        frames.append(time.perf_counter() - start)
+        update.append(middle - before)
+        draw.append(after - middle)
+
+    def summary(values):
+        return {"p50_ms": percentile(values, 50) * 1000, "p99_ms": percentile(values, 99) * 1000}
+    return {"frames": len(frames), "frame": summary(frames), "update": summary(update), "draw": summary(draw),
+            "budget_ms": 1000 / fps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Particle system benchmark")
+    parser.add_argument("--particles", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--fps", type=int, default=90)
+    args = parser.parse_args()
+
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.display.init()
+    result = benchmark(args.particles, args.seconds, fps=args.fps)
+    for phase in ("update", "draw", "frame"):
+        print(f"{phase:<8}p50 {result[phase]['p50_ms']:6.2f} ms   p99 {result[phase]['p99_ms']:6.2f} ms")
+    worst = result["frame"]["p99_ms"]
+    verdict = "holds" if worst <= result["budget_ms"] else "misses"
+    print(f"{args.particles} particles, {result['frames']} frames: p99 frame {worst:.2f} ms {verdict} "
+          f"the {result['budget_ms']:.1f} ms budget of {args.fps} FPS")
+    raise SystemExit(0 if worst <= result["budget_ms"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Per-frame phase profiler.
+
+The frame loop calls begin_frame() and then mark(phase) after each phase;
+the time since the previous mark is charged to that phase. Durations go
+into rolling windows for percentiles and into a bounded trace that can be
+exported as JSON, CSV or Chrome trace format (chrome://tracing, Perfetto).
+
+When disabled every call returns immediately, so the instrumentation can
+stay in the hot loop. PINGPONG_PROFILE=1 enables it at startup, F3
+toggles it and its on-screen overlay, and PINGPONG_PROFILE_OUT=<file>
+writes an export on quit (.csv, .trace.json or anything else for JSON).
+"""
+import csv
+import json
+import os
+import time
+from collections import deque
+
+WINDOW = 900  # frames of history for percentiles, 10 seconds at 90 FPS
+TRACE_FRAMES = 2700
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class Profiler:
+    def __init__(self, enabled=False, window=WINDOW, trace_frames=TRACE_FRAMES):
+        self.enabled = enabled
+        self.window = window
+        self.samples = {}
+        self.trace = deque(maxlen=trace_frames)
+        self.frame = 0
+        self._frame_start = 0.0
+        self._last = 0.0
+        self._phases = []
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self._phases = []
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._phases:
+            self._record(now)
+        self._frame_start = self._last = now
+        self._phases = []
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self._phases.append((phase, self._last, now - self._last))
+        self._last = now
+
+    def sample(self, name, duration):
+        """ A duration that isn't a frame phase, such as input latency. """
+        if not self.enabled:
+            return
+        window = self.samples.get(name)
+        if window is None:
+            window = self.samples[name] = deque(maxlen=self.window)
+        window.append(duration)
+
+    def _record(self, now):
+        self._phases.append(("frame", self._frame_start, now - self._frame_start))
+        # A phase can run several times in a frame (one physics tick each)
+        totals = {}
+        for phase, start, duration in self._phases:
+            totals[phase] = totals.get(phase, 0.0) + duration
+        for phase, duration in totals.items():
+            self.sample(phase, duration)
+        self.trace.append((self.frame, self._phases))
+        self.frame += 1
+
+    def summary(self):
+        """ {phase: {p50, p95, p99, max} in milliseconds} over the rolling window. """
+        result = {}
+        for phase, window in self.samples.items():
+            values = list(window)
+            result[phase] = {
+                "p50": percentile(values, 50) * 1000,
+                "p95": percentile(values, 95) * 1000,
+                "p99": percentile(values, 99) * 1000,
+                "max": max(values) * 1000,
+                "count": len(values),
+            }
+        return result
+
+    def export(self, path):
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["frame", "phase", "start_ms", "duration_ms"])
+                for frame, phases in self.trace:
+                    for phase, start, duration in phases:
+                        writer.writerow([frame, phase, f"{start * 1000:.4f}", f"{duration * 1000:.4f}"])
+        elif path.endswith(".trace.json"):
+            events = []
+            for frame, phases in self.trace:
+                for phase, start, duration in phases:
+                    events.append({"name": phase, "cat": "frame", "ph": "X", "pid": 1,
+                                   "tid": 0 if phase == "frame" else 1,
+                                   "ts": start * 1e6, "dur": duration * 1e6, "args": {"frame": frame}})
+            with open(path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        else:
+            with open(path, "w") as f:
+                json.dump({"frames": self.frame, "phases": self.summary()}, f, indent=2)
+
+    def overlay_lines(self):
+        lines = []
+        for phase, stats in sorted(self.summary().items(), key=lambda item: item[0] != "frame"):
+            lines.append(f"{phase:<8}{stats['p50']:6.2f}{stats['p95']:6.2f}{stats['p99']:6.2f} ms")
+        return lines
+
+    def export_on_exit(self):
+        path = os.environ.get("PINGPONG_PROFILE_OUT")
+        if path and self.frame:
+            self.export(path)
+
+
+profiler = Profiler(enabled=os.environ.get("PINGPONG_PROFILE", "0") != "0")
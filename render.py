@@ -0,0 +1,205 @@
+"""Offline rendering of recorded matches to numbered image frames.
+
+Frames are drawn by the game's own code (its court background, Paddle.draw,
+Ball.draw and draw_text) on SDL's dummy video driver, then scaled to the
+requested size and written as PNG or raw RGB (width * height * 3 bytes, no
+header). The frame range is cut into chunks and spread over a process
+pool. Each worker loads the frontend once and replays the recording from
+its current position to the start of the next chunk it gets, so chunks
+handed out in order mostly continue where the last one stopped. Frame k
+shows the match at k / fps seconds, interpolated between ticks the same
+way the game interpolates a frame, so any frame rate works.
+
+    python render.py match.pprec frames/ --size 1920x1080 --workers 4
+    python render.py match.pprec frames/ --format raw --fps 30 --start 12 --end 20
+    ffmpeg -framerate 90 -i frames/frame_%06d.png highlight.mp4
+
+Per-worker throughput is printed at the end, to size render boxes.
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+os.environ.setdefault("PINGPONG_HISTORY", "0")
+# Leave SIGTERM alone in the workers, so the pool can shut them down
+os.environ.setdefault("SDL_NO_SIGNAL_HANDLERS", "1")
+
+import numpy as np
+
+import engine
+import replay
+
+CHUNK = 90  # frames per pool task
+# pygame.image.save spends ~20 ms on an 800x600 PNG at libpng's default
+# compression; unfiltered rows at zlib level 1 take ~5 ms for similar files
+PNG_LEVEL = 1
+FORMATS = ("png", "raw")
+# Court size of each frontend; a recording is drawn by the game that made it
+FRONTENDS = {(800, 600): "project.py", (1200, 800): "DJONG ULTIMATE.py"}
+
+_game = None  # the frontend module, loaded once per worker
+_replays = {}  # path: (recording, match, player), continued from chunk to chunk
+_clock_ms = 0
+
+
+def _match_ticks():
+    # Stands in for assets.ticks, so crazy-mode colors follow match time
+    return _clock_ms
+
+
+def _init(frontend):
+    global _game
+    import assets
+    from bench import load_frontend
+    _game = load_frontend(frontend)
+    assets.ticks = _match_ticks
+
+
+def frame_count(recording, fps):
+    return recording.ticks * fps // engine.TICK_RATE + 1
+
+
+def frame_time(frame, fps):
+    """ (tick, alpha) the game would be at after frame / fps seconds. """
+    ticks, alpha = divmod(frame * engine.TICK_RATE, fps)
+    return ticks, alpha / fps
+
+
+def _replay_to(path, tick):
+    """ The worker's replay of path, advanced to tick; restarted if it is already past it. """
+    recording, match, player = _replays.get(path, (None, None, None))
+    if recording is None or match.tick > tick:
+        recording = replay.Recording.load(path) if recording is None else recording
+        match = recording.match(_game.Match)
+        player = replay.Player(recording)
+        _replays[path] = recording, match, player
+    while match.tick < tick and not player.finished(match):
+        engine.step(match, player.inputs(match, (0, 0)))
+    return match, player
+
+
+def draw_frame(match, alpha):
+    """ One game frame on the frontend's screen, as play_frame draws it minus the particles. """
+    global _clock_ms
+    game = _game
+    _clock_ms = int((match.tick + alpha) * 1000 / engine.TICK_RATE)
+    game.crazy_mode = match.crazy
+    game.screen.blit(getattr(game, "court_img", game.pl_img), (0, 0))
+    match.left.draw(game.GREEN, alpha)
+    match.right.draw(game.RED, alpha)
+    match.ball.draw(alpha)
+    game.draw_text(f"{match.left.score}", game.big_font, game.GREEN, game.WIDTH // 4, 50)
+    game.draw_text(f"{match.right.score}", game.big_font, game.RED, 3 * game.WIDTH // 4, 50)
+    return game.screen
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def png_bytes(rgb, width, height, level=PNG_LEVEL):
+    """ An 8-bit RGB PNG of packed rgb pixels. """
+    rows = np.empty((height, 1 + 3 * width), dtype=np.uint8)
+    rows[:, 0] = 0  # filter type None on every row
+    rows[:, 1:] = np.frombuffer(rgb, dtype=np.uint8).reshape(height, 3 * width)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", header) +
+            _png_chunk(b"IDAT", zlib.compress(rows, level)) + _png_chunk(b"IEND", b""))
+
+
+def render_chunk(task):
+    """ Render frames [first, last) to out; returns (pid, frames, seconds, diverged tick or None). """
+    import pygame
+
+    path, out, first, last, fps, size, fmt = task
+    start = time.perf_counter()
+    scaled = None if size == _game.screen.get_size() else pygame.Surface(size, 0, _game.screen)
+    for frame in range(first, last):
+        tick, alpha = frame_time(frame, fps)
+        match, player = _replay_to(path, tick)
+        surface = draw_frame(match, alpha)
+        if scaled is not None:
+            surface = pygame.transform.smoothscale(surface, size, scaled)
+        rgb = pygame.image.tobytes(surface, "RGB")
+        with open(os.path.join(out, f"frame_{frame:06d}.{fmt}"), "wb") as f:
+            f.write(png_bytes(rgb, *size) if fmt == "png" else rgb)
+    return os.getpid(), last - first, time.perf_counter() - start, player.diverged_at
+
+
+def render(path, out, size=None, fps=engine.TICK_RATE, fmt="png", workers=None, start=0.0, end=None,
+           frontend=None):
+    """ Render a recording to out; returns per-worker {pid: [frames, seconds]} and overall stats. """
+    recording = replay.Recording.load(path)
+    court = recording.settings["width"], recording.settings["height"]
+    if frontend is None:
+        if court not in FRONTENDS:
+            raise replay.ReplayError(f"{path}: no frontend draws a {court[0]}x{court[1]} court")
+        frontend = FRONTENDS[court]
+    size = size or court
+    total = frame_count(recording, fps)
+    first = min(total, max(0, math.ceil(start * fps)))
+    last = total if end is None else min(total, math.floor(end * fps) + 1)
+    os.makedirs(out, exist_ok=True)
+    path = os.path.abspath(path)
+    tasks = [(path, out, i, min(i + CHUNK, last), fps, size, fmt) for i in range(first, last, CHUNK)]
+
+    workers = workers or os.cpu_count() or 1
+    per_worker = {}
+    diverged = None
+    began = time.perf_counter()
+    with multiprocessing.Pool(workers, _init, (frontend,)) as pool:
+        # Chunks go out in order, so each worker's replay only ever moves forward
+        for pid, frames, seconds, diverged_at in pool.imap_unordered(render_chunk, tasks):
+            done = per_worker.setdefault(pid, [0, 0.0])
+            done[0] += frames
+            done[1] += seconds
+            if diverged_at is not None:
+                diverged = diverged_at if diverged is None else min(diverged, diverged_at)
+    elapsed = time.perf_counter() - began
+    frames = last - first
+    stats = {"frames": frames, "seconds": elapsed, "workers": workers, "size": size, "fps": fps,
+             "frames_per_second": frames / elapsed if elapsed else 0.0,
+             "realtime": frames / fps / elapsed if elapsed else 0.0, "diverged_at": diverged}
+    return per_worker, stats
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition("x")
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a recorded match to numbered image frames")
+    parser.add_argument("recording")
+    parser.add_argument("out", help="directory for frame_000000.<format> files")
+    parser.add_argument("--size", type=parse_size, help="output WIDTHxHEIGHT (default: the court size)")
+    parser.add_argument("--fps", type=int, default=engine.TICK_RATE)
+    parser.add_argument("--format", choices=FORMATS, default="png")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--start", type=float, default=0.0, help="first second of the match to render")
+    parser.add_argument("--end", type=float, help="last second of the match to render")
+    parser.add_argument("--frontend", choices=sorted(FRONTENDS.values()), help="draw with this game")
+    args = parser.parse_args()
+
+    per_worker, stats = render(args.recording, args.out, args.size, args.fps, args.format, args.workers,
+                               args.start, args.end, args.frontend)
+    for n, (pid, (frames, seconds)) in enumerate(sorted(per_worker.items())):
+        print(f"worker {n} (pid {pid}): {frames} frames in {seconds:.2f}s, {frames / seconds:,.1f} frames/s")
+    width, height = stats["size"]
+    print(f"{stats['frames']} {width}x{height} {args.format} frames in {stats['seconds']:.2f}s on "
+          f"{stats['workers']} workers: {stats['frames_per_second']:,.1f} frames/s, "
+          f"{stats['realtime']:.2f}x real time at {stats['fps']} FPS")
+    if stats["diverged_at"] is not None:
+        print(f"DIVERGED from the recording at tick {stats['diverged_at']}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""Deterministic match recording and replay.
+
+A match is fully determined by its settings, its seed and the input bits of
+each tick (engine.py draws every random number from the seed and the tick
+counter), plus any ball resizes made mid-match in DJONG. A recording stores
+exactly that: a small header, the resizes, and the inputs as four bits per
+tick (two per paddle), zlib-compressed. It also keeps a checksum of the
+match state once a second, so a replay that drifts is caught at the second
+it drifts, not at the final score. A bot whose moves depend on timing
+(GENIUS, which plans on a thread) is recorded by its presses instead.
+
+Record from either game with PINGPONG_RECORD=<file> (the most recent match
+is saved), watch one at normal speed with PINGPONG_REPLAY=<file>, or replay
+headless as fast as possible:
+
+    python replay.py match.pprec
+    python replay.py match.pprec --realtime
+"""
+import argparse
+import hashlib
+import os
+import struct
+import time
+import zlib
+
+import engine
+
+MAGIC = b"PPRC"
+VERSION = 1
+CHECK_EVERY = engine.TICK_RATE  # ticks between state checksums
+
+# magic, version, width, height, points, seed, crazy, ball size, left ai,
+# right ai, ticks, resizes, checks
+_HEADER = struct.Struct("<4sHHHHQBHbbIII")
+_RESIZE = struct.Struct("<IH")
+_CHECK = struct.Struct("<IQ")
+_STATE = struct.Struct("<I9d2iH")
+
+
+class ReplayError(Exception):
+    pass
+
+
+def checksum(match):
+    """ 64-bit hash of everything that decides the rest of a match. """
+    ball = match.ball
+    state = _STATE.pack(match.tick, ball.x, ball.y, ball.dx, ball.dy, ball.speed,
+                        match.left.x, match.left.y, match.right.x, match.right.y,
+                        match.left.score, match.right.score, ball.width)
+    return int.from_bytes(hashlib.blake2b(state, digest_size=8).digest(), "little")
+
+
+def replayable(ai):
+    """ ai, or None for a bot whose moves depend on timing (its presses are recorded instead). """
+    if ai in engine.POLICIES and not getattr(engine.POLICIES[ai], "replayable", True):
+        return None
+    return ai
+
+
+class Recording:
+    def __init__(self, width, height, points_to_win, seed, crazy=False,
+                 ball_size=engine.BALL_SIZE, left_ai=None, right_ai=None):
+        self.settings = dict(width=width, height=height, points_to_win=points_to_win, seed=seed,
+                             crazy=crazy, ball_size=ball_size, left_ai=left_ai, right_ai=right_ai)
+        self.inputs = bytearray()  # one nibble per tick, even ticks in the low half
+        self.ticks = 0
+        self.resizes = []  # (tick, size), applied before that tick runs
+        self.checks = {}  # tick: checksum of the state before that tick runs
+
+    @classmethod
+    def of(cls, match):
+        return cls(match.width, match.height, match.points_to_win, match.seed, match.crazy,
+                   match.ball_size, replayable(match.left_ai), replayable(match.right_ai))
+
+    def match(self, match_class=engine.Match):
+        """ A fresh match with the recorded settings and seed. """
+        return match_class(**self.settings)
+
+    def append(self, inputs):
+        nibble = (inputs[0] & 3) | (inputs[1] & 3) << 2
+        if self.ticks % 2 == 0:
+            self.inputs.append(nibble)
+        else:
+            self.inputs[-1] |= nibble << 4
+        self.ticks += 1
+
+    def inputs_at(self, tick):
+        if tick >= self.ticks:
+            return 0, 0
+        nibble = self.inputs[tick // 2] >> (4 * (tick % 2))
+        return nibble & 3, nibble >> 2 & 3
+
+    def save(self, path):
+        s = self.settings
+        header = _HEADER.pack(MAGIC, VERSION, s["width"], s["height"], s["points_to_win"], s["seed"],
+                              s["crazy"], s["ball_size"],
+                              -1 if s["left_ai"] is None else s["left_ai"],
+                              -1 if s["right_ai"] is None else s["right_ai"],
+                              self.ticks, len(self.resizes), len(self.checks))
+        parts = [header]
+        parts += [_RESIZE.pack(tick, size) for tick, size in self.resizes]
+        parts += [_CHECK.pack(tick, value) for tick, value in sorted(self.checks.items())]
+        parts.append(zlib.compress(bytes(self.inputs), 9))
+        # Write then rename, so a crash mid-save never leaves half a recording
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(parts))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            (magic, version, width, height, points, seed, crazy, ball_size, left_ai, right_ai,
+             ticks, resizes, checks) = _HEADER.unpack_from(data)
+        except struct.error:
+            raise ReplayError(f"{path}: truncated recording")
+        if magic != MAGIC or version != VERSION:
+            raise ReplayError(f"{path}: not a version {VERSION} recording")
+
+        recording = cls(width, height, points, seed, bool(crazy), ball_size,
+                        None if left_ai < 0 else left_ai, None if right_ai < 0 else right_ai)
+        offset = _HEADER.size
+        for _ in range(resizes):
+            recording.resizes.append(_RESIZE.unpack_from(data, offset))
+            offset += _RESIZE.size
+        for _ in range(checks):
+            tick, value = _CHECK.unpack_from(data, offset)
+            recording.checks[tick] = value
+            offset += _CHECK.size
+        recording.inputs = bytearray(zlib.decompress(data[offset:]))
+        recording.ticks = ticks
+        if len(recording.inputs) != (ticks + 1) // 2:
+            raise ReplayError(f"{path}: expected {ticks} ticks of input")
+        return recording
+
+
+class Recorder:
+    """ Tape for a live match: passes the player's inputs through and records them. """
+
+    def __init__(self, match, path):
+        self.recording = Recording.of(match)
+        self.path = path
+        self.match = match
+
+    def inputs(self, match, live):
+        if match.tick % CHECK_EVERY == 0:
+            self.recording.checks[match.tick] = checksum(match)
+        left, right = live
+        # Bots that can't be replayed are asked for this tick's presses now;
+        # they give the same answer when the match steps
+        if replayable(match.left_ai) != match.left_ai:
+            left = engine.POLICIES[match.left_ai](match, match.left)
+        if replayable(match.right_ai) != match.right_ai:
+            right = engine.POLICIES[match.right_ai](match, match.right)
+        self.recording.append((left, right))
+        return live
+
+    def resize(self, match, size):
+        self.recording.resizes.append((match.tick, size))
+        match.set_ball_size(size)
+
+    def finished(self, match):
+        return False
+
+    def close(self):
+        self.recording.checks[self.match.tick] = checksum(self.match)
+        self.recording.save(self.path)
+
+
+class Player:
+    """ Tape that ignores live inputs and drives the match from a recording. """
+
+    def __init__(self, recording):
+        self.recording = recording
+        self.resizes = list(recording.resizes)
+        self.diverged_at = None
+
+    def inputs(self, match, live):
+        self.check(match)
+        while self.resizes and self.resizes[0][0] <= match.tick:
+            match.set_ball_size(self.resizes.pop(0)[1])
+        return self.recording.inputs_at(match.tick)
+
+    def resize(self, match, size):
+        pass  # resizes come from the recording
+
+    def check(self, match):
+        """ Compare against the recorded checksum for this tick, if there is one. """
+        expected = self.recording.checks.get(match.tick)
+        if expected is not None and self.diverged_at is None and checksum(match) != expected:
+            self.diverged_at = match.tick
+        return self.diverged_at is None
+
+    def finished(self, match):
+        if match.tick >= self.recording.ticks:
+            self.check(match)
+            return True
+        return False
+
+    def close(self):
+        pass
+
+
+def play(recording, realtime=False, match_class=engine.Match):
+    """ Replay a recording without rendering; returns (match, player). """
+    match = recording.match(match_class)
+    player = Player(recording)
+    start = time.perf_counter()
+    while not player.finished(match) and not match.over:
+        engine.step(match, player.inputs(match, (0, 0)))
+        if realtime:
+            delay = start + match.tick * engine.DT - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    player.finished(match)
+    return match, player
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded match without rendering")
+    parser.add_argument("recording")
+    parser.add_argument("--realtime", action="store_true", help=f"pace at {engine.TICK_RATE} ticks/s")
+    parser.add_argument("--repeat", type=int, default=1, help="replay several times, for timing")
+    args = parser.parse_args()
+
+    recording = Recording.load(args.recording)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        match, player = play(recording, args.realtime)
+    elapsed = time.perf_counter() - start
+
+    ticks = match.tick * args.repeat
+    print(f"{match.tick} ticks, score {match.left.score}-{match.right.score}, winner {match.winner}")
+    print(f"{ticks / elapsed:,.0f} ticks/s ({elapsed:.3f}s)")
+    if player.diverged_at is not None:
+        print(f"DIVERGED at tick {player.diverged_at}")
+        raise SystemExit(1)
+    print(f"identical to the recording ({len(recording.checks)} checkpoints)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,545 @@
+"""Headless multi-room match server.
+
+Rooms are engine matches. Each worker process is a shard: it owns some
+rooms, one UDP socket on its own port and one asyncio loop, and a single
+fixed-rate scheduler ticks all of its rooms together at engine.TICK_RATE,
+so a thousand rooms cost one timer, not a thousand. A room's right paddle
+can belong to a netplay.Client (its snapshots and inputs use the same
+protocol as DJONG's network mode); otherwise both paddles are bots and the
+room starts a rematch whenever a match ends.
+
+The front process listens on the public port. A joining client gets a new
+room and is redirected to the shard that runs it. New rooms fill the first
+shard until its measured tick time would pass SATURATION of the tick
+budget, then spill over to the next, so extra cores are only used once one
+is busy. A player's room is closed once its client has been quiet for
+IDLE_TIMEOUT seconds. Player rooms are capped in total and per shard, and
+created no faster than JOIN_RATE a second; a JOIN over either limit is
+answered with netplay's FULL.
+
+CREATE and STATS control packets are only served on a second socket bound
+to the loopback interface (port + CONTROL_OFFSET by default), never on the
+public port. The front asks the shards over pipes and picks up their
+replies as the event loop sees them, so it keeps serving JOINs meanwhile.
+
+    python server.py serve --port 50007 --workers 4
+    python server.py loadgen --rooms 2000 --clients 20 --seconds 10
+
+loadgen starts a server, creates bot-vs-bot rooms through the control
+protocol, connects bot clients over real sockets, and reports tick
+latency percentiles, CPU per room and how many rooms a core can hold.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+from collections import deque
+
+import engine
+import netplay
+from profiler import percentile
+
+PORT = netplay.PORT
+SATURATION = 0.7  # fraction of the tick budget a shard may spend before rooms spill over
+STATS_WINDOW = engine.TICK_RATE * 10
+DEFAULT_ROOM_COST = 15e-6  # seconds per room tick until a shard has measured it
+
+CREATE, STATS = 16, 17  # control packets, JSON after the type byte
+CONTROL_OFFSET = 1000  # default control port, relative to the public one
+MAX_CREATE = 1000  # rooms one CREATE may ask for
+IDLE_TIMEOUT = 60  # seconds without a packet before a player's room is closed
+PLACED_TTL = 10  # seconds the front remembers where it sent a client, to answer its JOIN retries
+# Rooms joined over the public port: caps, and how fast new ones may be created
+MAX_PLAYER_ROOMS = 1000
+MAX_PLAYER_ROOMS_PER_SHARD = 500
+JOIN_RATE = 20  # new player rooms per second
+JOIN_BURST = 40
+# What a CREATE may ask for; rooms run in shards, where only the built-in bots exist
+ROOM_AIS = (None, engine.EASY, engine.MODERATE, engine.HARD, engine.PERFECT)
+MAX_POINTS = 99
+RECOUNT = 1.0  # seconds between asking the shards how many player rooms they still have, while full
+
+
+class Room:
+    def __init__(self, room_id, settings, send=None):
+        self.id = room_id
+        self.settings = settings
+        self.seed = engine.mix64(room_id)
+        self.matches = 0
+        self.match = self.new_match()
+        self.heard = time.monotonic()  # last packet from the remote player
+        # Remote player on the right paddle, if any
+        self.seat = None if send is None else netplay.Host(send, self.match.width, self.match.height)
+
+    def new_match(self):
+        self.matches += 1
+        return engine.Match(seed=engine.mix64(self.seed + self.matches), **self.settings)
+
+    def tick(self):
+        right = self.seat.remote_input() if self.seat is not None else 0
+        events = engine.step(self.match, (0, right))
+        if self.seat is not None:
+            self.seat.publish(self.match, events)
+        if self.match.over:
+            self.match = self.new_match()
+
+
+class _Sender:
+    """ The send() half of netplay.Link, on a shard's own transport. """
+
+    def __init__(self, shard):
+        self.shard = shard
+
+    def send(self, data, addr):
+        self.shard.transport.sendto(data, addr)
+
+
+class Shard(asyncio.DatagramProtocol):
+    """ One worker process: its rooms, its socket and the shared tick scheduler. """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rooms = {}
+        self.players = {}  # client address: room
+        self.ticks = 0
+        self.behind = 0
+        self.durations = deque(maxlen=STATS_WINDOW)
+        self.lateness = deque(maxlen=STATS_WINDOW)
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        self.room_ticks = 0
+        self.room_seconds = 0.0  # CPU spent ticking rooms; the rest of cpu is the shard's own overhead
+
+    def datagram_received(self, data, addr):
+        room = self.players.get(addr)
+        if room is not None:
+            room.heard = time.monotonic()
+            room.seat.handle(data, addr)
+
+    def reap(self):
+        """ Close the rooms of players who have gone quiet. """
+        cutoff = time.monotonic() - IDLE_TIMEOUT
+        for addr, room in list(self.players.items()):
+            if room.heard < cutoff:
+                del self.players[addr]
+                del self.rooms[room.id]
+
+    def command(self):
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            raise SystemExit  # the front process is gone
+        kind = message[0]
+        if kind == "create":
+            _, first_id, count, settings, player = message
+            for room_id in range(first_id, first_id + count):
+                send = _Sender(self) if player is not None else None
+                room = self.rooms[room_id] = Room(room_id, settings, send)
+                if player is not None:
+                    self.players[tuple(player)] = room
+            self.conn.send((len(self.rooms), len(self.players)))
+        elif kind == "count":
+            self.conn.send((len(self.rooms), len(self.players)))
+        elif kind == "stats":
+            self.conn.send(self.stats(reset=message[1]))
+
+    def stats(self, reset=False):
+        durations, lateness = list(self.durations), list(self.lateness)
+        cpu = time.process_time() - self.cpu_start
+        wall = time.perf_counter() - self.wall_start
+        stats = {
+            "rooms": len(self.rooms),
+            "players": len(self.players),
+            "ticks": self.ticks,
+            "behind": self.behind,
+            "tick_p50_ms": percentile(durations, 50) * 1000,
+            "tick_p95_ms": percentile(durations, 95) * 1000,
+            "tick_p99_ms": percentile(durations, 99) * 1000,
+            "late_p50_ms": percentile(lateness, 50) * 1000,
+            "late_p99_ms": percentile(lateness, 99) * 1000,
+            "utilization": sum(durations) / len(durations) / engine.DT if durations else 0.0,
+            "cpu": cpu / wall if wall else 0.0,
+            "cpu_us_per_room_tick": cpu / self.room_ticks * 1e6 if self.room_ticks else 0.0,
+            "cpu_seconds": cpu,
+            "wall_seconds": wall,
+            "room_seconds": self.room_seconds,
+            "room_ticks": self.room_ticks,
+        }
+        if reset:
+            self.durations.clear()
+            self.lateness.clear()
+            self.ticks = self.behind = self.room_ticks = 0
+            self.room_seconds = 0.0
+            self.cpu_start = time.process_time()
+            self.wall_start = time.perf_counter()
+        return stats
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            deadline += engine.DT
+            # Always yield, so sockets and commands are served even when behind
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+            now = loop.time()
+            self.lateness.append(max(0.0, now - deadline))
+            if now - deadline > engine.MAX_FRAME_TIME:
+                # Too far behind to catch up; drop the missed ticks
+                deadline = now
+                self.behind += 1
+
+            start, cpu = time.perf_counter(), time.process_time()
+            for room in self.rooms.values():
+                room.tick()
+            self.durations.append(time.perf_counter() - start)
+            self.room_seconds += time.process_time() - cpu
+            self.ticks += 1
+            self.room_ticks += len(self.rooms)
+            if self.ticks % engine.TICK_RATE == 0:
+                self.reap()
+
+
+def shard_main(conn, port):
+    async def main():
+        loop = asyncio.get_running_loop()
+        shard = Shard(conn)
+        shard.transport, _ = await loop.create_datagram_endpoint(lambda: shard, local_addr=("0.0.0.0", port))
+        loop.add_reader(conn.fileno(), shard.command)
+        conn.send(shard.transport.get_extra_info("sockname")[1])
+        await shard.run()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+class Front(asyncio.DatagramProtocol):
+    """ Public port: room placement and redirects. """
+
+    def __init__(self, workers, port):
+        self.shards = []
+        for i in range(workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shard_main, args=(child, port + 1 + i), daemon=True)
+            process.start()
+            self.shards.append({"conn": parent, "process": process, "port": parent.recv(),
+                                "rooms": 0, "players": 0, "cost": DEFAULT_ROOM_COST, "waiting": deque()})
+        self.next_room = 1
+        self.placed = {}  # client address: (shard port, or None while its room is created; time)
+        self.pruned = self.refilled = self.recounted = time.monotonic()
+        self.join_tokens = JOIN_BURST
+        self.refused = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        loop = asyncio.get_running_loop()
+        for shard in self.shards:
+            loop.add_reader(shard["conn"].fileno(), self._reply, shard)
+
+    def _reply(self, shard):
+        # Shards answer commands in order, so this is the oldest one still waiting
+        try:
+            message = shard["conn"].recv()
+        except EOFError:
+            asyncio.get_running_loop().remove_reader(shard["conn"].fileno())
+            while shard["waiting"]:
+                shard["waiting"].popleft().set_exception(ConnectionError("shard process exited"))
+            return
+        future = shard["waiting"].popleft()
+        if not future.cancelled():
+            future.set_result(message)
+
+    def ask(self, shard, message):
+        """ Future for the shard's reply to a command. """
+        future = asyncio.get_running_loop().create_future()
+        shard["waiting"].append(future)
+        shard["conn"].send(message)
+        return future
+
+    def place(self, count, shards=None):
+        """ Split count new rooms over the shards, filling each up to SATURATION first. """
+        shards = self.shards if shards is None else shards
+        budget = SATURATION * engine.DT
+        plan = []
+        for shard in shards:
+            room = max(shard["cost"], 1e-9)
+            free = max(0, int(budget / room) - shard["rooms"])
+            take = min(count, free)
+            if take:
+                plan.append((shard, take))
+                count -= take
+        if count:
+            # Every core is saturated: spread the rest where the load is lowest
+            rooms = [shard["rooms"] + sum(t for p, t in plan if p is shard) for shard in shards]
+            for i in range(count):
+                n = min(range(len(shards)), key=lambda n: rooms[n] * shards[n]["cost"])
+                rooms[n] += 1
+                plan.append((shards[n], 1))
+        return plan
+
+    async def create(self, count, settings, player=None, shards=None):
+        placed = []
+        replies = []
+        for shard, take in self.place(count, shards):
+            replies.append(self.ask(shard, ("create", self.next_room, take, settings, player)))
+            # Counted now, so creates in flight place against it too
+            shard["rooms"] += take
+            shard["players"] += take if player is not None else 0
+            placed.append((shard, self.next_room, take))
+            self.next_room += take
+        for (shard, _, _), reply in zip(placed, replies):
+            shard["rooms"], shard["players"] = await reply
+        return placed
+
+    async def recount(self):
+        """ Refresh the room counts, which only go down when shards reap idle players. """
+        counts = await asyncio.gather(*(self.ask(shard, ("count",)) for shard in self.shards))
+        for shard, (rooms, players) in zip(self.shards, counts):
+            shard["rooms"], shard["players"] = rooms, players
+
+    async def stats(self, reset=False):
+        results = await asyncio.gather(*(self.ask(shard, ("stats", reset)) for shard in self.shards))
+        for shard, stats in zip(self.shards, results):
+            shard["rooms"], shard["players"] = stats["rooms"], stats["players"]
+            if stats["cpu_us_per_room_tick"]:
+                shard["cost"] = stats["cpu_us_per_room_tick"] / 1e6
+        return results
+
+    def datagram_received(self, data, addr):
+        if not data or data[0] != netplay.JOIN:
+            return
+        now = time.monotonic()
+        if now - self.pruned > PLACED_TTL:
+            self.placed = {a: p for a, p in self.placed.items() if now - p[1] < PLACED_TTL}
+            self.pruned = now
+        placed = self.placed.get(addr)
+        if placed is None:
+            shards = self._open_shards(now)
+            if not shards:
+                self.refused += 1
+                self.transport.sendto(netplay.refuse(), addr)
+                return
+            self.join_tokens -= 1
+            self.placed[addr] = (None, now)
+            asyncio.ensure_future(self.join(addr, shards))
+        elif placed[0] is not None:
+            self.transport.sendto(netplay.redirect(placed[0]), addr)
+
+    def _open_shards(self, now):
+        """ Shards a new player room may go to, or none if the caps or the JOIN rate say no. """
+        self.join_tokens = min(JOIN_BURST, self.join_tokens + (now - self.refilled) * JOIN_RATE)
+        self.refilled = now
+        if self.join_tokens < 1:
+            return []
+        shards = [shard for shard in self.shards if shard["players"] < MAX_PLAYER_ROOMS_PER_SHARD]
+        if not shards or sum(shard["players"] for shard in self.shards) >= MAX_PLAYER_ROOMS:
+            if now - self.recounted > RECOUNT:
+                self.recounted = now
+                asyncio.ensure_future(self.recount())
+            return []
+        return shards
+
+    async def join(self, addr, shards):
+        shard, _, _ = (await self.create(1, {"left_ai": engine.HARD}, player=addr, shards=shards))[0]
+        self.placed[addr] = (shard["port"], time.monotonic())
+        self.transport.sendto(netplay.redirect(shard["port"]), addr)
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def room_settings(request):
+    """ (Match settings, None) from a CREATE request, or (None, error) if any field is out of range.
+
+    Checked here, before anything reaches a shard, where a bad value would
+    raise in the tick loop that every room on it shares.
+    """
+    count = request.get("count")
+    if not _is_int(count) or not 0 < count <= MAX_CREATE:
+        return None, f"count must be 1 to {MAX_CREATE}"
+    for key in ("left_ai", "right_ai"):
+        value = request.get(key)
+        if not (value is None or _is_int(value) and value in ROOM_AIS):
+            return None, f"{key} must be one of {ROOM_AIS}"
+    points = request.get("points_to_win", 5)
+    if not _is_int(points) or not 0 < points <= MAX_POINTS:
+        return None, f"points_to_win must be 1 to {MAX_POINTS}"
+    if not isinstance(request.get("crazy", False), bool):
+        return None, "crazy must be true or false"
+    return {key: request[key] for key in ("left_ai", "right_ai", "points_to_win", "crazy") if key in request}, None
+
+
+class Control(asyncio.DatagramProtocol):
+    """ Loopback socket for the control protocol, kept off the public port. """
+
+    def __init__(self, front):
+        self.front = front
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if data and data[0] in (CREATE, STATS):
+            asyncio.ensure_future(self.serve(data, addr))
+
+    async def serve(self, data, addr):
+        kind = data[0]
+        try:
+            request = json.loads(data[1:]) if data[1:] else {}
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            reply = {"error": "expected a JSON object"}
+        elif kind == CREATE:
+            settings, error = room_settings(request)
+            if error is None:
+                placed = await self.front.create(request["count"], settings)
+                reply = {"rooms": request["count"], "shards": [shard["port"] for shard, _, _ in placed]}
+            else:
+                reply = {"error": error}
+        else:
+            reply = await self.front.stats(bool(request.get("reset")))
+        self.transport.sendto(bytes([kind]) + json.dumps(reply).encode(), addr)
+
+
+async def serve(port=PORT, workers=None, control_port=None):
+    loop = asyncio.get_running_loop()
+    front = Front(workers or os.cpu_count() or 1, port)
+    control_port = port + CONTROL_OFFSET if control_port is None else control_port
+    transport, _ = await loop.create_datagram_endpoint(lambda: front, local_addr=("0.0.0.0", port))
+    control, _ = await loop.create_datagram_endpoint(lambda: Control(front), local_addr=("127.0.0.1", control_port))
+    print(f"listening on {port} (control on 127.0.0.1:{control_port}), "
+          f"shards on {', '.join(str(s['port']) for s in front.shards)}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        transport.close()
+        control.close()
+
+
+def request(address, kind, payload, timeout=30.0):
+    """ Control request to a running server's control port; returns the decoded JSON reply. """
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(bytes([kind]) + json.dumps(payload).encode(), address)
+        data, _ = sock.recvfrom(65536)
+    return json.loads(data[1:])
+
+
+def loadgen(rooms, clients, seconds, workers, port, difficulty):
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "--port", str(port),
+                               "--workers", str(workers)], stdout=subprocess.PIPE, text=True)
+    try:
+        print(server.stdout.readline().strip())
+        address = ("127.0.0.1", port)
+        control = ("127.0.0.1", port + CONTROL_OFFSET)
+
+        start = time.perf_counter()
+        batch = 250
+        for done in range(0, rooms, batch):
+            request(control, CREATE, {"count": min(batch, rooms - done), "left_ai": difficulty,
+                                      "right_ai": difficulty, "points_to_win": 5})
+        print(f"created {rooms} bot rooms in {time.perf_counter() - start:.2f}s")
+
+        # Networked bots play the right paddle of their own rooms
+        links = [netplay.Link(0) for _ in range(clients)]
+        players = [netplay.Client(link, address) for link in links]
+        views = [engine.Match() for _ in players]
+        request(control, STATS, {"reset": True})
+
+        stepper = engine.FixedStep()
+        next_frame = previous = time.perf_counter()
+        end = previous + seconds
+        while time.perf_counter() < end:
+            now = time.perf_counter()
+            frame_time, previous = now - previous, now
+            ticks = stepper.advance(frame_time)
+            for player, view in zip(players, views):
+                player.poll(view)
+                for _ in range(ticks):
+                    gap = view.ball.centery - view.right.centery
+                    bits = engine.DOWN if gap > 10 else engine.UP if gap < -10 else 0
+                    player.predict(view.right, bits, view.height)
+                player.render(view, frame_time)
+            next_frame += engine.DT
+            delay = next_frame - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        shards = request(control, STATS, {})
+        for link in links:
+            link.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+    report(shards, players, seconds)
+
+
+def report(shards, players, seconds):
+    print(f"{'shard':<7}{'rooms':>7}{'tick p50':>10}{'p95':>8}{'p99':>8}{'late p99':>10}"
+          f"{'util':>7}{'cpu':>6}{'us/room':>9}{'behind':>8}")
+    for i, s in enumerate(shards):
+        print(f"{i:<7}{s['rooms']:>7}{s['tick_p50_ms']:>9.2f}m{s['tick_p95_ms']:>7.2f}m{s['tick_p99_ms']:>7.2f}m"
+              f"{s['late_p99_ms']:>9.2f}m{s['utilization']:>7.0%}{s['cpu']:>6.0%}"
+              f"{s['cpu_us_per_room_tick']:>9.1f}{s['behind']:>8}")
+
+    rooms = sum(s["rooms"] for s in shards)
+    ticks = sum(s["ticks"] * s["rooms"] for s in shards) / seconds
+    room_ticks = sum(s["room_ticks"] for s in shards)
+    print(f"{rooms} rooms, {ticks:,.0f} room ticks/s (target {rooms * engine.TICK_RATE:,})")
+    if room_ticks:
+        # Weighted by room ticks: a shard holding a handful of rooms mostly measures its own overhead
+        average = sum(s["cpu_seconds"] for s in shards) / room_ticks * 1e6
+        per_room = sum(s["room_seconds"] for s in shards) / room_ticks * 1e6
+        overhead = sum((s["cpu_seconds"] - s["room_seconds"]) / s["wall_seconds"] for s in shards) / len(shards)
+        overhead = max(0.0, overhead)
+        holds = (1 - overhead) * 1e6 / (per_room * engine.TICK_RATE)
+        print(f"CPU per room: {per_room * engine.TICK_RATE / 1e4:.3f}% of a core ({per_room:.1f} us per tick, "
+              f"{average:.1f} us with shard overhead); one core holds about {holds:,.0f} rooms")
+        print(f"fixed overhead per shard (scheduler, sockets, stats): {overhead:.1%} of a core")
+    if players:
+        received = sum(p.received for p in players)
+        print(f"{len(players)} network players: {sum(p.connected for p in players)} connected, "
+              f"{received / len(players) / seconds:.0f} snapshots/s each, "
+              f"{sum(p.mispredictions for p in players)} mispredictions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-room match server")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("serve", help="run the server")
+    run.add_argument("--port", type=int, default=PORT)
+    run.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    run.add_argument("--control-port", type=int, help=f"loopback control port (default: port + {CONTROL_OFFSET})")
+
+    load = commands.add_parser("loadgen", help="start a server and fill it with bot rooms")
+    load.add_argument("--rooms", type=int, default=1000)
+    load.add_argument("--clients", type=int, default=10, help="rooms played by bots over the network")
+    load.add_argument("--seconds", type=float, default=10)
+    load.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    load.add_argument("--port", type=int, default=PORT + 100)
+    load.add_argument("--difficulty", type=int, default=engine.HARD)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        # Exit cleanly on SIGTERM too, so the shard processes are stopped with us
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            asyncio.run(serve(args.port, args.workers, args.control_port))
+        except KeyboardInterrupt:
+            pass
+    else:
+        loadgen(args.rooms, args.clients, args.seconds, args.workers, args.port, args.difficulty)
+
+
+if __name__ == "__main__":
+    main()
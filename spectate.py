@@ -0,0 +1,351 @@
+"""Spectator broadcast: one match, many viewers.
+
+Every tick the match is encoded once, with netplay's snapshot format, as a
+delta against the previous tick, or as a keyframe every KEYFRAME_EVERY
+ticks. The frames queued since the last flush (every FLUSH_INTERVAL, or
+less often when the network thread is busy) are joined once and the same
+bytes are written to every subscriber, so the cost per viewer is one
+socket write per flush. Frames travel over TCP with a two-byte length
+prefix; an INFO frame with the court size and crazy mode comes first and
+again whenever a new match changes them.
+
+The game thread only encodes and hands the frame over; the sockets are
+served by an asyncio loop on a background thread. A subscriber whose
+socket backs up past SOFT_LIMIT bytes is downsampled to keyframes only
+until it drains, and one that is still backed up after DROP_AFTER seconds
+is disconnected, so a slow viewer never holds up the game or the others.
+
+DJONG ULTIMATE broadcasts with PINGPONG_SPECTATE=<port>. To watch, or to
+benchmark the fan-out with many local subscribers:
+
+    python spectate.py watch 127.0.0.1:50017
+    python spectate.py bench --subscribers 1000 --slow 50 --seconds 12
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+import engine
+import netplay
+from profiler import percentile
+
+PORT = 50017
+KEYFRAME_EVERY = 30  # ticks, a third of a second to join or recover
+SOFT_LIMIT = 2048  # bytes queued for a subscriber before it only gets keyframes
+DROP_AFTER = 5.0  # seconds a subscriber may stay backed up before it is dropped
+FLUSH_INTERVAL = 1.0 / 45  # seconds; spectators are at most this much further behind
+SEND_BUFFER = 8192  # small kernel buffers, so backlog shows up in SOFT_LIMIT quickly
+
+INFO = 8
+_INFO = struct.Struct("<BHHB")  # type, width, height, crazy
+_LENGTH = struct.Struct("<H")
+
+WAITING, LIVE, DEGRADED = range(3)
+
+
+def frame(packet):
+    return _LENGTH.pack(len(packet)) + packet
+
+
+class _Subscriber(asyncio.Protocol):
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.state = WAITING
+        self.since = 0.0
+        self.frames = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        if self.broadcaster.info is not None:
+            transport.write(self.broadcaster.info)
+        self.broadcaster.subscribers.add(self)
+
+    def connection_lost(self, exc):
+        self.broadcaster.subscribers.discard(self)
+
+
+class Broadcaster:
+    def __init__(self, port=PORT, keyframe_every=KEYFRAME_EVERY, flush_interval=FLUSH_INTERVAL):
+        self.keyframe_every = keyframe_every
+        self.flush_interval = flush_interval
+        self.pending = deque()
+        self.scheduled = False
+        self.subscribers = set()
+        self.info = None
+        self.number = 0
+        self.previous = None
+        self.hits = 0
+        self.dropped = self.sent = self.skipped = 0
+        self.bytes = {True: [0, 0], False: [0, 0]}  # keyframe: [frames, bytes]
+        self.publish_times = deque(maxlen=engine.TICK_RATE * 10)
+        self.fanout_times = deque(maxlen=engine.TICK_RATE * 10)
+        self.batch_sizes = deque(maxlen=engine.TICK_RATE * 10)
+
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(port, ready), daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def _run(self, port, ready):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: _Subscriber(self), "0.0.0.0", port, backlog=1024))
+        self.port = self.server.sockets[0].getsockname()[1]
+        ready.set()
+        self.loop.run_forever()
+
+    def publish(self, match, events=()):
+        """ Encode this tick once and queue it for every subscriber; called from the game loop. """
+        start = time.perf_counter()
+        self.hits += sum(1 for kind, side in events if kind == engine.HIT)
+        info = frame(_INFO.pack(INFO, match.width, match.height, match.crazy))
+        if info != self.info:
+            self.info = info
+            self.previous = None  # a new court starts with a keyframe
+        else:
+            info = b""
+
+        self.number += 1
+        state = netplay.snapshot_state(match, self.hits)
+        keyframe = self.previous is None or self.number % self.keyframe_every == 0
+        baseline = None if keyframe else (self.number - 1, self.previous)
+        data = info + frame(netplay.encode(self.number, state, 0, baseline))
+        self.previous = state
+        self.bytes[keyframe][0] += 1
+        self.bytes[keyframe][1] += len(data)
+
+        self.pending.append((data, keyframe))
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon_threadsafe(self.loop.call_later, self.flush_interval, self._flush)
+        self.publish_times.append(time.perf_counter() - start)
+
+    def _flush(self):
+        # Everything queued since the last flush goes out as one write per
+        # subscriber; when this thread falls behind, batches just get bigger
+        self.scheduled = False
+        frames = []
+        while self.pending:
+            frames.append(self.pending.popleft())
+        if not frames:
+            return
+        start = time.perf_counter()
+
+        keys = [i for i, (data, keyframe) in enumerate(frames) if keyframe]
+        everything = b"".join(data for data, keyframe in frames)
+        keyframes = b"".join(frames[i][0] for i in keys)
+        resume = b"".join(data for data, keyframe in frames[keys[-1]:]) if keys else b""
+        resumed = len(frames) - keys[-1] if keys else 0
+
+        for subscriber in list(self.subscribers):
+            transport = subscriber.transport
+            if transport.is_closing():
+                self.subscribers.discard(subscriber)
+                continue
+            backlog = transport.get_write_buffer_size()
+            if subscriber.state == LIVE and backlog > SOFT_LIMIT:
+                subscriber.state = DEGRADED
+                subscriber.since = start
+            elif subscriber.state != LIVE and keys and backlog <= SOFT_LIMIT // 2:
+                # Deltas can resume from the newest keyframe on
+                subscriber.state = LIVE
+                transport.write(resume)
+                self.sent += resumed
+                self.skipped += len(frames) - resumed
+                continue
+            elif subscriber.state == DEGRADED and start - subscriber.since > DROP_AFTER:
+                transport.abort()
+                self.subscribers.discard(subscriber)
+                self.dropped += 1
+                continue
+
+            if subscriber.state == LIVE:
+                transport.write(everything)
+                self.sent += len(frames)
+            else:
+                if subscriber.state == DEGRADED and keys:
+                    transport.write(keyframes)
+                    self.sent += len(keys)
+                self.skipped += len(frames) - (len(keys) if subscriber.state == DEGRADED else 0)
+        self.fanout_times.append(time.perf_counter() - start)
+        self.batch_sizes.append(len(frames))
+
+    def stats(self):
+        states = [s.state for s in list(self.subscribers)]
+        publish, fanout = list(self.publish_times), list(self.fanout_times)
+        keyframes, deltas = self.bytes[True], self.bytes[False]
+        return {
+            "subscribers": len(states),
+            "live": states.count(LIVE),
+            "degraded": states.count(DEGRADED),
+            "waiting": states.count(WAITING),
+            "dropped": self.dropped,
+            "frames_sent": self.sent,
+            "frames_skipped": self.skipped,
+            "keyframe_bytes": keyframes[1] / keyframes[0] if keyframes[0] else 0.0,
+            "delta_bytes": deltas[1] / deltas[0] if deltas[0] else 0.0,
+            "publish_p50_us": percentile(publish, 50) * 1e6,
+            "publish_p99_us": percentile(publish, 99) * 1e6,
+            "fanout_p50_ms": percentile(fanout, 50) * 1000,
+            "fanout_p99_ms": percentile(fanout, 99) * 1000,
+            "frames_per_flush": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0.0,
+        }
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(1.0)
+
+
+class Viewer:
+    """ Rebuilds the match state from a spectator stream, one frame at a time. """
+
+    def __init__(self):
+        self.size = None
+        self.crazy = False
+        self.number = None
+        self.state = None
+        self.frames = 0
+
+    def feed(self, packet):
+        if packet[0] == INFO:
+            _, width, height, crazy = _INFO.unpack(packet)
+            self.size, self.crazy = (width, height), bool(crazy)
+            self.state = None
+            return
+        decoded = netplay.decode(packet, {self.number: self.state} if self.state is not None else {})
+        if decoded is None:
+            return  # a delta before our first keyframe
+        self.number, self.state, _ = decoded
+        self.frames += 1
+
+    @property
+    def score(self):
+        return self.state[netplay.LEFT_SCORE], self.state[netplay.RIGHT_SCORE]
+
+
+async def read_frames(reader, viewer=None):
+    """ Read frames until the stream ends and return how many; a viewer also decodes them. """
+    count = 0
+    while True:
+        try:
+            header = await reader.readexactly(_LENGTH.size)
+            packet = await reader.readexactly(_LENGTH.unpack(header)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return count
+        count += 1
+        if viewer is not None:
+            viewer.feed(packet)
+
+
+async def watch(address):
+    reader, writer = await asyncio.open_connection(*address)
+    viewer = Viewer()
+    score = None
+    while True:
+        header = await reader.readexactly(_LENGTH.size)
+        viewer.feed(await reader.readexactly(_LENGTH.unpack(header)[0]))
+        if viewer.state is not None and viewer.score != score:
+            score = viewer.score
+            print(f"{score[0]} - {score[1]}{'  (crazy)' if viewer.crazy else ''}", flush=True)
+
+
+async def _subscribers(port, count, slow, seconds):
+    """ count viewers on localhost; the first `slow` of them never read. """
+    tasks, writers, results = [], [], []
+    for i in range(count):
+        if i < slow:
+            sock = socket.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+            sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(sock, ("127.0.0.1", port))
+            writers.append(sock)
+            continue
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writers.append(writer)
+        tasks.append(asyncio.ensure_future(read_frames(reader, Viewer() if i == slow else None)))
+    print("ready", flush=True)
+    await asyncio.sleep(seconds)
+    for writer in writers:
+        writer.close()
+    results = await asyncio.gather(*tasks)
+    return {"readers": len(results), "frames_min": min(results, default=0),
+            "frames_max": max(results, default=0)}
+
+
+def bench(subscribers, slow, seconds):
+    broadcaster = Broadcaster(0)
+    viewers = subprocess.Popen([sys.executable, os.path.abspath(__file__), "subscribers",
+                                "--port", str(broadcaster.port), "--count", str(subscribers),
+                                "--slow", str(slow), "--seconds", str(seconds)],
+                               stdout=subprocess.PIPE, text=True)
+    viewers.stdout.readline()  # all connected
+
+    match = engine.Match(seed=1, points_to_win=10 ** 9, left_ai=engine.HARD, right_ai=engine.HARD)
+    stepper = engine.FixedStep()
+    late = []
+    start = next_frame = previous = time.perf_counter()
+    while time.perf_counter() - start < seconds - 0.5:
+        now = time.perf_counter()
+        late.append(max(0.0, now - next_frame))
+        frame_time, previous = now - previous, now
+        for _ in range(stepper.advance(frame_time)):
+            broadcaster.publish(match, engine.step(match))
+        next_frame += 1.0 / engine.TICK_RATE
+        delay = next_frame - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    stats = broadcaster.stats()
+    received = json.loads(viewers.communicate()[0].splitlines()[-1])
+    broadcaster.close()
+
+    print(f"{subscribers} subscribers ({slow} never read) for {seconds:.0f}s, {broadcaster.number} ticks")
+    for key, value in stats.items():
+        print(f"  {key:<18}{value:.2f}" if isinstance(value, float) else f"  {key:<18}{value}")
+    print(f"  game loop late p99 {percentile(late, 99) * 1000:.2f} ms")
+    print(f"  readers got {received['frames_min']}-{received['frames_max']} frames each")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spectator broadcast tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    view = commands.add_parser("watch", help="print the score of a broadcast as it changes")
+    view.add_argument("address", help="host:port")
+    test = commands.add_parser("bench", help="fan out a bot match to many local subscribers")
+    test.add_argument("--subscribers", type=int, default=1000)
+    test.add_argument("--slow", type=int, default=50, help="subscribers that never read")
+    test.add_argument("--seconds", type=float, default=12)
+    child = commands.add_parser("subscribers", help=argparse.SUPPRESS)
+    child.add_argument("--port", type=int)
+    child.add_argument("--count", type=int)
+    child.add_argument("--slow", type=int)
+    child.add_argument("--seconds", type=float)
+    args = parser.parse_args()
+
+    if args.command == "watch":
+        host, _, port = args.address.rpartition(":")
+        try:
+            asyncio.run(watch((host or "127.0.0.1", int(port or PORT))))
+        except (KeyboardInterrupt, asyncio.IncompleteReadError):
+            pass
+    elif args.command == "bench":
+        bench(args.subscribers, args.slow, args.seconds)
+    else:
+        print(json.dumps(asyncio.run(_subscribers(args.port, args.count, args.slow, args.seconds))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Rendered text cache shared by both frontends.
+
+font.render() is the most expensive call in a menu frame, and almost all
+of the strings drawn are the same every frame. render() keeps the
+surfaces keyed by (font, text, color, antialias) with LRU eviction.
+
+Set PINGPONG_TEXT_CACHE=0 (or cache.enabled = False) to render every call.
+"""
+import os
+from collections import OrderedDict
+
+MAX_ENTRIES = 256
+
+
+class TextCache:
+    def __init__(self, max_entries=MAX_ENTRIES, enabled=True):
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def render(self, font, text, antialias, color):
+        if not self.enabled:
+            self.misses += 1
+            return font.render(text, antialias, color)
+
+        key = (font, text, tuple(color), antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, antialias, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.max_entries:
+            self.surfaces.popitem(last=False)
+            self.evictions += 1
+        return surface
+
+    def clear(self):
+        self.surfaces.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.surfaces),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+cache = TextCache(enabled=os.environ.get("PINGPONG_TEXT_CACHE", "1") != "0")
+
+
+def render(font, text, antialias, color):
+    return cache.render(font, text, antialias, color)
@@ -0,0 +1,197 @@
+"""Round-robin bot tournaments with Elo and win-rate tables.
+
+Every pair of entrants (the built-in difficulties and any policies trained
+with gymenv.py) plays the same number of matches from each side, with both
+paddles bot-controlled. Matches are split into chunks and spread over a
+process pool; every match seed is derived from the tournament seed and the
+match's place in the schedule, so results don't depend on the number of
+workers. Bot-vs-bot chunks run on batch.BatchMatch, policy chunks on
+engine.step.
+
+    python tournament.py --matches 200 --points 5 11 --crazy both
+    python tournament.py --policy policy.npy --entrants MODERATE HARD
+
+A match still going at --max-ticks goes to whoever leads, or is a draw if
+the score is level (HARD and PERFECT can return each other's shots forever).
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import engine
+from batch import DIFFICULTIES, LEFT_SCORED, RIGHT_SCORED, BatchMatch
+
+CHUNK = 64  # matches per pool task
+MAX_TICKS = 120 * engine.TICK_RATE
+ELO_SCALE = 400
+ELO_MEAN = 1500
+
+_policies = {}  # name: difficulty, registered in each worker by _init
+
+
+def _init(policy_paths):
+    import gymenv
+    for path in policy_paths:
+        _policies[policy_name(path)] = engine.register_policy(gymenv.LinearPolicy.load(path))
+
+
+def policy_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _difficulty(name):
+    return DIFFICULTIES[name] if name in DIFFICULTIES else _policies[name]
+
+
+def match_seed(seed, config, left, right, i):
+    """ Seed of one scheduled match, independent of how the schedule is chunked. """
+    key = f"{seed}/{config['points_to_win']}/{config['crazy']}/{left}/{right}".encode()
+    return engine.mix64(int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") + i)
+
+
+def play_chunk(task):
+    """ Play one chunk; returns (config index, left, right, left wins, right wins, draws, ticks, seconds). """
+    config_index, config, left, right, seeds, max_ticks = task
+    start = time.perf_counter()
+    left_ai, right_ai = _difficulty(left), _difficulty(right)
+    if left in DIFFICULTIES and right in DIFFICULTIES:
+        batch = BatchMatch(seeds, left_ai=left_ai, right_ai=right_ai, **config).run(max_ticks)
+        left_score, right_score = batch.left_score, batch.right_score
+        left_wins = int(np.sum((batch.winner == LEFT_SCORED) | ((batch.winner == 0) & (left_score > right_score))))
+        right_wins = int(np.sum((batch.winner == RIGHT_SCORED) | ((batch.winner == 0) & (right_score > left_score))))
+        ticks = int(batch.tick.sum())
+    else:
+        left_wins = right_wins = ticks = 0
+        for seed in seeds:
+            match = engine.run(engine.Match(seed=seed, left_ai=left_ai, right_ai=right_ai, **config), max_ticks)
+            left_wins += match.left.score > match.right.score
+            right_wins += match.right.score > match.left.score
+            ticks += match.tick
+    draws = len(seeds) - left_wins - right_wins
+    return config_index, left, right, left_wins, right_wins, draws, ticks, time.perf_counter() - start
+
+
+def schedule(entrants, configs, matches, seed, max_ticks):
+    """ Pool tasks: every ordered pair of entrants plays matches games per config. """
+    tasks = []
+    for config_index, config in enumerate(configs):
+        for left, right in itertools.permutations(entrants, 2):
+            seeds = [match_seed(seed, config, left, right, i) for i in range(matches)]
+            for offset in range(0, matches, CHUNK):
+                tasks.append((config_index, config, left, right, seeds[offset:offset + CHUNK], max_ticks))
+    return tasks
+
+
+def elo(entrants, score, games, iterations=1000):
+    """ Elo ratings fitted to all results at once (Bradley-Terry), not in match order.
+
+    score[a][b] is a's points against b (a draw is half a point). Every pair
+    also gets one virtual draw, so an entrant that never drops a point gets
+    a large but finite rating.
+    """
+    strength = {name: 1.0 for name in entrants}
+    for _ in range(iterations):
+        updated = {}
+        for a in entrants:
+            won = sum(score[a][b] + 0.5 for b in entrants if b != a)
+            expected = sum((games[a][b] + 1) / (strength[a] + strength[b]) for b in entrants if b != a)
+            updated[a] = won / expected
+        mean = math.exp(sum(math.log(s) for s in updated.values()) / len(updated))
+        strength = {name: s / mean for name, s in updated.items()}
+    return {name: ELO_MEAN + ELO_SCALE * math.log10(s) for name, s in strength.items()}
+
+
+def tables(entrants, results):
+    """ (ratings, score, games) of one config from its chunk results. """
+    score = {a: {b: 0.0 for b in entrants} for a in entrants}
+    games = {a: {b: 0 for b in entrants} for a in entrants}
+    for left, right, left_wins, right_wins, draws in results:
+        score[left][right] += left_wins + draws / 2
+        score[right][left] += right_wins + draws / 2
+        games[left][right] += left_wins + right_wins + draws
+        games[right][left] += left_wins + right_wins + draws
+    return elo(entrants, score, games), score, games
+
+
+def print_tables(entrants, ratings, score, games):
+    ranked = sorted(entrants, key=ratings.get, reverse=True)
+    width = max(10, max(len(name) for name in entrants) + 2)
+    print(f"{'entrant':<{width}}{'elo':>7}{'score':>8}{'games':>7}")
+    for name in ranked:
+        played = sum(games[name].values())
+        print(f"{name:<{width}}{ratings[name]:>7.0f}{sum(score[name].values()) / played:>8.1%}{played:>7}")
+    print()
+    print(f"{'score vs':<{width}}" + "".join(f"{name:>{width}}" for name in ranked))
+    for a in ranked:
+        cells = "".join(f"{'-' if a == b else format(score[a][b] / games[a][b], '.1%'):>{width}}" for b in ranked)
+        print(f"{a:<{width}}{cells}")
+
+
+def run(entrants, configs, matches, seed=0, workers=None, max_ticks=MAX_TICKS, policies=()):
+    """ Play the tournament; returns ({config index: chunk results}, stats). """
+    tasks = schedule(entrants, configs, matches, seed, max_ticks)
+    workers = workers or os.cpu_count() or 1
+    results = {i: [] for i in range(len(configs))}
+    busy = ticks = 0
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers, _init, (list(policies),)) as pool:
+        # imap keeps schedule order, so the tables come out the same every run
+        for config_index, left, right, lw, rw, draws, chunk_ticks, seconds in pool.imap(play_chunk, tasks):
+            results[config_index].append((left, right, lw, rw, draws))
+            busy += seconds
+            ticks += chunk_ticks
+    elapsed = time.perf_counter() - start
+    played = sum(len(task[4]) for task in tasks)
+    stats = {"matches": played, "ticks": ticks, "seconds": elapsed, "workers": workers,
+             "matches_per_second": played / elapsed, "ticks_per_second": ticks / elapsed,
+             "worker_seconds": busy}
+    return results, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Round-robin tournament between bot difficulties")
+    parser.add_argument("--entrants", nargs="+", choices=DIFFICULTIES, default=list(DIFFICULTIES),
+                        help="built-in difficulties to enter")
+    parser.add_argument("--policy", action="append", default=[], help="trained policy to enter (repeatable)")
+    parser.add_argument("--matches", type=int, default=100, help="matches per pair and side")
+    parser.add_argument("--points", type=int, nargs="+", default=[5], help="points to win, one table each")
+    parser.add_argument("--crazy", choices=("off", "on", "both"), default="off")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--max-ticks", type=int, default=MAX_TICKS)
+    parser.add_argument("--json", help="save the tables and throughput as JSON")
+    args = parser.parse_args()
+
+    entrants = list(args.entrants) + [policy_name(path) for path in args.policy]
+    if len(set(entrants)) < 2:
+        parser.error("need at least two distinct entrants")
+    crazy = {"off": [False], "on": [True], "both": [False, True]}[args.crazy]
+    configs = [{"points_to_win": points, "crazy": c} for points in args.points for c in crazy]
+
+    results, stats = run(entrants, configs, args.matches, args.seed, args.workers, args.max_ticks, args.policy)
+
+    report = {"stats": stats, "configs": []}
+    for i, config in enumerate(configs):
+        ratings, score, games = tables(entrants, results[i])
+        print(f"== points to win {config['points_to_win']}{', crazy' if config['crazy'] else ''} ==")
+        print_tables(entrants, ratings, score, games)
+        print()
+        report["configs"].append({"config": config, "elo": ratings, "score": score, "games": games})
+
+    print(f"{stats['matches']} matches in {stats['seconds']:.2f}s on {stats['workers']} workers: "
+          f"{stats['matches_per_second']:,.1f} matches/s, {stats['ticks_per_second']:,.0f} ticks/s, "
+          f"{stats['matches'] / stats['worker_seconds']:,.1f} matches/s per worker")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()